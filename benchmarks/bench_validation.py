@@ -0,0 +1,132 @@
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+import click
+import pandas as pd
+from benchmarks.generate_csv import write_csv, rate_options, rates_from
+from services.csv_blocks import read_header, iter_row_blocks
+from services.file_processing import (
+    CSV_CHUNK_BYTES, analyze_block, parse_csv_bytes, merge_error_samples, failure_segments, timed,
+)
+from services.file_validators import validate_template
+
+STAGES = ["csv_parse", "validate_template", "validate_nulls", "validate_data_types", "row_hashing", "result_assembly"]
+
+
+def run_pipeline(path: str, chunk_bytes: int) -> dict:
+    """Run the worker's CPU path over a CSV in one process and return per-stage seconds."""
+    timings = {}
+    result = {"status": "success", "errors": {}, "error_counts": {}}
+    rows = 0
+    with open(path, "rb") as fh:
+        header = read_header(fh)
+        with timed(timings, "validate_template"):
+            validate_template(parse_csv_bytes(header))
+        sample_budget = {}
+        for segment_no, block in enumerate(iter_row_blocks(fh, chunk_bytes)):
+            started = time.perf_counter()
+            analysis = analyze_block(header, block)
+            elapsed = time.perf_counter() - started
+            for name, seconds in analysis["timings"].items():
+                timings[name] = timings.get(name, 0.0) + seconds
+            # Whatever analyze_block spent outside its timed stages went into building its result
+            timings["result_assembly"] = timings.get("result_assembly", 0.0) + elapsed - sum(analysis["timings"].values())
+            with timed(timings, "result_assembly"):
+                if analysis["error_counts"]:
+                    merge_error_samples(result, analysis, rows)
+                failure_segments(analysis, segment_no, rows, sample_budget)
+            rows += analysis["rows"]
+    return {"rows": rows, "timings": timings, "error_counts": result["error_counts"]}
+
+
+def measure(path: str, chunk_bytes: int, repeat: int) -> dict:
+    """Time the pipeline repeat times, keeping the fastest run, and record peak memory."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run = run_pipeline(path, chunk_bytes)
+        run["total_seconds"] = time.perf_counter() - started
+        if best is None or run["total_seconds"] < best["total_seconds"]:
+            best = run
+    # Memory is measured on a separate run so tracing does not skew the timings
+    tracemalloc.start()
+    run_pipeline(path, chunk_bytes)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rows = best["rows"]
+    return {
+        "rows": rows,
+        "file_bytes": os.path.getsize(path),
+        "total_seconds": round(best["total_seconds"], 6),
+        "rows_per_sec": round(rows / best["total_seconds"], 1) if best["total_seconds"] else None,
+        "stages": {
+            stage: {
+                "seconds": round(best["timings"].get(stage, 0.0), 6),
+                "rows_per_sec": round(rows / best["timings"][stage], 1) if best["timings"].get(stage) else None,
+            }
+            for stage in STAGES
+        },
+        "error_counts": best["error_counts"],
+        "peak_traced_memory_bytes": peak,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+@click.command()
+@click.option("--rows", "row_counts", multiple=True, type=int, default=[1_000, 100_000], show_default=True,
+              help="Row counts to benchmark; repeat the option for several sizes (1k to 10M).")
+@click.option("--repeat", default=3, show_default=True, help="Runs per size; the fastest is reported.")
+@click.option("--chunk-bytes", default=CSV_CHUNK_BYTES, show_default=True, help="Block size, as CSV_CHUNK_BYTES.")
+@click.option("--seed", default=0, show_default=True)
+@click.option("--output", type=click.Path(dir_okay=False), help="Write the JSON report here instead of stdout.")
+@rate_options
+def main(row_counts, repeat, chunk_bytes, seed, output, **options):
+    """Benchmark parsing, validation, hashing and result assembly on synthetic CSVs."""
+    rates = rates_from(options)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in row_counts:
+            path = os.path.join(tmp, f"bench_{rows}.csv")
+            write_csv(path, rows, rates, seed)
+            result = measure(path, chunk_bytes, repeat)
+            click.echo(f"{rows:>10} rows: {result['rows_per_sec']} rows/s, peak {result['peak_traced_memory_bytes'] / 1e6:.1f} MB", err=True)
+            results.append(result)
+            os.remove(path)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "chunk_bytes": chunk_bytes,
+        "error_rates": rates,
+        "seed": seed,
+        # ru_maxrss is in kilobytes on Linux
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as fh:
+            fh.write(text + "\n")
+    else:
+        click.echo(text)
+
+
+if __name__ == "__main__":
+    main()
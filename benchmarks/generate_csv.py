@@ -0,0 +1,90 @@
+import click
+import numpy as np
+import pandas as pd
+from services.constants import EXPECTED_COLUMNS
+
+NAMES = ["Aarav", "Priya", "Rohan", "Ananya", "Vikram", "Sneha", "Arjun", "Kavya", "Rahul", "Isha"]
+PLACES = [("Mumbai", "Maharashtra"), ("Pune", "Maharashtra"), ("Delhi", "Delhi"), ("Bengaluru", "Karnataka"),
+          ("Chennai", "Tamil Nadu"), ("Jaipur", "Rajasthan"), ("Kolkata", "West Bengal"), ("Lucknow", "Uttar Pradesh")]
+OCCUPATIONS = ["Engineer", "Teacher", "Doctor", "Designer", "Analyst", "Nurse", "Lawyer", "Chef"]
+# Columns a null error may blank out; sno stays filled so rows remain identifiable
+NULLABLE_COLUMNS = [col for col in EXPECTED_COLUMNS if col != "sno"]
+CHUNK_ROWS = 100_000
+
+
+def generate_chunk(rng: np.random.Generator, start: int, rows: int, rates: dict) -> pd.DataFrame:
+    """Build rows start+1..start+rows matching EXPECTED_COLUMNS, with errors injected at the given rates."""
+    sno = np.arange(start + 1, start + rows + 1)
+    names = np.array(NAMES)[rng.integers(0, len(NAMES), rows)]
+    places = rng.integers(0, len(PLACES), rows)
+    birth = pd.Series(np.datetime64("1950-01-01") + rng.integers(0, 365 * 55, rows).astype("timedelta64[D]"))
+    df = pd.DataFrame({
+        "sno": sno,
+        "name": names,
+        "age": rng.integers(18, 90, rows).astype(str),
+        "gender": np.where(rng.random(rows) < 0.5, "M", "F"),
+        "datetime": birth.dt.strftime("%m-%d-%Y").to_numpy(),
+        "city": np.array([p[0] for p in PLACES])[places],
+        "state": np.array([p[1] for p in PLACES])[places],
+        "email": pd.Series(names).str.lower().to_numpy() + sno.astype(str) + "@example.com",
+        "contact_no": rng.integers(6_000_000_000, 9_999_999_999, rows).astype(str),
+        "occupation": np.array(OCCUPATIONS)[rng.integers(0, len(OCCUPATIONS), rows)],
+    }, columns=EXPECTED_COLUMNS)
+
+    def pick(rate):
+        return rng.random(rows) < rate
+
+    mask = pick(rates["phone"])
+    df.loc[mask, "contact_no"] = df.loc[mask, "contact_no"].str[:6]
+    mask = pick(rates["dob"])
+    df.loc[mask, "datetime"] = "13-45-" + df.loc[mask, "datetime"].str[-4:]
+    mask = pick(rates["email"])
+    df.loc[mask, "email"] = df.loc[mask, "email"].str.replace("@", "", regex=False)
+    null_rows = np.flatnonzero(pick(rates["null"]))
+    null_cols = rng.integers(0, len(NULLABLE_COLUMNS), len(null_rows))
+    for col_index in np.unique(null_cols):
+        df.loc[null_rows[null_cols == col_index], NULLABLE_COLUMNS[col_index]] = ""
+    # A duplicate repeats the previous row exactly, sno included, so it hashes the same
+    dup_rows = np.flatnonzero(pick(rates["duplicate"]))
+    dup_rows = dup_rows[dup_rows > 0]
+    df.iloc[dup_rows] = df.iloc[dup_rows - 1].to_numpy()
+    return df
+
+
+def write_csv(path: str, rows: int, rates: dict, seed: int = 0) -> int:
+    """Write a synthetic CSV of the given size to path in CHUNK_ROWS pieces and return its size in bytes."""
+    rng = np.random.default_rng(seed)
+    with open(path, "w", newline="") as fh:
+        if rows == 0:
+            fh.write(",".join(EXPECTED_COLUMNS) + "\n")
+        for start in range(0, rows, CHUNK_ROWS):
+            chunk = generate_chunk(rng, start, min(CHUNK_ROWS, rows - start), rates)
+            chunk.to_csv(fh, header=start == 0, index=False)
+        return fh.tell()
+
+
+def rate_options(fn):
+    """Attach the per-check error rate options shared by the benchmark commands."""
+    for name in ["duplicate", "email", "dob", "phone", "null"]:
+        fn = click.option(f"--{name}-rate", default=0.01, show_default=True,
+                          help=f"Fraction of rows with a {name} error.")(fn)
+    return fn
+
+
+def rates_from(options: dict) -> dict:
+    return {name: options[f"{name}_rate"] for name in ["null", "phone", "dob", "email", "duplicate"]}
+
+
+@click.command()
+@click.option("--rows", default=100_000, show_default=True, help="Number of data rows to generate.")
+@click.option("--output", required=True, type=click.Path(dir_okay=False), help="CSV file to write.")
+@click.option("--seed", default=0, show_default=True, help="Random seed, for reproducible files.")
+@rate_options
+def main(rows, output, seed, **options):
+    """Generate a synthetic CSV matching EXPECTED_COLUMNS with configurable error rates."""
+    size = write_csv(output, rows, rates_from(options), seed)
+    click.echo(f"Wrote {rows} rows ({size} bytes) to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""Drive uploads through the API route, both workers and the CPU pool with in-memory stand-ins.
+
+Example:
+    python -m benchmarks.load_test --uploads 200 --rate 5 --rows 1000 --rows 20000 --output load.json
+"""
+import os
+
+# Queue names are read at import time by the modules under test
+os.environ.setdefault("QUEUE_FIRST", "file_queue")
+os.environ.setdefault("QUEUE_SECOND", "notification_queue")
+
+import asyncio
+import io
+import json
+import random
+import tempfile
+import time
+from datetime import datetime, timezone
+import click
+import httpx
+import numpy as np
+from fastapi import FastAPI
+from benchmarks.bench_validation import git_commit
+from benchmarks.generate_csv import generate_chunk, rate_options, rates_from
+from benchmarks.stand_ins import InMemoryBroker, InMemoryDatabase, InMemoryTeams, install
+from routes.file_routes import files
+from services.admission import AdmissionMiddleware
+from services import cpu_pool, file_processing, worker
+from services.scheduling import LANE_QUEUES, lane_for
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def make_payloads(row_counts: list, per_size: int, rates: dict, seed: int) -> list:
+    """Generate per_size distinct CSV payloads for each row count; sno ranges do not overlap."""
+    rng = np.random.default_rng(seed)
+    payloads, start = [], 0
+    for rows in row_counts:
+        for _ in range(per_size):
+            buffer = io.StringIO()
+            generate_chunk(rng, start, rows, rates).to_csv(buffer, index=False)
+            payloads.append((rows, buffer.getvalue().encode()))
+            start += rows
+    return payloads
+
+
+def summarize(values: list) -> dict:
+    """Latency percentiles in seconds."""
+    if not values:
+        return {}
+    summary = {f"p{p}": round(float(np.percentile(values, p)), 4) for p in PERCENTILES}
+    summary.update(mean=round(float(np.mean(values)), 4), max=round(float(np.max(values)), 4))
+    return summary
+
+
+class Saturation:
+    """Track in-flight file handlers and CPU pool tasks."""
+
+    def __init__(self):
+        self.handlers = 0
+        self.cpu_tasks = 0
+
+    def wrap_handler(self, handler):
+        async def wrapped(message):
+            self.handlers += 1
+            try:
+                return await handler(message)
+            finally:
+                self.handlers -= 1
+        return wrapped
+
+    def wrap_run_cpu(self, run_cpu):
+        def wrapped(fn, *args):
+            future = run_cpu(fn, *args)
+            self.cpu_tasks += 1
+            future.add_done_callback(self._cpu_done)
+            return future
+        return wrapped
+
+    def _cpu_done(self, _):
+        self.cpu_tasks -= 1
+
+
+async def sample(broker: InMemoryBroker, saturation: Saturation, interval: float, samples: list, started: float):
+    """Append queue depth and saturation readings every interval seconds."""
+    workers = max(cpu_pool.PROCESS_POOL_WORKERS, 1)
+    while True:
+        samples.append({
+            "t": round(time.perf_counter() - started, 3),
+            "file_queue_depth": broker.depth(LANE_QUEUES["small"]),
+            "large_file_queue_depth": broker.depth(LANE_QUEUES["large"]),
+            "notification_queue_depth": broker.depth(worker.NOTIFICATION_QUEUE),
+            "handlers_in_flight": saturation.handlers,
+            "cpu_tasks_in_flight": saturation.cpu_tasks,
+            "cpu_busy": round(min(saturation.cpu_tasks, workers) / workers, 3),
+        })
+        await asyncio.sleep(interval)
+
+
+async def run_load(uploads: int, rate: float, payloads: list, concurrency: int, sample_interval: float,
+                   db_latency: float, teams_latency: float, timeout: float, seed: int) -> dict:
+    broker, db, teams = InMemoryBroker(), InMemoryDatabase(db_latency), InMemoryTeams(teams_latency)
+    saturation = Saturation()
+    random.seed(seed)
+
+    with tempfile.TemporaryDirectory(prefix="fileflow-load-") as blob_root:
+        install(broker, db, teams, blob_root)
+        worker.handle_file_message = saturation.wrap_handler(worker.handle_file_message)
+        file_processing.run_cpu = saturation.wrap_run_cpu(cpu_pool.run_cpu)
+        cpu_pool.get_process_pool()
+
+        app = FastAPI()
+        app.add_middleware(AdmissionMiddleware)
+        app.include_router(files)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://load-test", timeout=None)
+        limit = asyncio.Semaphore(concurrency)
+        started_at, upload_seconds, rows_by_file, lane_by_file, upload_errors = {}, [], {}, {}, []
+
+        async def upload(index: int):
+            rows, payload = random.choice(payloads)
+            file_id = f"load-{index}"
+            async with limit:
+                started_at[file_id] = time.perf_counter()
+                response = await client.post("/files/upload", data={
+                    "file_id": file_id, "userid": f"user-{index % 10}", "username": "load", "role": "tester",
+                }, files={"file": (f"{file_id}.csv", payload, "text/csv")})
+                upload_seconds.append(time.perf_counter() - started_at[file_id])
+            if response.status_code == 200:
+                rows_by_file[file_id] = rows
+                lane_by_file[file_id] = lane_for(len(payload))
+            else:
+                upload_errors.append(response.status_code)
+
+        samples = []
+        started = time.perf_counter()
+        tasks = [
+            asyncio.create_task(worker.file_worker()),
+            asyncio.create_task(worker.shard_worker()),
+            asyncio.create_task(worker.notification_worker()),
+            asyncio.create_task(sample(broker, saturation, sample_interval, samples, started)),
+        ]
+        try:
+            # Open loop: uploads start on schedule whether or not earlier ones have finished
+            requests = []
+            for index in range(uploads):
+                delay = started + index / rate - time.perf_counter() if rate > 0 else 0
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                requests.append(asyncio.create_task(upload(index)))
+            await asyncio.gather(*requests)
+
+            teams.expected = len(rows_by_file)
+            if len(teams.sent) < teams.expected:
+                try:
+                    await asyncio.wait_for(teams.delivered.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            elapsed = time.perf_counter() - started
+        finally:
+            for task in tasks:
+                task.cancel()
+            broker.close()
+            await client.aclose()
+            cpu_pool.shutdown_process_pool()
+
+    end_to_end = [sent_at - started_at[file_id] for file_id, (_, sent_at) in teams.sent.items() if file_id in started_at]
+    end_to_end_by_lane = {}
+    for file_id, (_, sent_at) in teams.sent.items():
+        if file_id in lane_by_file:
+            end_to_end_by_lane.setdefault(lane_by_file[file_id], []).append(sent_at - started_at[file_id])
+    statuses = {}
+    for status, _ in teams.sent.values():
+        statuses[status] = statuses.get(status, 0) + 1
+    completed_rows = sum(rows_by_file.get(file_id, 0) for file_id in teams.sent)
+    return {
+        "elapsed_seconds": round(elapsed, 3),
+        "uploads": {"attempted": uploads, "accepted": len(rows_by_file), "rejected": upload_errors.count(429), "errors": len(upload_errors) - upload_errors.count(429)},
+        "completed_files": len(teams.sent),
+        "timed_out_files": len(rows_by_file) - len(teams.sent),
+        "statuses": statuses,
+        "throughput": {
+            "files_per_sec": round(len(teams.sent) / elapsed, 3),
+            "rows_per_sec": round(completed_rows / elapsed, 1),
+        },
+        "upload_latency_seconds": summarize(upload_seconds),
+        "end_to_end_latency_seconds": summarize(end_to_end),
+        "end_to_end_latency_seconds_by_lane": {lane: summarize(values) for lane, values in end_to_end_by_lane.items()},
+        "queue_depth": {
+            "file_queue_max": max((s["file_queue_depth"] for s in samples), default=0),
+            "large_file_queue_max": max((s["large_file_queue_depth"] for s in samples), default=0),
+            "notification_queue_max": max((s["notification_queue_depth"] for s in samples), default=0),
+        },
+        "saturation": {
+            "cpu_workers": max(cpu_pool.PROCESS_POOL_WORKERS, 1),
+            "cpu_busy_mean": round(float(np.mean([s["cpu_busy"] for s in samples])), 3) if samples else 0,
+            "handlers_in_flight_max": max((s["handlers_in_flight"] for s in samples), default=0),
+        },
+        "db_statements": db.statements,
+        "teams_messages": teams.messages,
+        "samples": samples,
+    }
+
+
+@click.command()
+@click.option("--uploads", default=100, show_default=True, help="Total number of uploads.")
+@click.option("--rate", default=5.0, show_default=True, help="Uploads started per second; 0 starts them all at once.")
+@click.option("--rows", "row_counts", multiple=True, type=int, default=[1_000, 10_000], show_default=True,
+              help="Rows per uploaded file; repeat for a mix of sizes.")
+@click.option("--distinct", default=5, show_default=True, help="Distinct payloads generated per size; uploads reuse them.")
+@click.option("--concurrency", default=50, show_default=True, help="Maximum uploads in flight at once.")
+@click.option("--db-latency-ms", default=2.0, show_default=True, help="Simulated latency per database statement.")
+@click.option("--teams-latency-ms", default=100.0, show_default=True, help="Simulated latency per Teams message.")
+@click.option("--sample-interval", default=0.5, show_default=True, help="Seconds between queue depth samples.")
+@click.option("--timeout", default=300.0, show_default=True, help="Seconds to wait for notifications after the last upload.")
+@click.option("--seed", default=0, show_default=True)
+@click.option("--output", type=click.Path(dir_okay=False), help="Write the JSON report here instead of stdout.")
+@rate_options
+def main(uploads, rate, row_counts, distinct, concurrency, db_latency_ms, teams_latency_ms, sample_interval,
+         timeout, seed, output, **options):
+    """Load-test the upload, processing and notification flow without RabbitMQ, Postgres or Teams."""
+    rates = rates_from(options)
+    payloads = make_payloads(row_counts, distinct, rates, seed)
+    result = asyncio.run(run_load(
+        uploads, rate, payloads, concurrency, sample_interval,
+        db_latency_ms / 1000, teams_latency_ms / 1000, timeout, seed,
+    ))
+    e2e = result["end_to_end_latency_seconds"]
+    click.echo(
+        f"{result['completed_files']}/{uploads} files in {result['elapsed_seconds']}s, "
+        f"end-to-end p50 {e2e.get('p50')}s p99 {e2e.get('p99')}s, "
+        f"max file queue depth {result['queue_depth']['file_queue_max']}",
+        err=True,
+    )
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "uploads": uploads, "rate": rate, "rows": list(row_counts), "distinct": distinct,
+            "concurrency": concurrency, "db_latency_ms": db_latency_ms, "teams_latency_ms": teams_latency_ms,
+            "error_rates": rates, "seed": seed,
+        },
+        **result,
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as fh:
+            fh.write(text + "\n")
+    else:
+        click.echo(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""In-memory stand-ins for RabbitMQ, the database layer and the Teams sender.
+
+They mirror the parts of aio_pika, services.db_services and services.teams_services that
+the upload route and the workers use, so the real request and worker code can run under
+load without external services. install() swaps them in.
+"""
+import asyncio
+import json
+import time
+from collections import deque
+from contextlib import asynccontextmanager, nullcontext
+from datetime import datetime
+from itertools import islice
+from typing import Iterable
+from services import blob_store, db_services, rabbit_service, teams_services
+from services.compression import compress_body
+from services.db_services import DB_BATCH_SIZE, seen_row_hashes
+from services.teams_services import format_file_message, TEAMS_SENT
+from services.tracing import span, trace_headers
+
+
+class InMemoryMessage:
+    """A delivered message with the aio_pika IncomingMessage surface the workers use."""
+
+    def __init__(self, body: bytes, content_encoding: str = None, headers: dict = None):
+        self.body = body
+        self.content_encoding = content_encoding
+        self.headers = headers or {}
+        self.published_at = time.perf_counter()
+        self.processed = False
+        # Set by the channel that delivered it, see InMemoryChannel
+        self.on_settle = None
+
+    @asynccontextmanager
+    async def process(self, requeue: bool = False, ignore_processed: bool = False):
+        try:
+            yield
+        except Exception:
+            self._settle(requeue)
+            raise
+        self._settle(False)
+
+    async def ack(self):
+        self._settle(False)
+
+    async def nack(self, requeue: bool = True):
+        self._settle(requeue)
+
+    async def reject(self, requeue: bool = False):
+        self._settle(requeue)
+
+    def _settle(self, requeue: bool):
+        if self.processed:
+            return
+        self.processed = True
+        if self.on_settle is not None:
+            self.on_settle(self, requeue)
+
+
+class InMemoryQueue:
+    """A named queue of messages ready for delivery."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.messages = asyncio.Queue()
+
+    def __len__(self) -> int:
+        return self.messages.qsize()
+
+
+class InMemoryChannel:
+    """A channel that, like RabbitMQ, delivers at most prefetch_count unsettled messages at a time.
+
+    Messages wait in their queue, and count towards its depth, until a slot frees up.
+    prefetch_count 0 is unlimited. Requeued messages go back to the end of their queue.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.prefetch_count = 0
+        self.unsettled = 0
+        self._slot_freed = asyncio.Event()
+
+    async def set_qos(self, prefetch_count: int = 0):
+        self.prefetch_count = prefetch_count
+
+    async def declare_queue(self, name: str, durable: bool = True, passive: bool = False):
+        return InMemoryConsumer(self, self.broker.queue(name))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def deliver(self, queue: InMemoryQueue):
+        """Yield queue's messages as prefetch slots free up."""
+        while True:
+            while self.prefetch_count and self.unsettled >= self.prefetch_count:
+                self._slot_freed.clear()
+                await self._slot_freed.wait()
+            self.unsettled += 1
+            message = await queue.messages.get()
+            message.processed = False
+            message.on_settle = lambda message, requeue: self._settled(queue, message, requeue)
+            yield message
+
+    def _settled(self, queue: InMemoryQueue, message: InMemoryMessage, requeue: bool):
+        self.unsettled -= 1
+        self._slot_freed.set()
+        if requeue:
+            queue.messages.put_nowait(message)
+
+
+class InMemoryConsumer:
+    """A queue declared on a channel, consumed under that channel's prefetch."""
+
+    def __init__(self, channel: InMemoryChannel, queue: InMemoryQueue):
+        self.channel = channel
+        self.queue = queue
+
+    async def consume(self, callback):
+        async def deliver():
+            async for message in self.channel.deliver(self.queue):
+                asyncio.create_task(callback(message))
+        self.channel.broker.consumers.append(asyncio.create_task(deliver()))
+
+    @asynccontextmanager
+    async def iterator(self):
+        yield self.channel.deliver(self.queue)
+
+
+class InMemoryBroker:
+    """Stands in for the RabbitMQ connection and the rabbit_service functions."""
+
+    def __init__(self):
+        self.queues = {}
+        self.events = {}
+        self.consumers = []
+
+    def queue(self, name: str) -> InMemoryQueue:
+        if name not in self.queues:
+            self.queues[name] = InMemoryQueue(name)
+        return self.queues[name]
+
+    def depth(self, name: str) -> int:
+        return len(self.queue(name))
+
+    async def get_connection(self):
+        return self
+
+    async def channel(self):
+        return InMemoryChannel(self)
+
+    async def publish_to_queue(self, message: dict, queue_name: str):
+        # Encode like publish_to_queue so consumers pay the same decode cost as with RabbitMQ
+        body, content_encoding = compress_body(json.dumps(message).encode())
+        with span(f"publish:{queue_name}"):
+            await self.queue(queue_name).messages.put(InMemoryMessage(body, content_encoding, trace_headers()))
+
+    async def publish_to_exchange(self, message: dict, exchange_name: str):
+        # No API process subscribes in the load test; keep the events for inspection
+        self.events.setdefault(exchange_name, []).append(message)
+
+    async def queue_depth(self, queue_name: str) -> int:
+        return self.depth(queue_name)
+
+    def close(self):
+        for task in self.consumers:
+            task.cancel()
+
+
+class InMemoryDatabase:
+    """Stands in for the db_services functions on the upload and processing path.
+
+    Each statement awaits latency seconds, and batches follow DB_BATCH_SIZE, so the
+    number of round trips matches the Postgres implementation.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.files = {}
+        self.row_hashes = set()
+        self.failure_counts = {}
+        self.checkpoints = {}
+        self.shards = {}
+        self.trace_spans = {}
+        self.statements = 0
+
+    async def _round_trip(self):
+        self.statements += 1
+        await asyncio.sleep(self.latency)
+
+    def transaction(self):
+        return nullcontext()
+
+    async def insert_file(self, file_id: str, filename: str, userid: str, username: str, role: str, blob_ref: str = None):
+        await self._round_trip()
+        self.files[file_id] = {
+            "file_id": file_id, "filename": filename, "userid": userid, "username": username,
+            "role": role, "blob_ref": blob_ref, "uploaded_at": datetime.utcnow(), "processed": False, "status": None,
+        }
+
+    async def get_file(self, file_id: str):
+        await self._round_trip()
+        return self.files.get(file_id)
+
+    async def update_file_status(self, file_id: str, status: str, deduplicated_rows: int = 0, passed_rows: int = 0, failed_rows: int = 0):
+        await self._round_trip()
+        if file_id in self.files:
+            self.files[file_id].update(
+                processed=True, status=status, deduplicated_rows=deduplicated_rows,
+                passed_rows=passed_rows, failed_rows=failed_rows,
+            )
+
+    async def get_checkpoint(self, file_id: str, for_update: bool = False):
+        await self._round_trip()
+        return self.checkpoints.get(file_id)
+
+    async def save_checkpoint(self, file_id: str, blob_ref: str, byte_offset: int, row_offset: int, segment_no: int, state: dict):
+        await self._round_trip()
+        self.checkpoints[file_id] = {
+            "blob_ref": blob_ref, "byte_offset": byte_offset, "row_offset": row_offset, "segment_no": segment_no,
+            "state": json.dumps(state), "completed_at": None, "notified_at": None,
+        }
+
+    async def complete_checkpoint(self, file_id: str, state: dict):
+        await self._round_trip()
+        self.checkpoints[file_id].update(state=json.dumps(state), completed_at=datetime.utcnow())
+
+    async def claim_notification(self, file_id: str) -> bool:
+        await self._round_trip()
+        checkpoint = self.checkpoints.get(file_id)
+        if checkpoint is None or checkpoint["completed_at"] is None or checkpoint["notified_at"] is not None:
+            return False
+        checkpoint["notified_at"] = datetime.utcnow()
+        return True
+
+    async def release_notification(self, file_id: str):
+        await self._round_trip()
+        if file_id in self.checkpoints:
+            self.checkpoints[file_id]["notified_at"] = None
+
+    async def insert_shards(self, file_id: str, shards: list):
+        await self._round_trip()
+        self.shards[file_id] = [
+            {"shard_no": shard_no, "start_offset": start, "end_offset": end, "byte_offset": None, "rows": None,
+             "segment_no": None, "state": None, "completed_at": None}
+            for shard_no, (start, end) in enumerate(shards)
+        ]
+
+    async def get_shard(self, file_id: str, shard_no: int, for_update: bool = False):
+        await self._round_trip()
+        shards = self.shards.get(file_id, [])
+        return shards[shard_no] if shard_no < len(shards) else None
+
+    async def save_shard_progress(self, file_id: str, shard_no: int, byte_offset: int, rows: int, segment_no: int, state: dict):
+        await self._round_trip()
+        self.shards[file_id][shard_no].update(byte_offset=byte_offset, rows=rows, segment_no=segment_no, state=json.dumps(state))
+
+    async def complete_shard(self, file_id: str, shard_no: int, rows: int, state: dict):
+        await self._round_trip()
+        self.shards[file_id][shard_no].update(rows=rows, state=json.dumps(state), completed_at=datetime.utcnow())
+
+    async def fetch_shards(self, file_id: str):
+        await self._round_trip()
+        return self.shards.get(file_id, [])
+
+    async def shift_failure_segments(self, file_id: str, first_segment: int, end_segment: int, rows: int):
+        # Segments are only counted here, so there are no row numbers to move
+        await self._round_trip()
+
+    async def insert_trace_spans(self, file_id: str, trace_id: str, service: str, spans: list):
+        spans = iter(spans)
+        while batch := list(islice(spans, DB_BATCH_SIZE)):
+            await self._round_trip()
+            self.trace_spans.setdefault(file_id, []).extend((trace_id, service, *entry) for entry in batch)
+
+    async def delete_failure_segments(self, file_id: str):
+        await self._round_trip()
+        self.failure_counts.pop(file_id, None)
+
+    async def insert_failure_segments(self, file_id: str, segments: Iterable[dict]) -> int:
+        segments = iter(segments)
+        failures = 0
+        while batch := list(islice(segments, DB_BATCH_SIZE)):
+            await self._round_trip()
+            failures += sum(segment["failure_count"] for segment in batch)
+        self.failure_counts[file_id] = self.failure_counts.get(file_id, 0) + failures
+        return failures
+
+    async def insert_successes(self, file_id: str, rows: Iterable[tuple]) -> dict:
+        rows = iter(rows)
+        inserted, deduplicated = 0, 0
+        new_hashes = deque()
+        while batch := list(islice(rows, DB_BATCH_SIZE)):
+            unique = {row_hash: row_json for row_hash, row_json in batch if row_hash not in seen_row_hashes}
+            deduplicated += len(batch) - len(unique)
+            if not unique:
+                continue
+            await self._round_trip()
+            for row_hash in unique:
+                if row_hash in self.row_hashes:
+                    deduplicated += 1
+                else:
+                    self.row_hashes.add(row_hash)
+                    new_hashes.append(row_hash)
+                    inserted += 1
+        return {"inserted": inserted, "deduplicated": deduplicated, "row_hashes": new_hashes}
+
+
+class InMemoryTeams:
+    """Stands in for send_teams_message, recording when each file's notification went out."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sent = {}
+        self.messages = 0
+        self.delivered = asyncio.Event()
+        self.expected = None
+
+    async def send_teams_message(self, file_id: str, status: str, errors: dict = None, error_counts: dict = None) -> str:
+        format_file_message(file_id, status, errors, error_counts)
+        await asyncio.sleep(self.latency)
+        self.messages += 1
+        self.sent.setdefault(file_id, (status, time.perf_counter()))
+        if self.expected is not None and len(self.sent) >= self.expected:
+            self.delivered.set()
+        return TEAMS_SENT
+
+
+def install(broker: InMemoryBroker, db: InMemoryDatabase, teams: InMemoryTeams, blob_root: str):
+    """Put the stand-ins behind the rabbit_service, db_services and teams_services backends, and a LocalBlobStore under blob_root."""
+    rabbit_service.backend.use(broker)
+    db_services.backend.use(db)
+    teams_services.backend.use(teams)
+    blob_store._blob_store = blob_store.LocalBlobStore(blob_root)
@@ -1,9 +1,16 @@
 from fastapi import FastAPI
-from services.db_services import test_database,database
-from services.rabbit_service import test_rabbitmq
-from services.teams_services import send_teams_message
+from fastapi.responses import JSONResponse, PlainTextResponse
+from services.metrics import render_metrics, METRICS_CONTENT_TYPE
+from services.db_services import database
+from services.rabbit_service import connect_rabbitmq, close_rabbitmq
+from services.health import get_health, run_health_refresher
+from services.stats import run_stats_invalidation
+from services.admission import AdmissionMiddleware
+from services.migrations import migrate, MIGRATE_ON_STARTUP
+from services.teams_services import send_teams_text, close_client
 from routes.file_routes import files
 from contextlib import asynccontextmanager
+import asyncio
 import logging
 
 # Basic configuration
@@ -21,25 +28,51 @@ async def lifespan(app: FastAPI):
     logger.info("Connecting to DB...")
     await database.connect()
     logger.info("DB connected")
+    if MIGRATE_ON_STARTUP:
+        await migrate()
+    await connect_rabbitmq()
+    logger.info("RabbitMQ connected")
+    health_task = asyncio.create_task(run_health_refresher())
+    stats_task = asyncio.create_task(run_stats_invalidation())
     yield
+    health_task.cancel()
+    stats_task.cancel()
+    await close_rabbitmq()
+    logger.info("RabbitMQ disconnected!")
+    await close_client()
     await database.disconnect()
     logger.info("DB disconnected!")
 
 app = FastAPI(title="FileFlow API",lifespan=lifespan)
+# Checks the backlog and global upload limits before an upload body is read
+app.add_middleware(AdmissionMiddleware)
+
+@app.get("/health/live")
+async def liveness():
+    """Report that the process is up and its event loop is responsive."""
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+async def readiness():
+    """Report cached dependency health with per-dependency latency; 503 if any dependency is down."""
+    health = await get_health()
+    return JSONResponse(health, status_code=200 if health["status"] == "ok" else 503)
 
 @app.get("/healthcheck")
 async def health_check():
-    db_status = test_database()
-    rabbit_status = await test_rabbitmq()
-    return {
-        "database": db_status,
-        "rabbitmq": rabbit_status
-    }
+    """Per-dependency status from the cached readiness checks."""
+    health = await get_health()
+    return {name: result["status"] for name, result in health["dependencies"].items()}
+
+@app.get("/metrics")
+async def metrics():
+    """Expose API counters and latency histograms in the Prometheus text format."""
+    return PlainTextResponse(render_metrics(), media_type=METRICS_CONTENT_TYPE)
 
 @app.get("/test-teams")
-def test_teams(message: str = "Hello from FastAPI!"):
+async def test_teams(message: str = "Hello from FastAPI!"):
     """Send a test message to Teams"""
-    result = send_teams_message(message)
+    result = await send_teams_text(message)
     return {"teams": result}
 
 app.include_router(files, tags=["Files"])
@@ -1,47 +1,120 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException,Form,Query
-from services.db_services import insert_file,fetch_files,get_file,get_processed,fetch_file_counts
+from fastapi import APIRouter, UploadFile, File, HTTPException,Form,Query,Response,Request
+from fastapi.responses import StreamingResponse
+from services.db_services import insert_file,fetch_files,iterate_files,get_file,get_processed,fetch_file_counts,fetch_failure_segments,fetch_trace_spans
 from services.rabbit_service import publish_to_queue
+from services.blob_store import get_blob_store, iter_upload, UPLOAD_CHUNK_SIZE
 from services.stats import get_filename_date_stats
-from services.utlities import compute_file_stats
-import os
-from datetime import date
+from services.db_services import stats_cache
+from services.metrics import UPLOAD_BYTES, UPLOAD_SECONDS
+from services.scheduling import LANE_QUEUES, lane_for
+from services.admission import admit_user_upload, request_size, Rejected
+from services.tracing import traced, span
+from services.utlities import compute_file_stats, encode_cursor, decode_cursor
+from services.failures import decode_row_numbers, merge_samples
+from services.file_processing import read_rows, RESULT_ERROR_SAMPLE_SIZE
+from services.export import find_export, iter_export_bytes, EXPORT_MEDIA_TYPES
+import json
+import time
+import asyncio
+from typing import Literal
+from datetime import date, timedelta
 from services.db_services import get_file_stats_by_date
 from dotenv import load_dotenv
 import traceback
+from urllib.parse import quote
 files = APIRouter(prefix="/files")
 
-QUEUE_FIRST=os.getenv("QUEUE_FIRST")
+PAGE_SIZE_DEFAULT = 100
+PAGE_SIZE_MAX = 1000
+
+def parse_cursor(cursor: str, kind: type = str):
+    """Decode a pagination cursor query parameter, rejecting malformed ones and values not of kind with 400."""
+    if cursor is None:
+        return None
+    try:
+        after = decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # bool is an int subclass but never a valid position
+    if not isinstance(after, kind) or isinstance(after, bool):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return after
+
+def page_cursor(rows: list, limit: int):
+    """Return the cursor for the page after rows, or None if this was the last page."""
+    if len(rows) < limit:
+        return None
+    return encode_cursor(rows[-1]["file_id"])
+
+def stream_ndjson(rows):
+    """Stream rows from an async iterator as newline-delimited JSON."""
+    async def body():
+        async for row in rows:
+            yield json.dumps(dict(row), default=str) + "\n"
+    return StreamingResponse(body(), media_type="application/x-ndjson")
 
 @files.post("/upload")
-async def upload_file( file_id: str = Form(...), userid: str = Form(...),username: str = Form(...),role: str = Form(...),file: UploadFile = File(...)):
-    """Upload a file, save it in DB, and push it to the processing queue."""
+async def upload_file(request: Request, file_id: str = Form(...), userid: str = Form(...),username: str = Form(...),role: str = Form(...),file: UploadFile = File(...)):
+    """Upload a file, stream it to the blob store, save it in DB, and push a reference to the processing queue.
+
+    .csv.gz and .csv.zst uploads are stored compressed; the worker decompresses them as it reads.
+    Files are queued on the small or large lane by size; userid and role travel with the
+    message for the workers' fair scheduling. Uploads over a per-user limit get 429 with Retry-After.
+    """
+    started = time.perf_counter()
     try:
-        file_bytes = await file.read()
-        await insert_file(
-            file_id=file_id,
-            filename=file.filename,
-            userid=userid,
-            username=username,
-            role=role
-        )
-        message = {
-            "file_id": file_id,
-            "filename": file.filename,
-            "file_content": file_bytes.decode("utf-8"),
-        }
-        await publish_to_queue(message, QUEUE_FIRST)
+        with admit_user_upload(userid, request_size(request.headers)):
+            async with traced(file_id, "api", "upload"):
+                with span("blob_write"):
+                    blob = await get_blob_store().put_stream(iter_upload(file))
+                UPLOAD_BYTES.observe(blob["size"])
+                with span("insert_file"):
+                    await insert_file(
+                        file_id=file_id,
+                        filename=file.filename,
+                        userid=userid,
+                        username=username,
+                        role=role,
+                        blob_ref=blob["blob_ref"]
+                    )
+                lane = lane_for(blob["size"])
+                message = {
+                    "file_id": file_id,
+                    "filename": file.filename,
+                    "blob_ref": blob["blob_ref"],
+                    "size": blob["size"],
+                    "checksum": blob["checksum"],
+                    "userid": userid,
+                    "role": role,
+                    "lane": lane,
+                    "enqueued_at": time.time(),
+                }
+                await publish_to_queue(message, LANE_QUEUES[lane])
+        # Other API processes catch up within STATS_CACHE_TTL_SECONDS
+        stats_cache.invalidate("totals")
+        UPLOAD_SECONDS.observe(time.perf_counter() - started, outcome="queued")
         return {"status": "queued", "file_id": file_id, "filename": file.filename}
+    except Rejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers=e.headers())
     except Exception as e:
+        UPLOAD_SECONDS.observe(time.perf_counter() - started, outcome="error")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @files.get("/")
-async def get_files():
-    """Fetch all files from the database."""
+async def get_files(
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
+    cursor: str = Query(None, description="next_cursor from the previous page"),
+    format: Literal["json", "ndjson"] = Query("json", description="ndjson streams every file after the cursor")
+):
+    """Fetch files ordered by file_id, one page at a time or as an NDJSON stream."""
+    after = parse_cursor(cursor)
+    if format == "ndjson":
+        return stream_ndjson(iterate_files(after))
     try:
-        rows = await fetch_files()
-        return {"files": rows}
+        rows = await fetch_files(limit, after)
+        return {"files": [dict(row) for row in rows], "next_cursor": page_cursor(rows, limit)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
@@ -55,15 +128,134 @@ async def fetch_file(file_id: str):
         "file_id": result.file_id,
         "filename": result.filename,
         "processed": result.processed,
-        
+        "deduplicated_rows": result.deduplicated_rows,
+    }
+
+@files.get("/{file_id}/failures")
+async def fetch_failures(file_id: str):
+    """Failure counts per error type for a file, each with a bounded sample of failing rows."""
+    segments = await fetch_failure_segments(file_id)
+    by_type = {}
+    for segment in segments:
+        by_type.setdefault(segment["error_type"], []).append(segment)
+    return {
+        "file_id": file_id,
+        "failures": [
+            {
+                "error_type": error_type,
+                "failure_count": sum(segment["failure_count"] for segment in type_segments),
+                "sample": merge_samples(type_segments, RESULT_ERROR_SAMPLE_SIZE),
+            }
+            for error_type, type_segments in by_type.items()
+        ],
+    }
+
+@files.get("/{file_id}/failures/{error_type}/rows")
+async def fetch_failure_rows(
+    file_id: str,
+    error_type: str,
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
+    cursor: str = Query(None, description="next_cursor from the previous page")
+):
+    """Full row detail for one error type of a file, read back from the stored upload, one page at a time."""
+    after = parse_cursor(cursor, int)
+    file = await get_file(file_id)
+    if not file:
+        raise HTTPException(status_code=404, detail="File not found")
+    if not file["blob_ref"]:
+        raise HTTPException(status_code=404, detail="File content is not available")
+
+    page = []
+    for segment in await fetch_failure_segments(file_id, error_type):
+        rows = decode_row_numbers(segment["row_numbers"], segment["row_base"])
+        if after is not None:
+            rows = rows[rows > after]
+        page.extend(int(row) for row in rows[:limit + 1 - len(page)])
+        if len(page) > limit:
+            break
+    next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+    page = page[:limit]
+    row_data = await asyncio.to_thread(read_rows, file["blob_ref"], page)
+    return {
+        "file_id": file_id,
+        "error_type": error_type,
+        "rows": [{"row": row, "data": row_data.get(row)} for row in page],
+        "next_cursor": next_cursor,
+    }
+
+@files.get("/{file_id}/timeline")
+async def fetch_timeline(file_id: str):
+    """Spans the API, workers and notifier recorded for a file, in start order, timed from the first.
+
+    Spans named stage:<name> total that stage over all blocks of the file and start with processing.
+    """
+    spans = await fetch_trace_spans(file_id)
+    if not spans:
+        raise HTTPException(status_code=404, detail="No timeline recorded for this file")
+    started_at = spans[0]["started_at"]
+    finished_at = max(s["started_at"] + timedelta(seconds=s["duration_seconds"]) for s in spans)
+    return {
+        "file_id": file_id,
+        "started_at": started_at,
+        "duration_seconds": round((finished_at - started_at).total_seconds(), 6),
+        "spans": [
+            {
+                "trace_id": s["trace_id"],
+                "service": s["service"],
+                "name": s["name"],
+                "offset_seconds": round((s["started_at"] - started_at).total_seconds(), 6),
+                "duration_seconds": round(s["duration_seconds"], 6),
+                "attributes": json.loads(s["attributes"]) if s["attributes"] else {},
+            }
+            for s in spans
+        ],
     }
 
+@files.get("/{file_id}/export")
+async def export_file(
+    file_id: str,
+    format: Literal["parquet", "arrow", "csv", "ndjson"] = Query(None, description="Defaults to the format the export was written in")
+):
+    """Stream a processed file's passed rows from its columnar export, converting to CSV or NDJSON batch by batch."""
+    export = await asyncio.to_thread(find_export, file_id)
+    if export is None:
+        raise HTTPException(status_code=404, detail="Export not available")
+    path, export_format = export
+    output_format = format or export_format
+    if output_format in ("parquet", "arrow") and output_format != export_format:
+        raise HTTPException(status_code=400, detail=f"Export is stored as {export_format}; request {export_format}, csv or ndjson")
+
+    chunks = iter_export_bytes(path, export_format, output_format, UPLOAD_CHUNK_SIZE)
+    async def body():
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            yield chunk
+    return StreamingResponse(
+        body(),
+        media_type=EXPORT_MEDIA_TYPES[output_format],
+        headers={"Content-Disposition": f'attachment; filename="{quote(file_id, safe="")}.{output_format}"'},
+    )
+
 @files.get("/processed/{status}")
-async def fetch_processed(status: bool):
-    """Fetch files filtered by their processed status (success or failure)."""
-    results = await get_processed(status)
-    if not results:
+async def fetch_processed(
+    status: bool,
+    response: Response,
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
+    cursor: str = Query(None, description="X-Next-Cursor header from the previous page"),
+    format: Literal["json", "ndjson"] = Query("json", description="ndjson streams every matching file after the cursor")
+):
+    """Fetch files filtered by their processed status (success or failure), one page at a time.
+
+    The cursor for the next page is returned in the X-Next-Cursor header.
+    """
+    after = parse_cursor(cursor)
+    if format == "ndjson":
+        return stream_ndjson(iterate_files(after, status))
+    results = await get_processed(status, limit, after)
+    if not results and cursor is None:
         raise HTTPException(status_code=404, detail="File not found")
+    next_cursor = page_cursor(results, limit)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return [dict(row) for row in results]
 
 @files.get("/files/stats")
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from fastapi.responses import JSONResponse
+from services.cache import LRUCache
+from services.metrics import UPLOADS_REJECTED_TOTAL
+from services.rabbit_service import queue_depth
+from services.scheduling import LANE_QUEUES
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Limits are per API process; 0 disables a limit
+# Uploads are refused while this many files wait on the lanes
+UPLOAD_MAX_QUEUE_DEPTH = int(os.getenv("UPLOAD_MAX_QUEUE_DEPTH", "10000"))
+UPLOAD_QUEUE_DEPTH_TTL_SECONDS = float(os.getenv("UPLOAD_QUEUE_DEPTH_TTL_SECONDS", "2"))
+# Request bytes being received and stored at once, in total and per userid
+UPLOAD_MAX_IN_FLIGHT_BYTES = int(os.getenv("UPLOAD_MAX_IN_FLIGHT_BYTES", str(4 * 1024 ** 3)))
+UPLOAD_USER_MAX_IN_FLIGHT_BYTES = int(os.getenv("UPLOAD_USER_MAX_IN_FLIGHT_BYTES", str(1024 ** 3)))
+# Sustained upload rates, each with a burst allowance of the same size
+UPLOAD_RATE_PER_SECOND = float(os.getenv("UPLOAD_RATE_PER_SECOND", "0"))
+UPLOAD_USER_RATE_PER_MINUTE = float(os.getenv("UPLOAD_USER_RATE_PER_MINUTE", "0"))
+UPLOAD_RETRY_AFTER_SECONDS = int(os.getenv("UPLOAD_RETRY_AFTER_SECONDS", "5"))
+UPLOAD_BACKLOG_RETRY_AFTER_SECONDS = int(os.getenv("UPLOAD_BACKLOG_RETRY_AFTER_SECONDS", "30"))
+UPLOAD_PATH = "/files/upload"
+# Users whose rate buckets are remembered; an evicted user starts with a full bucket
+TRACKED_USERS = 10000
+
+
+class Rejected(Exception):
+    """An upload refused by admission control; the client may retry after retry_after seconds."""
+
+    def __init__(self, reason: str, message: str, retry_after: float):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = max(int(math.ceil(retry_after)), 1)
+
+    def headers(self) -> dict:
+        return {"Retry-After": str(self.retry_after)}
+
+
+class TokenBucket:
+    """Allow rate events per second on average with bursts of up to burst events."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token and return 0, or return the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+_in_flight_bytes = 0
+_user_in_flight_bytes = {}
+_upload_bucket = TokenBucket(UPLOAD_RATE_PER_SECOND, UPLOAD_RATE_PER_SECOND) if UPLOAD_RATE_PER_SECOND > 0 else None
+_user_buckets = LRUCache(TRACKED_USERS)
+_depth = 0
+_depth_checked_at = float("-inf")
+_depth_lock = asyncio.Lock()
+
+def _reject(reason: str, message: str, retry_after: float):
+    UPLOADS_REJECTED_TOTAL.inc(reason=reason)
+    raise Rejected(reason, message, retry_after)
+
+async def backlog_depth() -> int:
+    """Messages ready on the file lanes, re-read from the broker at most every UPLOAD_QUEUE_DEPTH_TTL_SECONDS."""
+    global _depth, _depth_checked_at
+    if time.monotonic() - _depth_checked_at > UPLOAD_QUEUE_DEPTH_TTL_SECONDS:
+        async with _depth_lock:
+            if time.monotonic() - _depth_checked_at > UPLOAD_QUEUE_DEPTH_TTL_SECONDS:
+                try:
+                    _depth = sum([await queue_depth(queue_name) for queue_name in LANE_QUEUES.values()])
+                except Exception:
+                    # Admit on an unknown depth; the enqueue fails on its own if the broker is down
+                    logger.exception("Could not read queue depth for admission control")
+                _depth_checked_at = time.monotonic()
+    return _depth
+
+@contextmanager
+def admit_upload(size: int):
+    """Hold size request bytes of an upload against the process-wide limits.
+
+    Raises Rejected if the upload rate or in-flight byte limit is exceeded. Call
+    check_backlog first.
+    """
+    global _in_flight_bytes
+    if _upload_bucket is not None:
+        wait = _upload_bucket.take()
+        if wait:
+            _reject("rate", "Too many uploads, slow down", wait)
+    if UPLOAD_MAX_IN_FLIGHT_BYTES and _in_flight_bytes and _in_flight_bytes + size > UPLOAD_MAX_IN_FLIGHT_BYTES:
+        _reject("bytes", "Too many upload bytes in flight", UPLOAD_RETRY_AFTER_SECONDS)
+    _in_flight_bytes += size
+    try:
+        yield
+    finally:
+        _in_flight_bytes -= size
+
+async def check_backlog():
+    """Raise Rejected while the workers are more than UPLOAD_MAX_QUEUE_DEPTH files behind."""
+    if UPLOAD_MAX_QUEUE_DEPTH and await backlog_depth() >= UPLOAD_MAX_QUEUE_DEPTH:
+        _reject("backlog", "Processing backlog is full, retry later", UPLOAD_BACKLOG_RETRY_AFTER_SECONDS)
+
+@contextmanager
+def admit_user_upload(userid: str, size: int):
+    """Hold size request bytes against userid's rate and in-flight byte limits, raising Rejected if exceeded.
+
+    A user's first upload is always let through the byte limit, so files larger than
+    the limit are not refused forever.
+    """
+    if UPLOAD_USER_RATE_PER_MINUTE > 0:
+        bucket = _user_buckets.get(userid)
+        if bucket is None:
+            bucket = TokenBucket(UPLOAD_USER_RATE_PER_MINUTE / 60, UPLOAD_USER_RATE_PER_MINUTE)
+            _user_buckets.set(userid, bucket)
+        wait = bucket.take()
+        if wait:
+            _reject("user_rate", "Too many uploads for this user, slow down", wait)
+    in_flight = _user_in_flight_bytes.get(userid, 0)
+    if UPLOAD_USER_MAX_IN_FLIGHT_BYTES and in_flight and in_flight + size > UPLOAD_USER_MAX_IN_FLIGHT_BYTES:
+        _reject("user_bytes", "Too many upload bytes in flight for this user", UPLOAD_RETRY_AFTER_SECONDS)
+    _user_in_flight_bytes[userid] = in_flight + size
+    try:
+        yield
+    finally:
+        _user_in_flight_bytes[userid] -= size
+        if not _user_in_flight_bytes[userid]:
+            del _user_in_flight_bytes[userid]
+
+def request_size(headers) -> int:
+    """The Content-Length of a request from its headers, or 0 if it is missing or invalid."""
+    try:
+        return max(int(headers.get("content-length", 0)), 0)
+    except ValueError:
+        return 0
+
+def rejection_response(rejected: Rejected) -> JSONResponse:
+    return JSONResponse({"detail": str(rejected)}, status_code=429, headers=rejected.headers())
+
+
+class AdmissionMiddleware:
+    """Refuse uploads with 429 before their body is read when the backlog, rate or in-flight bytes are over limit.
+
+    Per-user limits need the userid form field and are applied by the upload route.
+    """
+
+    def __init__(self, app, path: str = UPLOAD_PATH):
+        self.app = app
+        self.path = path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] != self.path:
+            return await self.app(scope, receive, send)
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        try:
+            await check_backlog()
+            admission = admit_upload(request_size(headers))
+            admission.__enter__()
+        except Rejected as e:
+            return await rejection_response(e)(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission.__exit__(None, None, None)
@@ -0,0 +1,27 @@
+import functools
+
+
+class Backend:
+    """Lets a stand-in object take over a module's routed functions, for the load test.
+
+    While a stand-in is in use, every routed function calls the stand-in's method of the
+    same name instead. Routing happens inside the functions, so modules that imported them
+    by name follow too. A stand-in missing a method raises AttributeError rather than
+    reaching the real service.
+    """
+
+    def __init__(self):
+        self.stand_in = None
+
+    def use(self, stand_in):
+        """Route calls to stand_in; None routes them back to the real implementation."""
+        self.stand_in = stand_in
+
+    def routed(self, func):
+        """Decorate a coroutine function so use() can take it over."""
+        @functools.wraps(func)
+        async def call(*args, **kwargs):
+            if self.stand_in is not None:
+                return await getattr(self.stand_in, func.__name__)(*args, **kwargs)
+            return await func(*args, **kwargs)
+        return call
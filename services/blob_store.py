@@ -0,0 +1,184 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import AsyncIterator, BinaryIO
+import click
+from dotenv import load_dotenv
+from services.compression import open_decoded, detect_encoding
+from services.db_services import database, fetch_expired_blob_refs, clear_blob_refs
+
+load_dotenv()
+
+BLOB_STORE_BACKEND = os.getenv("BLOB_STORE_BACKEND", "local")
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR", "/data/blobs")
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+
+
+class BlobStore(ABC):
+    """Storage for uploaded files, referenced from queue messages instead of embedding them."""
+
+    @abstractmethod
+    async def put_stream(self, chunks: AsyncIterator[bytes]) -> dict:
+        """Store a stream of byte chunks and return {"blob_ref", "size", "checksum"}."""
+
+    @abstractmethod
+    def open(self, blob_ref: str) -> BinaryIO:
+        """Open a stored blob for binary reading."""
+
+    @abstractmethod
+    def size(self, blob_ref: str) -> int:
+        """Return the size in bytes of a stored blob."""
+
+    @abstractmethod
+    def delete(self, blob_ref: str, written_before: datetime = None) -> bool:
+        """Remove a stored blob, ignoring blobs that do not exist.
+
+        With written_before (UTC), a blob written at or after it, e.g. by a new upload of
+        the same content, is kept and False returned.
+        """
+
+    async def put_bytes(self, data: bytes) -> dict:
+        """Store an in-memory payload."""
+        async def single():
+            yield data
+        return await self.put_stream(single())
+
+
+class LocalBlobStore(BlobStore):
+    """Content-addressed blob store on local disk, keyed by the SHA-256 of the content."""
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+
+    def _path(self, blob_ref: str) -> str:
+        if len(blob_ref) != 64 or not all(c in "0123456789abcdef" for c in blob_ref):
+            raise ValueError(f"Invalid blob reference: {blob_ref}")
+        return os.path.join(self.root, blob_ref[:2], blob_ref[2:4], blob_ref)
+
+    async def put_stream(self, chunks: AsyncIterator[bytes]) -> dict:
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, "tmp"))
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                async for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    await asyncio.to_thread(fh.write, chunk)
+            blob_ref = digest.hexdigest()
+            path = self._path(blob_ref)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Identical content maps to the same path, so replacing is harmless
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return {"blob_ref": blob_ref, "size": size, "checksum": f"sha256:{blob_ref}"}
+
+    def open(self, blob_ref: str) -> BinaryIO:
+        return open(self._path(blob_ref), "rb")
+
+    def size(self, blob_ref: str) -> int:
+        return os.path.getsize(self._path(blob_ref))
+
+    def delete(self, blob_ref: str, written_before: datetime = None) -> bool:
+        path = self._path(blob_ref)
+        # Moved aside before checking, so an upload landing at path meanwhile is never removed
+        tombstone = os.path.join(self.root, "tmp", f"{blob_ref}.deleted")
+        try:
+            os.replace(path, tombstone)
+        except FileNotFoundError:
+            return True
+        if written_before is not None and datetime.utcfromtimestamp(os.path.getmtime(tombstone)) >= written_before:
+            if os.path.exists(path):
+                os.remove(tombstone)
+            else:
+                os.replace(tombstone, path)
+            return False
+        os.remove(tombstone)
+        return True
+
+
+BLOB_STORE_BACKENDS = {
+    "local": lambda: LocalBlobStore(BLOB_STORE_DIR),
+}
+
+_blob_store = None
+
+def get_blob_store() -> BlobStore:
+    """Return the process-wide blob store selected by BLOB_STORE_BACKEND."""
+    global _blob_store
+    if _blob_store is None:
+        if BLOB_STORE_BACKEND not in BLOB_STORE_BACKENDS:
+            raise ValueError(f"Unknown BLOB_STORE_BACKEND: {BLOB_STORE_BACKEND}")
+        _blob_store = BLOB_STORE_BACKENDS[BLOB_STORE_BACKEND]()
+    return _blob_store
+
+def open_csv(blob_ref: str) -> BinaryIO:
+    """Open a stored upload as uncompressed CSV bytes, decompressing .csv.gz and .csv.zst uploads on the fly."""
+    return open_decoded(get_blob_store().open(blob_ref))
+
+async def store_decoded(blob_ref: str) -> str:
+    """Return the ref of an uncompressed copy of a stored upload, storing the copy if the upload was compressed."""
+    store = get_blob_store()
+    with store.open(blob_ref) as fh:
+        if detect_encoding(fh.read(4)) is None:
+            return blob_ref
+    with open_csv(blob_ref) as fh:
+        async def chunks():
+            while chunk := await asyncio.to_thread(fh.read, UPLOAD_CHUNK_SIZE):
+                yield chunk
+        blob = await store.put_stream(chunks())
+    return blob["blob_ref"]
+
+async def iter_upload(file, chunk_size: int = UPLOAD_CHUNK_SIZE):
+    """Yield an UploadFile's content in chunks without reading it all into memory."""
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+async def prune_blobs(before: datetime) -> int:
+    """Delete the blobs only files processed before a time refer to; returns how many were deleted.
+
+    Their files keep their rows and failure segments but lose blob_ref, so failing row
+    detail is no longer available. Blobs written since, e.g. by a new upload with the
+    same content, are kept.
+    """
+    store = get_blob_store()
+    deleted = 0
+    for blob_ref in await fetch_expired_blob_refs(before):
+        if not store.delete(blob_ref, written_before=before):
+            continue
+        await clear_blob_refs([blob_ref], before)
+        deleted += 1
+    return deleted
+
+async def _prune(before: datetime) -> int:
+    await database.connect()
+    try:
+        return await prune_blobs(before)
+    finally:
+        await database.disconnect()
+
+@click.group()
+def cli():
+    """Maintain the blob store."""
+    logging.basicConfig(level=logging.INFO)
+
+@cli.command()
+@click.option("--before", required=True, type=click.DateTime(formats=["%Y-%m-%d"]), help="Delete uploads of files processed before this date.")
+def prune(before):
+    """Delete stored uploads that only files processed before a date refer to; run it from cron."""
+    deleted = asyncio.run(_prune(before))
+    click.echo(f"Deleted {deleted} blob(s)")
+
+if __name__ == "__main__":
+    cli()
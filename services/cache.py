@@ -0,0 +1,134 @@
+import asyncio
+import functools
+import time
+from collections import OrderedDict
+from services.metrics import CACHE_REQUESTS_TOTAL
+
+
+class LRUCache:
+    """A bounded mapping that evicts the least recently used key once maxsize is reached."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        if key in self._data:
+            self._data.move_to_end(key)
+            return True
+        return False
+
+    def get(self, key, default=None):
+        """Return the cached value for key and mark it as recently used."""
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def set(self, key, value=True):
+        """Store value under key, evicting the oldest entries if the cache is full."""
+        if self.maxsize <= 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def update(self, keys):
+        """Mark every key in keys as present."""
+        for key in keys:
+            self.set(key)
+
+    def clear(self):
+        self._data.clear()
+
+
+class TTLCache:
+    """A bounded LRU mapping whose entries expire ttl seconds after they are stored.
+
+    Entries carry tags so related keys can be dropped together. Every invalidation bumps
+    generation, which lets a reader tell whether its value was computed before it.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return the live value for key and mark it as recently used."""
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        value, expires_at, _ = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, tags=()):
+        """Store value under key with its tags, evicting the least recently used entries if full."""
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        self._data[key] = (value, time.monotonic() + self.ttl, frozenset(tags))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, *tags):
+        """Drop every entry carrying any of the tags."""
+        self.generation += 1
+        for key in [key for key, (_, _, entry_tags) in self._data.items() if entry_tags.intersection(tags)]:
+            del self._data[key]
+
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
+
+
+_MISSING = object()
+
+def cached(cache: TTLCache, tags=None):
+    """Serve an async function's results from cache, keyed by its name and arguments.
+
+    tags(*args, **kwargs) names the tags stored with each result. Concurrent misses for
+    one key share a single call, and a result computed across an invalidation is
+    returned but not stored.
+    """
+    def decorator(fn):
+        in_flight = {}
+
+        async def fill(key, args, kwargs):
+            generation = cache.generation
+            value = await fn(*args, **kwargs)
+            if cache.generation == generation:
+                cache.set(key, value, tags(*args, **kwargs) if tags else ())
+            return value
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            key = (fn.__qualname__, args, tuple(sorted(kwargs.items())))
+            value = cache.get(key, _MISSING)
+            if value is not _MISSING:
+                CACHE_REQUESTS_TOTAL.inc(function=fn.__name__, result="hit")
+                return value
+            task = in_flight.get(key)
+            if task is None:
+                CACHE_REQUESTS_TOTAL.inc(function=fn.__name__, result="miss")
+                task = asyncio.ensure_future(fill(key, args, kwargs))
+                in_flight[key] = task
+                task.add_done_callback(lambda _: in_flight.pop(key, None))
+            else:
+                CACHE_REQUESTS_TOTAL.inc(function=fn.__name__, result="shared")
+            # One caller going away must not cancel the call the others are waiting on
+            return await asyncio.shield(task)
+        return wrapper
+    return decorator
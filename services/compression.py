@@ -0,0 +1,113 @@
+import gzip
+import io
+import os
+from typing import BinaryIO
+import zstandard
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Encoding applied to queue message bodies larger than QUEUE_COMPRESS_MIN_BYTES: zstd, gzip or identity
+QUEUE_MESSAGE_ENCODING = os.getenv("QUEUE_MESSAGE_ENCODING", "zstd")
+QUEUE_COMPRESS_MIN_BYTES = int(os.getenv("QUEUE_COMPRESS_MIN_BYTES", "1024"))
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Uploads are stored as sent and recognised by their leading bytes
+FILE_MAGIC = {
+    b"\x1f\x8b": "gzip",
+    b"\x28\xb5\x2f\xfd": "zstd",
+}
+
+def detect_encoding(head: bytes):
+    """Return "gzip" or "zstd" if head starts a compressed stream, else None."""
+    for magic, encoding in FILE_MAGIC.items():
+        if head.startswith(magic):
+            return encoding
+    return None
+
+class ForwardReader:
+    """Binary reader over a decompression stream with readline, tell and forward-only seek.
+
+    Closing it also closes source, the underlying compressed file, when given.
+    """
+
+    def __init__(self, raw, source: BinaryIO = None):
+        self.raw = raw
+        self.source = source
+        self.buffer = b""
+        self.position = 0
+
+    def _fill(self, size: int) -> bool:
+        chunk = self.raw.read(max(size, READ_CHUNK_SIZE))
+        self.buffer += chunk
+        return bool(chunk)
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            data, self.buffer = self.buffer + self.raw.read(), b""
+        else:
+            while len(self.buffer) < size and self._fill(size - len(self.buffer)):
+                pass
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.position += len(data)
+        return data
+
+    def readline(self) -> bytes:
+        while b"\n" not in self.buffer and self._fill(READ_CHUNK_SIZE):
+            pass
+        end = self.buffer.find(b"\n")
+        return self.read(len(self.buffer) if end < 0 else end + 1)
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence != io.SEEK_SET or offset < self.position:
+            raise io.UnsupportedOperation("only forward seeks are supported")
+        while self.position < offset and self.read(min(offset - self.position, READ_CHUNK_SIZE)):
+            pass
+        return self.position
+
+    def close(self):
+        self.raw.close()
+        if self.source is not None:
+            self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_decoded(fh: BinaryIO) -> BinaryIO:
+    """Wrap a stored file so reads return the uncompressed CSV, whatever it was uploaded as.
+
+    Decompression is streamed; seeking forward re-reads the compressed data up to the target.
+    """
+    encoding = detect_encoding(fh.read(4))
+    fh.seek(0)
+    if encoding == "gzip":
+        return ForwardReader(gzip.GzipFile(fileobj=fh, mode="rb"), fh)
+    if encoding == "zstd":
+        return ForwardReader(zstandard.ZstdDecompressor().stream_reader(fh, closefd=True))
+    return fh
+
+def compress_body(body: bytes):
+    """Compress a queue message body; returns (body, content_encoding or None)."""
+    if QUEUE_MESSAGE_ENCODING == "identity" or len(body) < QUEUE_COMPRESS_MIN_BYTES:
+        return body, None
+    if QUEUE_MESSAGE_ENCODING == "zstd":
+        return zstandard.ZstdCompressor().compress(body), "zstd"
+    if QUEUE_MESSAGE_ENCODING == "gzip":
+        return gzip.compress(body), "gzip"
+    raise ValueError(f"Unknown QUEUE_MESSAGE_ENCODING: {QUEUE_MESSAGE_ENCODING}")
+
+def decompress_body(body: bytes, content_encoding: str = None) -> bytes:
+    """Undo compress_body according to the message's content_encoding header."""
+    if not content_encoding or content_encoding == "identity":
+        return body
+    if content_encoding == "zstd":
+        return zstandard.ZstdDecompressor().decompress(body)
+    if content_encoding == "gzip":
+        return gzip.decompress(body)
+    raise ValueError(f"Unsupported message content_encoding: {content_encoding}")
@@ -0,0 +1,37 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+PROCESS_POOL_WORKERS = int(os.getenv("PROCESS_POOL_WORKERS", str(os.cpu_count() or 1)))
+
+_pool = None
+
+def get_process_pool():
+    """Return the shared process pool for CPU-bound work, or None when it is disabled."""
+    global _pool
+    if PROCESS_POOL_WORKERS <= 0:
+        return None
+    if _pool is None:
+        # spawn keeps children free of the parent's event loop, sockets and threads
+        _pool = ProcessPoolExecutor(
+            max_workers=PROCESS_POOL_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
+
+def max_in_flight() -> int:
+    """Number of CPU tasks to keep queued so every pool worker stays busy."""
+    return max(PROCESS_POOL_WORKERS, 1) * 2
+
+def run_cpu(fn, *args) -> asyncio.Future:
+    """Schedule fn(*args) on the process pool, or a thread when the pool is disabled."""
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(get_process_pool(), fn, *args)
+
+def shutdown_process_pool():
+    """Stop the pool's worker processes."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
@@ -0,0 +1,79 @@
+from typing import BinaryIO, Iterator
+
+QUOTE = b'"'
+NEWLINE = b"\n"
+
+def read_header(fh: BinaryIO) -> bytes:
+    """Read the header record, including any quoted line breaks inside it."""
+    header = b""
+    while True:
+        line = fh.readline()
+        header += line
+        if not line or header.count(QUOTE) % 2 == 0:
+            return header
+
+def _last_record_end(buf: bytes):
+    """Return the offset just past the last newline that is not inside a quoted field.
+
+    buf must start at a record boundary. Escaped quotes are doubled in CSV, so an even
+    number of quotes before a newline means the newline ends a record.
+    """
+    end = buf.rfind(NEWLINE)
+    if end < 0:
+        return None
+    quotes = buf.count(QUOTE, 0, end)
+    while end >= 0:
+        if quotes % 2 == 0:
+            return end + 1
+        previous = buf.rfind(NEWLINE, 0, end)
+        if previous < 0:
+            return None
+        quotes -= buf.count(QUOTE, previous, end)
+        end = previous
+    return None
+
+def iter_row_blocks(fh: BinaryIO, block_size: int) -> Iterator[bytes]:
+    """Yield roughly block_size byte blocks of a CSV body, each ending on a record boundary."""
+    carry = b""
+    while True:
+        data = fh.read(block_size)
+        if not data:
+            if carry:
+                yield carry
+            return
+        buf = carry + data
+        cut = _last_record_end(buf)
+        if cut is None:
+            carry = buf
+            continue
+        carry = buf[cut:]
+        yield buf[:cut]
+
+def plan_shards(fh: BinaryIO, shard_size: int, block_size: int) -> list:
+    """Split a CSV body into (start, end) byte ranges of at least shard_size bytes, cut on record boundaries.
+
+    fh must be positioned just after the header; offsets are absolute file positions.
+    """
+    shards = []
+    start = end = fh.tell()
+    for block in iter_row_blocks(fh, block_size):
+        end += len(block)
+        if end - start >= shard_size:
+            shards.append((start, end))
+            start = end
+    if end > start:
+        shards.append((start, end))
+    return shards
+
+class BoundedReader:
+    """File-like view of fh that stops reading at byte offset end."""
+
+    def __init__(self, fh: BinaryIO, end: int):
+        self.fh = fh
+        self.end = end
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = self.end - self.fh.tell()
+        if remaining <= 0:
+            return b""
+        return self.fh.read(remaining if size < 0 else min(size, remaining))
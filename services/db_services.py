@@ -1,9 +1,13 @@
 import os
 from databases import Database
 from dotenv import load_dotenv
-import psycopg2
 import json
+from collections import deque
+from itertools import islice
+from typing import Iterable
+from services.cache import LRUCache, TTLCache, cached
 from services.utlities import get_row_hash
+from services.backends import Backend
 from datetime import datetime, date
 load_dotenv()
 
@@ -12,158 +16,487 @@ POSTGRES_PORT = os.getenv("POSTGRES_PORT")
 POSTGRES_DB = os.getenv("POSTGRES_DB")
 POSTGRES_USER = os.getenv("POSTGRES_USER")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "500"))
+ROW_HASH_CACHE_SIZE = int(os.getenv("ROW_HASH_CACHE_SIZE", "100000"))
+STATS_CACHE_SIZE = int(os.getenv("STATS_CACHE_SIZE", "1024"))
+STATS_CACHE_TTL_SECONDS = float(os.getenv("STATS_CACHE_TTL_SECONDS", "10"))
 
 DATABASE_URL = f"postgresql://{os.getenv('POSTGRES_USER')}:{os.getenv('POSTGRES_PASSWORD')}@{os.getenv('POSTGRES_HOST')}:{os.getenv('POSTGRES_PORT')}/{os.getenv('POSTGRES_DB')}"
-database = Database(DATABASE_URL)
-
-def test_database():
-    """Test database connectivity by connecting and fetching version."""
-    try:
-        conn = psycopg2.connect(
-            host=POSTGRES_HOST,
-            port=POSTGRES_PORT,
-            database=POSTGRES_DB,
-            user=POSTGRES_USER,
-            password=POSTGRES_PASSWORD
-        )
-        cursor = conn.cursor()
-        cursor.execute("SELECT version();")
-        version = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        return f"Database connected, version: {version[0]}"
-    except Exception as e:
-        return f"Database test failed: {e}"
-
-async def insert_file(file_id: str, filename: str, userid: str, username: str, role: str):
-    """Insert a new file record into the 'files' table."""
-    query = """INSERT INTO files (file_id, filename, userid, username, role) VALUES (:file_id, :filename, :userid, :username, :role)
+
+# The load test's in-memory stand-in takes over the functions below through this
+backend = Backend()
+
+class RoutedDatabase(Database):
+    """A Database whose transactions are the stand-in's while backend has one in use."""
+
+    def transaction(self, **kwargs):
+        if backend.stand_in is not None:
+            return backend.stand_in.transaction()
+        return super().transaction(**kwargs)
+
+database = RoutedDatabase(DATABASE_URL)
+
+# Hashes known to be committed in file_success; lets overlapping re-uploads skip the DB
+seen_row_hashes = LRUCache(ROW_HASH_CACHE_SIZE)
+# Stats query results, dropped by tag when a worker reports a finished file (see services.stats)
+stats_cache = TTLCache(STATS_CACHE_SIZE, STATS_CACHE_TTL_SECONDS)
+
+@backend.routed
+async def insert_file(file_id: str, filename: str, userid: str, username: str, role: str, blob_ref: str = None):
+    """Insert a new file record into the 'files' table and count it in the daily rollup."""
+    query = """INSERT INTO files (file_id, filename, userid, username, role, uploaded_at, blob_ref) VALUES (:file_id, :filename, :userid, :username, :role, :uploaded_at, :blob_ref)
     """
+    uploaded_at = datetime.utcnow()
     values = {
         "file_id": file_id,
         "filename": filename,
         "userid": userid,
         "username": username,
-        "role": role
+        "role": role,
+        "uploaded_at": uploaded_at,
+        "blob_ref": blob_ref
     }
-    await database.execute(query=query, values=values)
+    async with database.transaction():
+        await database.execute(query=query, values=values)
+        await add_daily_file_counts(uploaded_at.date(), uploaded=1)
+
+
+FILE_LIST_COLUMNS = "file_id, filename, userid, username, role, processed, processed_at"
 
+def _file_list_query(processed: bool = None, after: str = None, limit: int = None):
+    """Build a keyset-paginated listing of files ordered by file_id."""
+    conditions, values = [], {}
+    if processed is not None:
+        conditions.append("processed = :processed")
+        values["processed"] = processed
+    if after is not None:
+        conditions.append("file_id > :after")
+        values["after"] = after
+    query = f"SELECT {FILE_LIST_COLUMNS} FROM files"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY file_id"
+    if limit is not None:
+        query += " LIMIT :limit"
+        values["limit"] = limit
+    return query, values
 
-async def fetch_files():
-    """Fetch all files ordered by file_id """
-    query = """ SELECT *FROM files ORDER BY File_id """
-    return await database.fetch_all(query=query)
+@backend.routed
+async def fetch_files(limit: int = None, after: str = None, processed: bool = None):
+    """Fetch a page of files ordered by file_id, starting after the given file_id."""
+    query, values = _file_list_query(processed, after, limit)
+    return await database.fetch_all(query=query, values=values)
 
+async def iterate_files(after: str = None, processed: bool = None):
+    """Yield files ordered by file_id from a server-side cursor, without loading them all."""
+    query, values = _file_list_query(processed, after)
+    async for row in database.iterate(query=query, values=values):
+        yield row
+
+@backend.routed
 async def get_file(file_id: str):
     """Fetch a single file by its file_id."""
     query = "SELECT * FROM files WHERE file_id = :file_id"
     result = await database.fetch_one(query=query, values={"file_id": file_id})
     return result
 
-async def get_processed(processed: bool):
-    """Fetch files filtered by their processed status (True/False)."""
-    query = "SELECT * FROM files WHERE processed = :processed"
-    results = await database.fetch_all(query=query, values={"processed": processed})
-    return results
+@backend.routed
+async def get_processed(processed: bool, limit: int = None, after: str = None):
+    """Fetch a page of files filtered by their processed status (True/False)."""
+    return await fetch_files(limit, after, processed)
+
+@backend.routed
+async def update_file_status(file_id: str, status: str, deduplicated_rows: int = 0, passed_rows: int = 0, failed_rows: int = 0):
+    """Update a file's processed status and counters, and move it between the rollup buckets.
 
-async def update_file_status(file_id: str, status: str):
-    """Update a file's processed status and processed_at timestamp."""
+    passed_rows are the rows this run inserted and are added to the file's total, since
+    rows stored by earlier runs stay. failed_rows replaces the total, as a fresh run
+    replaces the file's failure segments (see delete_failure_segments). Call it in the
+    same transaction as the row inserts so the rollups stay exact.
+    """
     processed = True if status == "success" else False
-    query = """UPDATE files SET processed = :processed,processed_at = :processed_at WHERE file_id = :file_id"""
-    values = { "processed": processed,"processed_at": datetime.utcnow(),"file_id": file_id } 
+    processed_at = datetime.utcnow()
+    query = """
+        WITH old AS (
+            SELECT filename, processed, processed_at, passed_rows, failed_rows
+            FROM files WHERE file_id = :file_id FOR UPDATE
+        )
+        UPDATE files SET processed = :processed, processed_at = :processed_at, deduplicated_rows = :deduplicated_rows,
+            passed_rows = old.passed_rows + :passed_rows, failed_rows = :failed_rows
+        FROM old WHERE files.file_id = :file_id
+        RETURNING files.filename, old.processed AS old_processed, old.processed_at AS old_processed_at,
+            old.passed_rows AS old_passed_rows, old.failed_rows AS old_failed_rows,
+            files.passed_rows, files.failed_rows
+    """
+    values = { "processed": processed,"processed_at": processed_at,"deduplicated_rows": deduplicated_rows,
+               "passed_rows": passed_rows,"failed_rows": failed_rows,"file_id": file_id } 
+    row = await database.fetch_one(query=query, values=values)
+    if row is None:
+        return
+
+    # A reprocessed file leaves the bucket it was counted in before
+    if row["old_processed_at"] is not None:
+        old_day = row["old_processed_at"].date()
+        await add_daily_file_counts(old_day, passed=-int(bool(row["old_processed"])), failed=-int(not row["old_processed"]))
+        await add_filename_row_counts(row["filename"], old_day, -row["old_passed_rows"], -row["old_failed_rows"])
+    await add_daily_file_counts(processed_at.date(), passed=int(processed), failed=int(not processed))
+    await add_filename_row_counts(row["filename"], processed_at.date(), row["passed_rows"], row["failed_rows"])
+
+@backend.routed
+async def fetch_expired_blob_refs(before: datetime) -> list:
+    """Blob refs, including decoded copies kept in checkpoints, that only files processed before a time refer to."""
+    query = """
+        SELECT blob_ref FROM (
+            SELECT blob_ref, processed_at FROM files WHERE blob_ref IS NOT NULL
+            UNION ALL
+            SELECT c.blob_ref, f.processed_at FROM file_checkpoints c JOIN files f USING (file_id)
+        ) refs
+        GROUP BY blob_ref
+        HAVING bool_and(processed_at IS NOT NULL AND processed_at < :before)
+    """
+    return [row["blob_ref"] for row in await database.fetch_all(query=query, values={"before": before})]
+
+@backend.routed
+async def clear_blob_refs(blob_refs: list, before: datetime):
+    """Forget deleted blobs on the files processed before a time that referred to them.
+
+    Files uploaded since with the same content keep the ref to their new copy.
+    """
+    query = "UPDATE files SET blob_ref = NULL WHERE blob_ref = ANY(:blob_refs) AND processed_at < :before"
+    await database.execute(query=query, values={"blob_refs": blob_refs, "before": before})
+
+@backend.routed
+async def get_checkpoint(file_id: str, for_update: bool = False):
+    """Fetch a file's processing checkpoint, or None if processing never started.
+
+    With for_update the row stays locked until the surrounding transaction ends.
+    """
+    query = """
+        SELECT blob_ref, byte_offset, row_offset, segment_no, state, completed_at, notified_at
+        FROM file_checkpoints WHERE file_id = :file_id
+    """
+    if for_update:
+        query += " FOR UPDATE"
+    return await database.fetch_one(query=query, values={"file_id": file_id})
+
+@backend.routed
+async def save_checkpoint(file_id: str, blob_ref: str, byte_offset: int, row_offset: int, segment_no: int, state: dict):
+    """Record how far processing of a file's blob got. Call it in the transaction that commits the rows it covers.
+
+    Saving a checkpoint for a different blob starts the file over, including its notification.
+    """
+    query = """
+        INSERT INTO file_checkpoints (file_id, blob_ref, byte_offset, row_offset, segment_no, state, updated_at)
+        VALUES (:file_id, :blob_ref, :byte_offset, :row_offset, :segment_no, :state, :updated_at)
+        ON CONFLICT (file_id) DO UPDATE SET
+            blob_ref = EXCLUDED.blob_ref, byte_offset = EXCLUDED.byte_offset, row_offset = EXCLUDED.row_offset,
+            segment_no = EXCLUDED.segment_no, state = EXCLUDED.state, updated_at = EXCLUDED.updated_at,
+            completed_at = NULL, notified_at = NULL
+    """
+    values = {"file_id": file_id, "blob_ref": blob_ref, "byte_offset": byte_offset, "row_offset": row_offset,
+              "segment_no": segment_no, "state": json.dumps(state), "updated_at": datetime.utcnow()}
     await database.execute(query=query, values=values)
 
-async def insert_failure(file_id: str, error_type: str, error_detail: str):
-    """Insert a failure record into 'file_failure' table for a file row."""
-    query = """ INSERT INTO file_failure (file_id, error_type, errors, processed_at) VALUES (:file_id, :error_type, :errors, :processed_at)"""
-    values = {
-        "file_id": file_id,
-        "error_type": error_type,
-        "errors": json.dumps(error_detail),
-        "processed_at": datetime.utcnow()
-    }
+@backend.routed
+async def complete_checkpoint(file_id: str, state: dict):
+    """Mark a file's processing finished, storing its final state and result."""
+    query = """
+        UPDATE file_checkpoints SET state = :state, completed_at = :completed_at, updated_at = :completed_at
+        WHERE file_id = :file_id
+    """
+    await database.execute(query=query, values={"file_id": file_id, "state": json.dumps(state), "completed_at": datetime.utcnow()})
+
+@backend.routed
+async def claim_notification(file_id: str) -> bool:
+    """Claim the right to send a processed file's notification; True only for the first caller."""
+    query = """
+        UPDATE file_checkpoints SET notified_at = :notified_at
+        WHERE file_id = :file_id AND completed_at IS NOT NULL AND notified_at IS NULL
+        RETURNING file_id
+    """
+    return await database.fetch_one(query=query, values={"file_id": file_id, "notified_at": datetime.utcnow()}) is not None
+
+@backend.routed
+async def release_notification(file_id: str):
+    """Give up a claim from claim_notification so a redelivered message can send it."""
+    await database.execute(query="UPDATE file_checkpoints SET notified_at = NULL WHERE file_id = :file_id", values={"file_id": file_id})
+
+@backend.routed
+async def insert_shards(file_id: str, shards: list):
+    """Replace a file's shard plan with (start, end) byte ranges, numbered from 0."""
+    await database.execute(query="DELETE FROM file_shards WHERE file_id = :file_id", values={"file_id": file_id})
+    columns = ["file_id", "shard_no", "start_offset", "end_offset"]
+    for start in range(0, len(shards), DB_BATCH_SIZE):
+        batch = shards[start:start + DB_BATCH_SIZE]
+        values = {"file_id": file_id}
+        for i, (start_offset, end_offset) in enumerate(batch):
+            values[f"shard_no_{i}"] = start + i
+            values[f"start_offset_{i}"] = start_offset
+            values[f"end_offset_{i}"] = end_offset
+        await database.execute(query=build_multi_insert("file_shards", columns, ["file_id"], len(batch)), values=values)
+
+@backend.routed
+async def get_shard(file_id: str, shard_no: int, for_update: bool = False):
+    """Fetch a shard with its progress, or None if the file has no such shard.
+
+    With for_update the row stays locked until the surrounding transaction ends.
+    """
+    query = """
+        SELECT start_offset, end_offset, byte_offset, rows, segment_no, state, completed_at FROM file_shards
+        WHERE file_id = :file_id AND shard_no = :shard_no
+    """
+    if for_update:
+        query += " FOR UPDATE"
+    return await database.fetch_one(query=query, values={"file_id": file_id, "shard_no": shard_no})
+
+@backend.routed
+async def save_shard_progress(file_id: str, shard_no: int, byte_offset: int, rows: int, segment_no: int, state: dict):
+    """Record how far a shard got. Call it in the transaction that commits the rows it covers."""
+    query = """
+        UPDATE file_shards SET byte_offset = :byte_offset, rows = :rows, segment_no = :segment_no, state = :state
+        WHERE file_id = :file_id AND shard_no = :shard_no
+    """
+    values = {"file_id": file_id, "shard_no": shard_no, "byte_offset": byte_offset, "rows": rows,
+              "segment_no": segment_no, "state": json.dumps(state)}
+    await database.execute(query=query, values=values)
+
+@backend.routed
+async def complete_shard(file_id: str, shard_no: int, rows: int, state: dict):
+    """Store a processed shard's row count and state."""
+    query = """
+        UPDATE file_shards SET rows = :rows, state = :state, completed_at = :completed_at
+        WHERE file_id = :file_id AND shard_no = :shard_no
+    """
+    values = {"file_id": file_id, "shard_no": shard_no, "rows": rows, "state": json.dumps(state), "completed_at": datetime.utcnow()}
+    await database.execute(query=query, values=values)
+
+@backend.routed
+async def fetch_shards(file_id: str):
+    """Fetch a file's shards in file order."""
+    query = """
+        SELECT shard_no, start_offset, end_offset, rows, state, completed_at
+        FROM file_shards WHERE file_id = :file_id ORDER BY shard_no
+    """
+    return await database.fetch_all(query=query, values={"file_id": file_id})
+
+@backend.routed
+async def shift_failure_segments(file_id: str, first_segment: int, end_segment: int, rows: int):
+    """Move failure segments in [first_segment, end_segment) down by rows, including their sample row numbers."""
+    query = """
+        UPDATE file_failure_segments SET row_base = row_base + :rows,
+            sample = COALESCE((
+                SELECT jsonb_agg(
+                    CASE WHEN jsonb_typeof(entry) = 'object'
+                        THEN jsonb_set(entry, '{row}', to_jsonb((entry->>'row')::bigint + :rows))
+                        ELSE entry END
+                    ORDER BY position)
+                FROM jsonb_array_elements(sample) WITH ORDINALITY AS t(entry, position)
+            ), '[]'::jsonb)
+        WHERE file_id = :file_id AND segment_no >= :first_segment AND segment_no < :end_segment
+    """
+    values = {"file_id": file_id, "first_segment": first_segment, "end_segment": end_segment, "rows": rows}
+    await database.execute(query=query, values=values)
+
+@backend.routed
+async def add_daily_file_counts(day: date, uploaded: int = 0, passed: int = 0, failed: int = 0):
+    """Add to the per-day file counters in 'file_stats_daily'."""
+    query = """
+        INSERT INTO file_stats_daily (day, uploaded_files, passed_files, failed_files)
+        VALUES (:day, :uploaded, :passed, :failed)
+        ON CONFLICT (day) DO UPDATE SET
+            uploaded_files = file_stats_daily.uploaded_files + EXCLUDED.uploaded_files,
+            passed_files = file_stats_daily.passed_files + EXCLUDED.passed_files,
+            failed_files = file_stats_daily.failed_files + EXCLUDED.failed_files
+    """
+    values = {"day": day, "uploaded": uploaded, "passed": passed, "failed": failed}
+    await database.execute(query=query, values=values)
+
+@backend.routed
+async def add_filename_row_counts(filename: str, day: date, passed_rows: int, failed_rows: int):
+    """Add to the per-filename, per-day row counters in 'filename_stats_daily'."""
+    query = """
+        INSERT INTO filename_stats_daily (filename, day, passed_rows, failed_rows)
+        VALUES (:filename, :day, :passed_rows, :failed_rows)
+        ON CONFLICT (filename, day) DO UPDATE SET
+            passed_rows = filename_stats_daily.passed_rows + EXCLUDED.passed_rows,
+            failed_rows = filename_stats_daily.failed_rows + EXCLUDED.failed_rows
+    """
+    values = {"filename": filename, "day": day, "passed_rows": passed_rows, "failed_rows": failed_rows}
     await database.execute(query=query, values=values)
-async def row_exists(row_hash: str) -> bool:
-    """Check if a row with this hash already exists in 'file_success' to avoid duplicates."""
-    query_check = """
-        SELECT 1 FROM file_success WHERE row_hash = :row_hash
+
+def iter_batches(items: Iterable, batch_size: int = None):
+    """Yield lists of at most batch_size items from any iterable."""
+    batch_size = batch_size or DB_BATCH_SIZE
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def build_multi_insert(table: str, columns: list, shared: list, count: int) -> str:
+    """Build a multi-row INSERT with one VALUES tuple per row.
+
+    Columns listed in shared bind the same parameter in every tuple, the others are
+    bound as :<column>_<i> for row i.
+    """
+    tuples = []
+    for i in range(count):
+        params = [f":{col}" if col in shared else f":{col}_{i}" for col in columns]
+        tuples.append(f"({', '.join(params)})")
+    return f"INSERT INTO {table} ({', '.join(columns)}) VALUES {', '.join(tuples)}"
+
+@backend.routed
+async def insert_failure_segments(file_id: str, segments: Iterable[dict]) -> int:
+    """Insert failure segments into 'file_failure_segments' and return how many failures they hold.
+
+    A segment covers one error type in one block of rows: its failure count, the
+    compressed row numbers (see services.failures) and a bounded sample of the rows.
     """
-    existing = await database.fetch_one(
-        query=query_check, values={"row_hash": row_hash}
-    )
-    return bool(existing)
+    columns = ["file_id", "error_type", "segment_no", "row_base", "failure_count", "row_numbers", "sample", "processed_at"]
+    processed_at = datetime.utcnow()
+    failures = 0
+    for batch in iter_batches(segments):
+        values = {"file_id": file_id, "processed_at": processed_at}
+        for i, segment in enumerate(batch):
+            for col in columns[1:-1]:
+                values[f"{col}_{i}"] = segment[col]
+            values[f"sample_{i}"] = json.dumps(segment["sample"])
+            failures += segment["failure_count"]
+        query = build_multi_insert("file_failure_segments", columns, ["file_id", "processed_at"], len(batch))
+        # A reprocessed file replaces the segments of its previous run
+        query += """ ON CONFLICT (file_id, error_type, segment_no) DO UPDATE SET
+            row_base = EXCLUDED.row_base, failure_count = EXCLUDED.failure_count, row_numbers = EXCLUDED.row_numbers,
+            sample = EXCLUDED.sample, processed_at = EXCLUDED.processed_at"""
+        await database.execute(query=query, values=values)
+    return failures
 
+@backend.routed
+async def insert_trace_spans(file_id: str, trace_id: str, service: str, spans: list):
+    """Insert (name, started_at epoch seconds, duration seconds, attributes) spans into 'file_trace_spans'."""
+    columns = ["file_id", "trace_id", "service", "name", "started_at", "duration_seconds", "attributes"]
+    for batch in iter_batches(spans):
+        values = {"file_id": file_id, "trace_id": trace_id, "service": service}
+        for i, (name, started_at, seconds, attributes) in enumerate(batch):
+            values[f"name_{i}"] = name
+            values[f"started_at_{i}"] = datetime.utcfromtimestamp(started_at)
+            values[f"duration_seconds_{i}"] = seconds
+            values[f"attributes_{i}"] = json.dumps(attributes) if attributes else None
+        query = build_multi_insert("file_trace_spans", columns, ["file_id", "trace_id", "service"], len(batch))
+        await database.execute(query=query, values=values)
 
+@backend.routed
+async def fetch_trace_spans(file_id: str):
+    """Fetch every span recorded for a file, in start order."""
+    query = """
+        SELECT trace_id, service, name, started_at, duration_seconds, attributes
+        FROM file_trace_spans WHERE file_id = :file_id ORDER BY started_at, id
+    """
+    return await database.fetch_all(query=query, values={"file_id": file_id})
+
+@backend.routed
+async def delete_failure_segments(file_id: str):
+    """Delete a file's failure segments before it is processed again from the start."""
+    await database.execute(query="DELETE FROM file_failure_segments WHERE file_id = :file_id", values={"file_id": file_id})
+
+@backend.routed
+async def fetch_failure_segments(file_id: str, error_type: str = None):
+    """Fetch a file's failure segments in row order, optionally for one error type."""
+    query = """
+        SELECT error_type, segment_no, row_base, failure_count, row_numbers, sample
+        FROM file_failure_segments WHERE file_id = :file_id
+    """
+    values = {"file_id": file_id}
+    if error_type is not None:
+        query += " AND error_type = :error_type"
+        values["error_type"] = error_type
+    query += " ORDER BY error_type, segment_no"
+    return await database.fetch_all(query=query, values=values)
+
+@backend.routed
+async def insert_successes(file_id: str, rows: Iterable[tuple]) -> dict:
+    """Insert (row_hash, row_json) pairs into 'file_success' in batches, skipping rows already stored.
+
+    Duplicates are resolved per batch: in-batch repeats and hashes in seen_row_hashes are
+    dropped up front, the rest are claimed in file_success_hashes, whose primary key stands
+    in for a unique row_hash index across file_success's partitions.
+    Returns the inserted and deduplicated counts plus the most recent hashes this call
+    inserted or found claimed, which the caller should add to seen_row_hashes once its
+    transaction commits; a conflict may be with a row of the same, still open, transaction.
+    """
+    processed_at = datetime.utcnow()
+    inserted, deduplicated = 0, 0
+    new_hashes = deque(maxlen=max(ROW_HASH_CACHE_SIZE, 0))
+    for batch in iter_batches(rows):
+        hashed = {}
+        for row_hash, row_json in batch:
+            hashed.setdefault(row_hash, row_json)
+        new_rows = [(h, row) for h, row in hashed.items() if h not in seen_row_hashes]
+        deduplicated += len(batch) - len(new_rows)
+        if not new_rows:
+            continue
+        values = {"file_id": file_id, "processed_at": processed_at}
+        for i, (row_hash, row_json) in enumerate(new_rows):
+            values[f"row_data_{i}"] = row_json
+            values[f"row_hash_{i}"] = row_hash
+        tuples = ", ".join(f"(:row_hash_{i}, :row_data_{i})" for i in range(len(new_rows)))
+        query = f"""
+            WITH batch (row_hash, row_data) AS (VALUES {tuples}),
+            claimed AS (
+                INSERT INTO file_success_hashes (row_hash) SELECT row_hash FROM batch
+                ON CONFLICT DO NOTHING RETURNING row_hash
+            )
+            INSERT INTO file_success (file_id, processed_at, row_data, row_hash)
+            SELECT CAST(:file_id AS TEXT), CAST(:processed_at AS TIMESTAMP), CAST(batch.row_data AS JSONB), batch.row_hash
+            FROM batch JOIN claimed USING (row_hash)
+            RETURNING row_hash
+        """
+        returned = [row["row_hash"] for row in await database.fetch_all(query=query, values=values)]
+        inserted += len(returned)
+        deduplicated += len(new_rows) - len(returned)
+        new_hashes.extend(returned)
+        returned = set(returned)
+        new_hashes.extend(h for h, _ in new_rows if h not in returned)
+    return {"inserted": inserted, "deduplicated": deduplicated, "row_hashes": new_hashes}
+
+@backend.routed
 async def insert_success(file_id: str, row_data: dict):
     """Insert a successful row into 'file_success' table."""
-    row_hash = get_row_hash(row_data)
-    if await row_exists(row_hash):
-        return
-    query_insert = """
-        INSERT INTO file_success (file_id, processed_at, row_data, row_hash)
-        VALUES (:file_id, :processed_at, :row_data, :row_hash)
-    """
-    values = {
-        "file_id": file_id,
-        "processed_at": datetime.utcnow(),
-        "row_data": json.dumps(row_data),
-        "row_hash": row_hash
-    }
-    await database.execute(query=query_insert, values=values)
+    result = await insert_successes(file_id, [(get_row_hash(row_data), json.dumps(row_data))])
+    seen_row_hashes.update(result["row_hashes"])
 
+@cached(stats_cache, tags=lambda: ("totals",))
+@backend.routed
 async def fetch_file_counts():
-    """Fetch total, passed, and failed file counts for summary statistics."""
-    total_query = "SELECT COUNT(*) FROM files"
-    total = await database.fetch_val(total_query)
-    passed_query = "SELECT COUNT(*) FROM files WHERE processed = true"
-    passed = await database.fetch_val(passed_query)
+    """Fetch total, passed, and failed file counts for summary statistics from the daily rollup."""
+    query = "SELECT COALESCE(SUM(uploaded_files), 0) AS total, COALESCE(SUM(passed_files), 0) AS passed FROM file_stats_daily"
+    row = await database.fetch_one(query)
+    total, passed = int(row["total"]), int(row["passed"])
     failed = total - passed if total else 0
     return total, passed, failed
 
-async def get_file_ids_by_filename_and_date(filename: str, date_str: str = None):
-    """Fetch file_ids for a given filename and processed date."""
+@cached(stats_cache, tags=lambda filename, date_str=None: (f"filename:{filename}",))
+@backend.routed
+async def fetch_filename_row_counts(filename: str, date_str: str = None):
+    """Fetch passed and failed row counts for a filename, optionally on one processed date, from the rollup."""
     values = {"filename": filename}
+    query = """
+        SELECT COALESCE(SUM(passed_rows), 0) AS passed, COALESCE(SUM(failed_rows), 0) AS failed
+        FROM filename_stats_daily WHERE filename = :filename
+    """
     if date_str:
-        parsed_date = date.fromisoformat(date_str.strip())
-
-        query = """
-            SELECT file_id FROM files
-            WHERE filename = :filename
-            AND processed_at IS NOT NULL
-            AND DATE(processed_at) = :date
-        """
-        values["date"] = parsed_date
-    else:
-        query = """
-            SELECT file_id FROM files
-            WHERE filename = :filename
-        """
-
-    rows = await database.fetch_all(query=query, values=values)
-    return [row["file_id"] for row in rows]
-
-async def count_success_rows_by_fileids(file_ids: list):
-    """Count the number of successful rows for a list of file_ids."""
-    if not file_ids:
-        return 0
-    query = "SELECT COUNT(*) FROM file_success WHERE file_id = ANY(:file_ids)"
-    return await database.fetch_val(query, values={"file_ids": file_ids})
-
-
-async def count_failure_rows_by_fileids(file_ids: list):
-    """Count the number of failed rows for a list of file_ids."""
-    if not file_ids:
-        return 0
-    query = "SELECT COUNT(*) FROM file_failure WHERE file_id = ANY(:file_ids)"
-    return await database.fetch_val(query, values={"file_ids": file_ids})
+        query += " AND day = :date"
+        values["date"] = date.fromisoformat(date_str.strip())
+    row = await database.fetch_one(query=query, values=values)
+    return int(row["passed"]), int(row["failed"])
 
+@cached(stats_cache, tags=lambda date: ("daily",))
+@backend.routed
 async def get_file_stats_by_date(date):
-    """Fetch the count of success and failure files for a given date."""
+    """Fetch the count of success and failure files for a given date from the daily rollup."""
     query = """
-        SELECT 
-            COUNT(*) FILTER (WHERE processed = true) AS success_count,
-            COUNT(*) FILTER (WHERE processed = false) AS failure_count
-        FROM files
-        WHERE DATE(processed_at) = :date
+        SELECT passed_files AS success_count, failed_files AS failure_count
+        FROM file_stats_daily
+        WHERE day = :date
     """
     return await database.fetch_one(query=query, values={"date": date})
@@ -0,0 +1,158 @@
+import glob
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import pandas as pd
+from dotenv import load_dotenv
+from services.constants import EXPECTED_COLUMNS
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = ipc = pq = None
+
+load_dotenv()
+
+# Write each processed file's passed rows as parquet or arrow (Arrow IPC) under EXPORT_DIR; empty disables
+EXPORT_FORMAT = os.getenv("EXPORT_FORMAT", "").lower()
+EXPORT_DIR = os.getenv("EXPORT_DIR", "/data/exports")
+EXPORT_FORMATS = ("parquet", "arrow")
+EXPORT_MEDIA_TYPES = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.file",
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+if EXPORT_FORMAT and EXPORT_FORMAT not in EXPORT_FORMATS:
+    raise ValueError(f"Unknown EXPORT_FORMAT: {EXPORT_FORMAT}")
+if EXPORT_FORMAT and pa is None:
+    raise ImportError("EXPORT_FORMAT requires pyarrow (pip install pyarrow)")
+
+def export_schema():
+    """Every template column as text, exactly as uploaded; passed rows have no blank cells."""
+    return pa.schema([(column, pa.string()) for column in EXPECTED_COLUMNS])
+
+def _file_dir(file_id: str) -> str:
+    # file_id comes from the client, so it is hashed rather than used as a path
+    return os.path.join(EXPORT_DIR, hashlib.sha256(file_id.encode("utf-8")).hexdigest())
+
+def _export_path(file_id: str, export_format: str) -> str:
+    return os.path.join(_file_dir(file_id), f"rows.{export_format}")
+
+def _part_path(file_id: str, segment_no: int) -> str:
+    return os.path.join(_file_dir(file_id), "parts", f"{segment_no:012d}.{EXPORT_FORMAT}")
+
+def _write_table(table, sink, export_format: str):
+    if export_format == "parquet":
+        pq.write_table(table, sink)
+    else:
+        with ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+def encode_part(df: pd.DataFrame):
+    """Serialize a block's passed rows in EXPORT_FORMAT, or None when export is off or nothing applies.
+
+    Blocks whose columns do not match the template are not exported. Runs in the CPU pool.
+    """
+    if not EXPORT_FORMAT or df.empty or list(df.columns) != EXPECTED_COLUMNS:
+        return None
+    table = pa.Table.from_pandas(df.astype(str), schema=export_schema(), preserve_index=False)
+    sink = io.BytesIO()
+    _write_table(table, sink, EXPORT_FORMAT)
+    return sink.getvalue()
+
+def _replace(path: str, write):
+    """Write a file through a temporary file in the same directory so readers never see it half written."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            write(fh)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def write_part(file_id: str, segment_no: int, data: bytes):
+    """Store one block's encoded rows. Parts are named by segment number, so a retried block overwrites its own part."""
+    _replace(_part_path(file_id, segment_no), lambda fh: fh.write(data))
+
+def clear_export(file_id: str):
+    """Remove a file's parts and finished export, before it is processed from the start."""
+    shutil.rmtree(_file_dir(file_id), ignore_errors=True)
+
+def _iter_parquet_batches(path: str):
+    parquet_file = pq.ParquetFile(path)
+    for group in range(parquet_file.num_row_groups):
+        yield from parquet_file.read_row_group(group).to_batches()
+
+def _iter_arrow_batches(path: str):
+    with pa.memory_map(path) as source:
+        reader = ipc.open_file(source)
+        for batch in range(reader.num_record_batches):
+            yield reader.get_batch(batch)
+
+def iter_batches(path: str):
+    """Yield the record batches of a parquet or arrow file one at a time."""
+    if path.endswith(".parquet"):
+        return _iter_parquet_batches(path)
+    return _iter_arrow_batches(path)
+
+def finish_export(file_id: str):
+    """Combine a file's parts, in file order, into its single export file and drop the parts.
+
+    Batches are copied one at a time, so memory stays at one part. Safe to repeat: with
+    the parts gone the finished export is left as it is. Returns the export path or None.
+    """
+    if not EXPORT_FORMAT:
+        return None
+    parts = sorted(glob.glob(os.path.join(_file_dir(file_id), "parts", f"*.{EXPORT_FORMAT}")))
+    path = _export_path(file_id, EXPORT_FORMAT)
+    if not parts:
+        return path if os.path.exists(path) else None
+
+    def write(fh):
+        if EXPORT_FORMAT == "parquet":
+            writer = pq.ParquetWriter(fh, export_schema())
+        else:
+            writer = ipc.new_file(fh, export_schema())
+        with writer:
+            for part in parts:
+                for batch in iter_batches(part):
+                    writer.write_batch(batch)
+
+    _replace(path, write)
+    shutil.rmtree(os.path.dirname(parts[0]), ignore_errors=True)
+    return path
+
+def find_export(file_id: str):
+    """Return (path, format) of a file's finished export, or None."""
+    for export_format in EXPORT_FORMATS:
+        path = _export_path(file_id, export_format)
+        if os.path.exists(path):
+            return path, export_format
+    return None
+
+def iter_export_bytes(path: str, export_format: str, output_format: str, chunk_size: int):
+    """Yield an export file as output_format: the stored file as is, or csv/ndjson converted a batch at a time."""
+    if output_format == export_format:
+        with open(path, "rb") as fh:
+            while chunk := fh.read(chunk_size):
+                yield chunk
+        return
+    first = True
+    for batch in iter_batches(path):
+        df = batch.to_pandas()
+        if output_format == "csv":
+            yield df.to_csv(index=False, header=first).encode("utf-8")
+        else:
+            yield df.to_json(orient="records", lines=True, force_ascii=False).encode("utf-8")
+        first = False
+    if first and output_format == "csv":
+        yield (",".join(EXPECTED_COLUMNS) + "\n").encode("utf-8")
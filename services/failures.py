@@ -0,0 +1,25 @@
+import json
+import zlib
+import numpy as np
+
+# Row numbers are stored as zlib-compressed little-endian uint32 deltas
+ROW_DELTA_DTYPE = "<u4"
+
+def encode_row_numbers(rows) -> bytes:
+    """Compress an ascending sequence of row numbers into delta-encoded bytes."""
+    rows = np.asarray(rows, dtype=np.int64)
+    return zlib.compress(np.diff(rows, prepend=0).astype(ROW_DELTA_DTYPE).tobytes())
+
+def decode_row_numbers(data: bytes, row_base: int = 0) -> np.ndarray:
+    """Inverse of encode_row_numbers, shifting every row by row_base."""
+    deltas = np.frombuffer(zlib.decompress(data), dtype=ROW_DELTA_DTYPE)
+    return np.cumsum(deltas, dtype=np.int64) + row_base
+
+def merge_samples(segments, limit: int) -> list:
+    """Concatenate the stored samples of ordered segments, keeping at most limit entries."""
+    sample = []
+    for segment in segments:
+        if len(sample) >= limit:
+            break
+        sample.extend(json.loads(segment["sample"])[:limit - len(sample)])
+    return sample
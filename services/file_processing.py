@@ -1,94 +1,416 @@
+import asyncio
 import io
+import time
+from collections import deque
+from contextlib import contextmanager
 import pandas as pd
 from services.file_validators import validate_template, validate_nulls, validate_data_types
-from services.rabbit_service import publish_to_queue
-from services.db_services import update_file_status,insert_failure,insert_success
+from services.blob_store import open_csv
+from services.cpu_pool import run_cpu, max_in_flight
+from services.csv_blocks import read_header, iter_row_blocks
+from services.utlities import row_fingerprints, ROW_FINGERPRINT_BYTES
+from services.failures import encode_row_numbers
+from services.export import EXPORT_FORMAT, encode_part, write_part, clear_export, finish_export
+from services.tracing import add_timings
+from services.metrics import (
+    STAGE_SECONDS, VALIDATOR_SECONDS, FILE_SECONDS, ROWS_PER_SECOND, ROWS_TOTAL, FILES_TOTAL, VALIDATION_FAILURES_TOTAL,
+)
+from services.db_services import update_file_status,insert_failure_segments,insert_successes,database,seen_row_hashes,DB_BATCH_SIZE
+from services.db_services import get_checkpoint,save_checkpoint,complete_checkpoint,delete_failure_segments
 import os,json
 from dotenv import load_dotenv
 
-QUEUE_SECOND = os.getenv("QUEUE_SECOND")
+CSV_CHUNK_BYTES = int(os.getenv("CSV_CHUNK_BYTES", str(8 * 1024 * 1024)))
+RESULT_ERROR_SAMPLE_SIZE = int(os.getenv("RESULT_ERROR_SAMPLE_SIZE", "100"))
+CSV_READ_OPTIONS = {"dtype": {"contact_no": str}, "keep_default_na": False}
+ROW_HASH_WIDTH = ROW_FINGERPRINT_BYTES * 2
 
-async def process_file(file_id: str, file_content: str) -> dict:
-    """Process a single uploaded CSV file."""
-    result = {"file_id": file_id, "status": "success", "errors": {}}
-    try:
-        df = pd.read_csv(io.StringIO(file_content),dtype={"contact_no": str},keep_default_na=False)
-        df.columns = df.columns.str.strip() 
+async def process_file(file_id: str, blob_ref: str) -> dict:
+    """Process a single uploaded CSV file read from the blob store.
 
-        template_result = validate_template(df)
-        if template_result["status"] != "success":
-            result["errors"]["template"] = template_result.get("details", {})
-            result["status"] = "failed" 
+    The file is cut into CSV_CHUNK_BYTES blocks of whole rows. Parsing, validation and
+    row hashing run in the CPU pool (see analyze_block); the event loop only reads
+    blocks and writes results, so memory stays proportional to the blocks in flight.
+    The result keeps per-check error counts and at most RESULT_ERROR_SAMPLE_SIZE
+    sample rows per check.
 
-        null_result = validate_nulls(df)
-        if null_result["status"] != "success":
-            result["errors"]["null_check"] = null_result.get("details", {}).get("null_error", [])
-            result["status"] = "failed"
+    Each block's rows commit together with a checkpoint in file_checkpoints, so a
+    redelivered message resumes after the last committed block. Once the final status
+    is committed, processing the same file and blob again returns the stored result.
 
-        type_result = validate_data_types(df)
-        if type_result["status"] != "success":
-            result["errors"]["data_type_check"] = type_result.get("details", {})
-            result["status"] = "failed"
-
-        failed_rows = set()
-
-        if "template" in result["errors"]:
-            details = result["errors"]["template"]
-            for missing in details.get("missing_columns", []):
-                await insert_failure(file_id, "template", f"missing column: {missing}")
-            for extra in details.get("extra_columns", []):
-                await insert_failure(file_id, "template", f"extra column: {extra}")
-            if details.get("order_mismatch"):
-                await insert_failure(file_id, "template", "order mismatch")
-
-        for null_row in result["errors"].get("null_check", []):
-            row_num = null_row["row"]
-            failed_rows.add(row_num)
-            null_cols = ", ".join(null_row["null_columns"])
-            row_data = null_row["data"]
-            await insert_failure(
-                file_id,
-                "null_check",
-                f"Null value in column(s): {null_cols} at row {row_num}: {json.dumps(row_data)}"
-            )
-
-        for dtype_error, rows in result["errors"].get("data_type_check", {}).items():
-            for row_info in rows:
-                if isinstance(row_info, dict):
-                    row_num = row_info["row"]
-                    row_data = row_info["data"]
-                else:
-                    row_num = row_info
-                    row_data = df.iloc[row_num - 2].to_dict() 
-                failed_rows.add(row_num)
-                await insert_failure(
-                    file_id,
-                    dtype_error,
-                    f"{dtype_error} at row {row_num}: {json.dumps(row_data)}"
-                )
-
-        all_rows = list(range(2, len(df) + 2))  
-        passed_rows = [r for r in all_rows if r not in failed_rows]
-        passed_rows_data = [
-         df.iloc[r - 2].where(pd.notna(df.iloc[r - 2]), None).to_dict()  
-         for r in passed_rows
-        ]
-        for row_data in passed_rows_data:
-            await insert_success(file_id, row_data)
-
-        if result["status"] == "failed":
-            result["message"] = f"{len(failed_rows)} row(s) failed, {len(passed_rows)} row(s) passed"
+    With EXPORT_FORMAT set, passed rows are also written as one export part per block
+    and combined into a single parquet or arrow file before the final status commits.
+    Inside a trace, the per-stage timings are recorded as spans.
+    """
+    started = time.perf_counter()
+    started_at = time.time()
+    timings = {}
+    try:
+        checkpoint = await get_checkpoint(file_id)
+        if checkpoint is not None and checkpoint["blob_ref"] == blob_ref:
+            state = json.loads(checkpoint["state"])
+            if checkpoint["completed_at"] is not None:
+                return state["result"]
+            byte_offset, row_offset, segment_no = checkpoint["byte_offset"], checkpoint["row_offset"], checkpoint["segment_no"]
         else:
-            result["status"] = "success"
-            result["message"] = "All validations passed"
+            state = new_checkpoint_state(file_id)
+            byte_offset, row_offset, segment_no = None, 0, 0
+        result, counts = state["result"], state["counts"]
 
+        with open_csv(blob_ref) as fh:
+            header = await asyncio.to_thread(read_header, fh)
 
-        await update_file_status(file_id, result["status"])
-        await publish_to_queue(result, QUEUE_SECOND)
+            if byte_offset is None:
+                byte_offset = len(header)
+                await asyncio.to_thread(clear_export, file_id)
+                async with database.transaction():
+                    # A previous run's segments would otherwise outlive this run's
+                    await delete_failure_segments(file_id)
+                    await check_template(file_id, header, state, timings)
+                    await save_checkpoint(file_id, blob_ref, byte_offset, row_offset, segment_no, state)
+            else:
+                fh.seek(byte_offset)
+
+            # Row numbers from analyze_block are relative to its block
+            async for analysis in analyze_blocks(header, fh):
+                async with database.transaction():
+                    row_hashes = await record_block(file_id, analysis, state, row_offset, segment_no, timings)
+                    byte_offset += analysis["bytes"]
+                    row_offset += analysis["rows"]
+                    segment_no += 1
+                    await save_checkpoint(file_id, blob_ref, byte_offset, row_offset, segment_no, state)
+                seen_row_hashes.update(row_hashes)
+
+        finish_result(state)
+        if EXPORT_FORMAT:
+            with timed(timings, "export_write"):
+                await asyncio.to_thread(finish_export, file_id)
+        with timed(timings, "db_write"):
+            async with database.transaction():
+                await update_file_status(file_id, result["status"], counts["deduplicated"], counts["inserted_passed"], counts["inserted_failed"])
+                await complete_checkpoint(file_id, state)
+
+        record_file_metrics(result, timings, time.perf_counter() - started, counts["passed"], counts["failed"])
         return result
 
     except Exception as e:
+        FILES_TOTAL.inc(status="error")
         return {"file_id": file_id, "status": "error", "message": str(e)}
+    finally:
+        add_timings(timings, started_at)
+
+
+async def check_template(file_id: str, header: bytes, state: dict, timings: dict):
+    """Validate the header against the template, recording a failure segment if it does not match."""
+    result = state["result"]
+    with timed(timings, "validate_template"):
+        template_result = validate_template(parse_csv_bytes(header))
+    if template_result["status"] != "success":
+        result["errors"]["template"] = template_result.get("details", {})
+        result["status"] = "failed"
+        with timed(timings, "db_write"):
+            state["counts"]["inserted_failed"] += await insert_failure_segments(file_id, [template_segment(result["errors"]["template"])])
+
+
+async def record_block(file_id: str, analysis: dict, state: dict, row_offset: int, segment_no: int, timings: dict):
+    """Write one analyze_block result and fold it into state; returns the row hashes it stored or found claimed.
+
+    Call it inside a transaction and add the hashes to seen_row_hashes after it commits.
+    """
+    result, counts = state["result"], state["counts"]
+    for name, seconds in analysis["timings"].items():
+        timings[name] = timings.get(name, 0.0) + seconds
+    if analysis["error_counts"]:
+        result["status"] = "failed"
+        merge_error_samples(result, analysis, row_offset)
+    with timed(timings, "db_write"):
+        counts["inserted_failed"] += await insert_failure_segments(
+            file_id, failure_segments(analysis, segment_no, row_offset, state["sample_budget"])
+        )
+        inserted = await insert_successes(file_id, iter_passed_rows(analysis))
+    if analysis["passed_export"] is not None:
+        with timed(timings, "export_write"):
+            await asyncio.to_thread(write_part, file_id, segment_no, analysis["passed_export"])
+    counts["inserted_passed"] += inserted["inserted"]
+    counts["failed"] += analysis["failed"]
+    counts["passed"] += analysis["rows"] - analysis["failed"]
+    counts["deduplicated"] += inserted["deduplicated"]
+    return inserted["row_hashes"]
+
+
+def finish_result(state: dict):
+    """Set the final status, message and deduplicated count on a checkpoint state's result."""
+    result, counts = state["result"], state["counts"]
+    if result["status"] == "failed":
+        result["message"] = f"{counts['failed']} row(s) failed, {counts['passed']} row(s) passed"
+    else:
+        result["status"] = "success"
+        result["message"] = "All validations passed"
+    result["deduplicated_rows"] = counts["deduplicated"]
+
+
+def new_checkpoint_state(file_id: str) -> dict:
+    """The checkpointed part of process_file's progress before the first block."""
+    return {
+        "result": {"file_id": file_id, "status": "success", "errors": {}, "error_counts": {}},
+        "counts": {"passed": 0, "failed": 0, "deduplicated": 0, "inserted_passed": 0, "inserted_failed": 0},
+        "sample_budget": {},
+    }
+
+
+@contextmanager
+def timed(timings: dict, name: str):
+    """Add the with-block's duration in seconds to timings[name]."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - started
+
+
+VALIDATORS = ("validate_template", "validate_nulls", "validate_data_types")
+
+def record_file_metrics(result: dict, timings: dict, seconds: float, passed: int, failed: int):
+    """Publish one file's per-stage timings, row counts and failures to the metrics registry."""
+    for name, value in timings.items():
+        if name in VALIDATORS:
+            VALIDATOR_SECONDS.observe(value, validator=name)
+        else:
+            STAGE_SECONDS.observe(value, stage=name)
+    FILE_SECONDS.observe(seconds, status=result["status"])
+    FILES_TOTAL.inc(status=result["status"])
+    if seconds > 0:
+        ROWS_PER_SECOND.observe((passed + failed) / seconds)
+    ROWS_TOTAL.inc(passed, outcome="passed")
+    ROWS_TOTAL.inc(failed, outcome="failed")
+    ROWS_TOTAL.inc(result.get("deduplicated_rows", 0), outcome="deduplicated")
+    for error_type, count in result["error_counts"].items():
+        VALIDATION_FAILURES_TOTAL.inc(count, error_type=error_type)
+    if "template" in result["errors"]:
+        VALIDATION_FAILURES_TOTAL.inc(error_type="template")
+
+
+async def analyze_blocks(header: bytes, fh):
+    """Yield analyze_block results in file order while keeping the CPU pool saturated."""
+    blocks = iter_row_blocks(fh, CSV_CHUNK_BYTES)
+    pending = deque()
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < max_in_flight():
+                block = await asyncio.to_thread(next, blocks, None)
+                if block is None:
+                    exhausted = True
+                else:
+                    pending.append(run_cpu(analyze_block, header, block))
+            if not pending:
+                return
+            yield await pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def parse_csv_bytes(data: bytes) -> pd.DataFrame:
+    """Parse CSV bytes with the options every validator expects."""
+    df = pd.read_csv(io.BytesIO(data), **CSV_READ_OPTIONS)
+    df.columns = df.columns.str.strip()
+    return df
+
+
+def analyze_block(header: bytes, block: bytes) -> dict:
+    """Parse, validate and hash one block of rows. Runs in a CPU pool process.
+
+    Row numbers are relative to the block, the first row being row 2. Failing row numbers
+    come back compressed per error type, passed rows as a single NDJSON string and their
+    hashes as one fixed-width string, so the parent unpickles a few buffers instead of a
+    dict per row. passed_export holds the passed rows encoded for export, if enabled.
+    """
+    timings = {}
+    with timed(timings, "csv_parse"):
+        df = parse_csv_bytes(header + block)
+    errors = validate_chunk(df, timings)
+    failure_rows, failed_rows = chunk_failure_rows(errors)
+
+    error_counts = {}
+    samples = {}
+    if "null_check" in errors:
+        error_counts["null_check"] = len(errors["null_check"])
+        samples["null_check"] = errors["null_check"][:RESULT_ERROR_SAMPLE_SIZE]
+    for dtype_error, rows in errors.get("data_type_check", {}).items():
+        error_counts[dtype_error] = len(rows)
+        samples.setdefault("data_type_check", {})[dtype_error] = rows[:RESULT_ERROR_SAMPLE_SIZE]
+
+    with timed(timings, "row_hashing"):
+        passed = df[~(df.index + 2).isin(list(failed_rows))]
+        passed_hashes = row_fingerprints(passed).tobytes().hex()
+        # One JSON document per line; JSON escapes newlines inside values
+        passed_json = passed.to_json(orient="records", lines=True, double_precision=15).rstrip("\n") if len(passed) else ""
+    passed_export = None
+    if EXPORT_FORMAT:
+        with timed(timings, "export_encode"):
+            passed_export = encode_part(passed)
+
+    return {
+        "rows": len(df),
+        "bytes": len(block),
+        "failed": len(failed_rows),
+        "failure_rows": {error_type: encode_row_numbers(rows) for error_type, rows in failure_rows.items()},
+        "error_counts": error_counts,
+        "samples": samples,
+        "timings": timings,
+        "passed_json": passed_json,
+        "passed_hashes": passed_hashes,
+        "passed_export": passed_export,
+    }
+
+
+def iter_passed_rows(analysis: dict):
+    """Yield (row_hash, row_json) pairs from an analyze_block result."""
+    if not analysis["passed_json"]:
+        return
+    hashes = analysis["passed_hashes"]
+    for i, row_json in enumerate(analysis["passed_json"].split("\n")):
+        yield hashes[i * ROW_HASH_WIDTH:(i + 1) * ROW_HASH_WIDTH], row_json
+
+
+def validate_chunk(df: pd.DataFrame, timings: dict = None) -> dict:
+    """Run the row-level validators on a chunk and return its errors keyed by check."""
+    timings = {} if timings is None else timings
+    errors = {}
+    with timed(timings, "validate_nulls"):
+        null_result = validate_nulls(df)
+    if null_result["status"] != "success":
+        errors["null_check"] = null_result.get("details", {}).get("null_error", [])
+
+    with timed(timings, "validate_data_types"):
+        type_result = validate_data_types(df)
+    if type_result["status"] != "success":
+        errors["data_type_check"] = type_result.get("details", {})
+    return errors
+
+
+def template_failures(details: dict) -> list:
+    """Build (error_type, error_detail) failure records for a template mismatch."""
+    failures = []
+    for missing in details.get("missing_columns", []):
+        failures.append(("template", f"missing column: {missing}"))
+    for extra in details.get("extra_columns", []):
+        failures.append(("template", f"extra column: {extra}"))
+    if details.get("order_mismatch"):
+        failures.append(("template", "order mismatch"))
+    return failures
+
+
+def chunk_failure_rows(errors: dict):
+    """Return a chunk's failing row numbers per error type, and the set of all failed rows."""
+    failure_rows = {}
+    if errors.get("null_check"):
+        failure_rows["null_check"] = sorted(row["row"] for row in errors["null_check"])
+    for dtype_error, rows in errors.get("data_type_check", {}).items():
+        if rows:
+            failure_rows[dtype_error] = sorted(row["row"] if isinstance(row, dict) else row for row in rows)
+    failed_rows = set()
+    for rows in failure_rows.values():
+        failed_rows.update(rows)
+    return failure_rows, failed_rows
+
+
+def block_samples(samples: dict) -> dict:
+    """Flatten analyze_block samples to {error_type: sample rows}."""
+    flat = {}
+    if "null_check" in samples:
+        flat["null_check"] = samples["null_check"]
+    flat.update(samples.get("data_type_check", {}))
+    return flat
+
+
+def failure_segments(analysis: dict, segment_no: int, row_offset: int, sample_budget: dict) -> list:
+    """Build one failure segment per error type for a block.
+
+    Segments keep the block-relative row numbers with row_offset as their base. Samples
+    are shifted to file row numbers and draw on sample_budget so each error type keeps at
+    most RESULT_ERROR_SAMPLE_SIZE sample rows per file.
+    """
+    samples = block_samples(analysis["samples"])
+    segments = []
+    for error_type, row_numbers in analysis["failure_rows"].items():
+        remaining = sample_budget.get(error_type, RESULT_ERROR_SAMPLE_SIZE)
+        sample = [{**row, "row": row["row"] + row_offset} for row in samples.get(error_type, [])[:remaining]]
+        sample_budget[error_type] = remaining - len(sample)
+        segments.append({
+            "error_type": error_type,
+            "segment_no": segment_no,
+            "row_base": row_offset,
+            "failure_count": analysis["error_counts"][error_type],
+            "row_numbers": row_numbers,
+            "sample": sample,
+        })
+    return segments
+
+
+def template_segment(details: dict) -> dict:
+    """Build the failure segment for a template mismatch; it has no row numbers."""
+    failures = template_failures(details)
+    return {
+        "error_type": "template",
+        "segment_no": 0,
+        "row_base": 0,
+        "failure_count": len(failures),
+        "row_numbers": encode_row_numbers([]),
+        "sample": [detail for _, detail in failures],
+    }
+
+
+def merge_error_samples(result: dict, analysis: dict, row_offset: int):
+    """Add a block's error counts and samples to the result, keeping only a bounded sample."""
+    counts = result["error_counts"]
+    for check, count in analysis["error_counts"].items():
+        counts[check] = counts.get(check, 0) + count
+
+    def shifted(rows, limit):
+        return [{**row, "row": row["row"] + row_offset} for row in rows[:limit]]
+
+    samples = analysis["samples"]
+    if "null_check" in samples:
+        sample = result["errors"].setdefault("null_check", [])
+        sample.extend(shifted(samples["null_check"], RESULT_ERROR_SAMPLE_SIZE - len(sample)))
+
+    for dtype_error, rows in samples.get("data_type_check", {}).items():
+        sample = result["errors"].setdefault("data_type_check", {}).setdefault(dtype_error, [])
+        sample.extend(shifted(rows, RESULT_ERROR_SAMPLE_SIZE - len(sample)))
+
+
+def read_rows(blob_ref: str, row_numbers, block_size: int = None) -> dict:
+    """Read rows of a stored CSV by row number (the first data row is row 2) as {row: row dict}.
+
+    Scanning stops after the block holding the last requested row.
+    """
+    wanted = sorted(set(int(row) for row in row_numbers))
+    found = {}
+    if not wanted:
+        return found
+    with open_csv(blob_ref) as fh:
+        header = read_header(fh)
+        first_row = 2
+        for block in iter_row_blocks(fh, block_size or CSV_CHUNK_BYTES):
+            df = parse_csv_bytes(header + block)
+            last_row = first_row + len(df)
+            positions = [row - first_row for row in wanted if first_row <= row < last_row]
+            for position, row_data in zip(positions, iter_row_dicts(df.iloc[positions])):
+                found[first_row + position] = row_data
+            first_row = last_row
+            if first_row > wanted[-1]:
+                break
+    return found
+
+
+def iter_row_dicts(df: pd.DataFrame, batch_size: int = None):
+    """Yield row dicts (NaN converted to None) converting one batch of rows at a time."""
+    batch_size = batch_size or DB_BATCH_SIZE
+    for start in range(0, len(df), batch_size):
+        batch = df.iloc[start:start + batch_size]
+        yield from batch.astype(object).where(batch.notna(), None).to_dict("records")
 
 
 def compute_file_stats(total: int, passed: int, failed: int):
@@ -1,5 +1,6 @@
 from typing import List
 import pandas as pd
+import numpy as np
 from datetime import datetime
 from services.constants import EXPECTED_COLUMNS
 import math
@@ -7,6 +8,7 @@ import re
 from dateutil.parser import parse
 
 EMAIL_REGEX = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$") 
+DOB_FORMAT = "%m-%d-%Y"
 
 def validate_template(df: pd.DataFrame) -> dict:
     """
@@ -30,25 +32,85 @@ def validate_template(df: pd.DataFrame) -> dict:
 
     return {"status": "success"}
 
+def _clean_text(col: pd.Series) -> pd.Series:
+    """Return a column as stripped strings with zero-width spaces removed."""
+    return col.astype(str).str.strip().str.replace("\u200b", "", regex=False)
+
+def _row_records(df: pd.DataFrame, mask: pd.Series) -> dict:
+    """Build row dicts keyed by index label, only for the rows selected by mask."""
+    failing = df[mask]
+    return dict(zip(failing.index, failing.to_dict("records")))
+
+def blank_mask(df: pd.DataFrame) -> pd.DataFrame:
+    """Return a boolean frame marking cells that are null or blank after stripping."""
+    mask = df.isna()
+    for i, col in enumerate(df.columns):
+        values = df.iloc[:, i]
+        if values.dtype == object:
+            mask.iloc[:, i] |= values.astype(str).str.strip().eq("").to_numpy()
+    return mask
+
 def validate_nulls(df: pd.DataFrame) -> dict:
     """
     Validate that no required fields in the DataFrame are null or empty.
     
     Returns failed rows with the columns that are null/empty.
     """
+    mask = blank_mask(df)
+    has_null = mask.any(axis=1)
     null_rows = []
-    for idx, row in df.iterrows():
-        row_null_cols = [col for col in df.columns if pd.isna(row[col]) or str(row[col]).strip() == ""]
-        if row_null_cols:
+    if has_null.any():
+        columns = np.array(df.columns, dtype=object)
+        records = _row_records(df, has_null)
+        flagged = mask[has_null]
+        for idx, flags in zip(flagged.index, flagged.to_numpy()):
             null_rows.append({
-                "row": idx + 2, 
-                "null_columns": row_null_cols,
-                "data": row.to_dict() 
+                "row": idx + 2,
+                "null_columns": columns[flags].tolist(),
+                "data": records[idx]
             })
     if null_rows:
         return {"status": "failed", "details": {"null_error": null_rows}}
     return {"status": "success", "details": {"null_error": []}}
 
+def phone_error_mask(df: pd.DataFrame) -> pd.Series:
+    """Flag rows whose contact_no is present but does not contain exactly 10 digits."""
+    if "contact_no" not in df.columns:
+        return pd.Series(False, index=df.index)
+    phone = df["contact_no"]
+    present = phone.notna() & phone.ne("")
+    if pd.api.types.is_float_dtype(phone):
+        text = phone[present].astype("int64").astype(str)
+    else:
+        text = phone[present].astype(str).str.strip()
+    bad = text.str.count(r"\d").ne(10)
+    return bad.reindex(df.index, fill_value=False)
+
+def dob_error_mask(df: pd.DataFrame) -> pd.Series:
+    """Flag rows whose datetime is present but not a valid MM-DD-YYYY date."""
+    if "datetime" not in df.columns:
+        return pd.Series(False, index=df.index)
+    dob = df["datetime"]
+    present = dob.notna() & dob.ne("")
+    text = _clean_text(dob[present])
+    parsed = pd.to_datetime(text, format=DOB_FORMAT, errors="coerce")
+    bad = parsed.isna()
+    # pandas cannot represent years outside ~1677-2262, recheck those few with strptime
+    for idx in bad[bad].index:
+        try:
+            datetime.strptime(text[idx], DOB_FORMAT)
+            bad[idx] = False
+        except Exception:
+            pass
+    return bad.reindex(df.index, fill_value=False)
+
+def email_error_mask(df: pd.DataFrame) -> pd.Series:
+    """Flag rows whose email is non-empty and does not match EMAIL_REGEX."""
+    if "email" not in df.columns:
+        return pd.Series(False, index=df.index)
+    text = _clean_text(df["email"])
+    return text.ne("") & ~text.str.match(EMAIL_REGEX, na=False)
+
 def validate_data_types(df: pd.DataFrame) -> dict:
     """
     Validate the data types and formats of certain columns in the DataFrame.
@@ -58,34 +120,21 @@ def validate_data_types(df: pd.DataFrame) -> dict:
     - datetime follows MM-DD-YYYY
     - emails follow a valid email format
     """
-    errors = {"email_error": [], "phone_error": [], "dob_error": []}
-    for idx, row in df.iterrows():
-        if row.isna().all():
-            continue
-        row_dict = row.to_dict()
-        phone_val = row["contact_no"] if "contact_no" in row else ""
-        if pd.notna(phone_val) and phone_val != "":
-            if isinstance(phone_val, float):
-                phone_str = str(int(phone_val))
-            else:
-                phone_str = str(phone_val).strip()
-            phone_str = ''.join(filter(str.isdigit, phone_str))
-            if len(phone_str) != 10:
-                errors["phone_error"].append({"row": idx + 2, "data": row_dict})
-
-        dob_val = row["datetime"] if "datetime" in row else ""
-        if pd.notna(dob_val) and dob_val != "":
-            dob_str = str(dob_val).strip().replace("\u200b", "")
-            try:
-                datetime.strptime(dob_str, "%m-%d-%Y")
-            except Exception:
-                errors["dob_error"].append({"row": idx + 2, "data": row_dict})
-
-        email_str = str(row["email"]).strip().replace("\u200b", "") if "email" in row else ""
-        if email_str and not EMAIL_REGEX.match(email_str):
-            errors["email_error"].append({"row": idx + 2, "data": row_dict})
+    not_empty = ~df.isna().all(axis=1)
+    masks = {
+        "email_error": email_error_mask(df) & not_empty,
+        "phone_error": phone_error_mask(df) & not_empty,
+        "dob_error": dob_error_mask(df) & not_empty,
+    }
+    any_error = masks["email_error"] | masks["phone_error"] | masks["dob_error"]
+    errors = {}
+    if any_error.any():
+        records = _row_records(df, any_error)
+        for error_type in ["email_error", "phone_error", "dob_error"]:
+            mask = masks[error_type]
+            if mask.any():
+                errors[error_type] = [{"row": idx + 2, "data": records[idx]} for idx in mask[mask].index]
 
-    errors = {k: v for k, v in errors.items() if v}
     if errors:
         return {"status": "failed", "details": errors}
     return {"status": "success"}
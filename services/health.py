@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import os
+import time
+from services.db_services import database
+from services.rabbit_service import is_connected, queue_depth
+
+logger = logging.getLogger(__name__)
+
+HEALTH_CACHE_TTL_SECONDS = float(os.getenv("HEALTH_CACHE_TTL_SECONDS", "5"))
+HEALTH_CHECK_TIMEOUT_SECONDS = float(os.getenv("HEALTH_CHECK_TIMEOUT_SECONDS", "2"))
+QUEUE_FIRST = os.getenv("QUEUE_FIRST")
+
+_results = {}
+_checked_at = 0.0
+_refresh_lock = asyncio.Lock()
+
+async def check_database():
+    """Run a trivial query over the shared connection pool."""
+    await database.fetch_val("SELECT 1")
+
+async def check_rabbitmq():
+    """Verify the shared broker connection and round-trip a passive queue declare."""
+    if not is_connected():
+        raise ConnectionError("RabbitMQ connection is not open")
+    if QUEUE_FIRST:
+        await queue_depth(QUEUE_FIRST)
+
+CHECKS = {
+    "database": check_database,
+    "rabbitmq": check_rabbitmq,
+}
+
+async def _run_check(check):
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(check(), HEALTH_CHECK_TIMEOUT_SECONDS)
+        status, error = "ok", None
+    except asyncio.TimeoutError:
+        status, error = "error", f"timed out after {HEALTH_CHECK_TIMEOUT_SECONDS}s"
+    except Exception as e:
+        status, error = "error", str(e) or type(e).__name__
+    result = {"status": status, "latency_ms": round((time.perf_counter() - started) * 1000, 2)}
+    if error:
+        result["error"] = error
+    return result
+
+async def refresh_health():
+    """Run every dependency check concurrently and cache the results."""
+    global _results, _checked_at
+    async with _refresh_lock:
+        names = list(CHECKS)
+        results = await asyncio.gather(*(_run_check(CHECKS[name]) for name in names))
+        _results = dict(zip(names, results))
+        _checked_at = time.monotonic()
+    return _results
+
+async def get_health() -> dict:
+    """Return cached readiness, refreshing first only if the cache has gone stale."""
+    if time.monotonic() - _checked_at > HEALTH_CACHE_TTL_SECONDS and not _refresh_lock.locked():
+        await refresh_health()
+    ready = bool(_results) and all(r["status"] == "ok" for r in _results.values())
+    return {
+        "status": "ok" if ready else "error",
+        "age_seconds": round(time.monotonic() - _checked_at, 2),
+        "dependencies": _results,
+    }
+
+async def run_health_refresher():
+    """Refresh the cached health results every HEALTH_CACHE_TTL_SECONDS until cancelled."""
+    while True:
+        try:
+            await refresh_health()
+        except Exception:
+            logger.exception("Health refresh failed")
+        await asyncio.sleep(HEALTH_CACHE_TTL_SECONDS)
@@ -0,0 +1,143 @@
+import asyncio
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9, 1e10)
+THROUGHPUT_BUCKETS = (100, 1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6)
+WAIT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 15, 30, 60, 300, 900, 1800, 3600, 14400)
+
+# Metrics are plain per-process aggregates. Updates happen on the event loop (or under
+# the GIL for the odd thread), so the hot path is a dict lookup and a few additions.
+REGISTRY = []
+
+
+def _label_key(labelnames: tuple, labels: dict) -> tuple:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames: tuple, key: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, key)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """A monotonically increasing count, optionally split by labels."""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(self.labelnames, labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Observations counted into fixed buckets, with their sum and count."""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # key -> [per-bucket counts..., +Inf count, sum]
+        self.values = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with-block in seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, series in self.values.items():
+            labels = _format_labels(self.labelnames, key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames, key, 'le="%g"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            cumulative += series[len(self.buckets)]
+            bucket_labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{labels} {series[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render_metrics() -> str:
+    """Render every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+UPLOAD_BYTES = Histogram("fileflow_upload_bytes", "Size of uploaded files in bytes.", buckets=SIZE_BUCKETS)
+UPLOAD_SECONDS = Histogram("fileflow_upload_seconds", "Time to accept an upload, store it and enqueue it.", ("outcome",))
+QUEUE_PUBLISH_SECONDS = Histogram("fileflow_queue_publish_seconds", "Time to publish a message.", ("queue",))
+QUEUE_WAIT_SECONDS = Histogram("fileflow_queue_wait_seconds", "Time from upload until a worker starts the file, per lane.", ("lane",), buckets=WAIT_BUCKETS)
+STAGE_SECONDS = Histogram("fileflow_stage_seconds", "Time spent per processing stage for one file, summed over its blocks.", ("stage",))
+VALIDATOR_SECONDS = Histogram("fileflow_validator_seconds", "Time spent per validator for one file, summed over its blocks.", ("validator",))
+FILE_SECONDS = Histogram("fileflow_file_seconds", "End-to-end processing time per file.", ("status",))
+ROWS_PER_SECOND = Histogram("fileflow_rows_per_second", "Rows processed per second, per file.", buckets=THROUGHPUT_BUCKETS)
+ROWS_TOTAL = Counter("fileflow_rows_total", "Rows processed by outcome.", ("outcome",))
+FILES_TOTAL = Counter("fileflow_files_total", "Files processed by final status.", ("status",))
+VALIDATION_FAILURES_TOTAL = Counter("fileflow_validation_failures_total", "Validation failures by error type.", ("error_type",))
+UPLOADS_REJECTED_TOTAL = Counter("fileflow_uploads_rejected_total", "Uploads refused with 429 by admission control, by limit.", ("reason",))
+CACHE_REQUESTS_TOTAL = Counter("fileflow_cache_requests_total", "Cached function calls by result: hit, miss or shared in-flight miss.", ("function", "result"))
+TEAMS_SEND_SECONDS = Histogram("fileflow_teams_send_seconds", "Time to deliver a Teams message, including retries.", ("outcome",))
+
+
+async def _serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = render_metrics().encode("utf-8")
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            + f"Content-Type: {METRICS_CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii")
+            + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port: int):
+    """Serve render_metrics() over plain HTTP on port, for processes without a web app."""
+    server = await asyncio.start_server(_serve_metrics, host="0.0.0.0", port=port)
+    logger.info("Metrics served on port %d", port)
+    return server
@@ -0,0 +1,404 @@
+import asyncio
+import logging
+import os
+from datetime import date, datetime
+import click
+from dotenv import load_dotenv
+from services.db_services import database
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Apply pending migrations when the API or a worker starts, instead of running the CLI on deploy
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "false").lower() == "true"
+# Monthly partitions of the row tables are created this many months ahead of the current one
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+# Row tables partitioned by month of processed_at; rows outside every partition land in <table>_default.
+# file_failure only holds rows from before failure segments; those age out by processed_at in drop_partitions.
+PARTITIONED_TABLES = ("file_success", "file_failure")
+# pg_advisory_xact_lock key held while migrating or adding partitions, so concurrent starters do each step once
+MIGRATION_LOCK_KEY = 0x66696c65
+
+def month_start(day: date) -> date:
+    return date(day.year, day.month, 1)
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_p{month:%Y_%m}"
+
+async def create_partition(table: str, month: date) -> bool:
+    """Create table's partition for month unless it exists; returns whether it was created.
+
+    Rows for that month already caught by the default partition are moved into it.
+    Call it inside a transaction; it takes the migration lock so concurrent callers wait.
+    """
+    await database.execute(query="SELECT pg_advisory_xact_lock(:key)", values={"key": MIGRATION_LOCK_KEY})
+    name = partition_name(table, month)
+    if await database.fetch_val(query="SELECT to_regclass(:name) IS NOT NULL", values={"name": name}):
+        return False
+    bounds = {"start": month, "end": next_month(month)}
+    await database.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    await database.execute(
+        query=f"""
+            WITH moved AS (
+                DELETE FROM {table}_default WHERE processed_at >= :start AND processed_at < :end RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+        """,
+        values=bounds,
+    )
+    await database.execute(
+        f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ('{bounds['start']}') TO ('{bounds['end']}')"
+    )
+    return True
+
+async def ensure_partitions(months_ahead: int = PARTITION_MONTHS_AHEAD) -> list:
+    """Create the current and the next months_ahead monthly partitions of every partitioned row table."""
+    created = []
+    tables = [table for table in PARTITIONED_TABLES
+              if await database.fetch_val(query="SELECT to_regclass(:name) IS NOT NULL", values={"name": f"{table}_default"})]
+    month = month_start(datetime.utcnow().date())
+    for _ in range(months_ahead + 1):
+        for table in tables:
+            async with database.transaction():
+                if await create_partition(table, month):
+                    created.append(partition_name(table, month))
+        month = next_month(month)
+    return created
+
+async def list_partitions(table: str) -> list:
+    """Return (partition name, month) for each monthly partition of table, oldest first."""
+    rows = await database.fetch_all(
+        query="""
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = CAST(:table AS regclass) ORDER BY c.relname
+        """,
+        values={"table": table},
+    )
+    prefix = f"{table}_p"
+    return [
+        (row["relname"], datetime.strptime(row["relname"][len(prefix):], "%Y_%m").date())
+        for row in rows if row["relname"].startswith(prefix)
+    ]
+
+async def drop_partitions(before: date) -> list:
+    """Drop every monthly partition whose rows were all processed before the given date.
+
+    Failure segments processed and trace spans started before the same month boundary
+    are deleted too, and the boundary is recorded in row_retention so a rollup rebuild
+    knows rows are missing.
+    The rows' hashes stay in file_success_hashes, so uploads repeating them are still
+    counted as duplicates, and the per-file and daily rollups keep their counts.
+    """
+    cutoff = month_start(before)
+    dropped = []
+    async with database.transaction():
+        for table in PARTITIONED_TABLES:
+            for name, month in await list_partitions(table):
+                if next_month(month) <= cutoff:
+                    await database.execute(f"DROP TABLE {name}")
+                    dropped.append(name)
+        segments = await database.fetch_val(
+            query="WITH deleted AS (DELETE FROM file_failure_segments WHERE processed_at < :cutoff RETURNING 1) SELECT COUNT(*) FROM deleted",
+            values={"cutoff": cutoff},
+        )
+        if segments:
+            logger.info("Deleted %d failure segment(s) processed before %s", segments, cutoff)
+        spans = await database.fetch_val(
+            query="WITH deleted AS (DELETE FROM file_trace_spans WHERE started_at < :cutoff RETURNING 1) SELECT COUNT(*) FROM deleted",
+            values={"cutoff": cutoff},
+        )
+        if spans:
+            logger.info("Deleted %d trace span(s) started before %s", spans, cutoff)
+        if dropped or segments:
+            await database.execute(
+                query="INSERT INTO row_retention (dropped_before, dropped_at) VALUES (:cutoff, :dropped_at) ON CONFLICT DO NOTHING",
+                values={"cutoff": cutoff, "dropped_at": datetime.utcnow()},
+            )
+    return dropped
+
+async def dropped_before():
+    """The latest month boundary drop_partitions removed rows before, or None if it never has."""
+    if not await database.fetch_val("SELECT to_regclass('row_retention') IS NOT NULL"):
+        return None
+    return await database.fetch_val("SELECT MAX(dropped_before) FROM row_retention")
+
+async def _partition_row_tables():
+    """Move file_success and file_failure into monthly partitions of processed_at.
+
+    A unique index on a partitioned table has to include the partition key, so row_hash
+    uniqueness moves to the unpartitioned file_success_hashes table.
+    """
+    await database.execute("CREATE TABLE file_success_hashes (row_hash TEXT PRIMARY KEY)")
+    await database.execute("INSERT INTO file_success_hashes (row_hash) SELECT row_hash FROM file_success ON CONFLICT DO NOTHING")
+    # (column definitions, columns copied besides processed_at)
+    layouts = {
+        "file_success": ("file_id TEXT NOT NULL, row_hash TEXT NOT NULL, row_data JSONB NOT NULL", "file_id, row_hash, row_data"),
+        "file_failure": ("file_id TEXT NOT NULL, error_type TEXT, errors JSONB", "file_id, error_type, errors"),
+    }
+    for table in PARTITIONED_TABLES:
+        definitions, names = layouts[table]
+        await database.execute(f"ALTER TABLE {table} RENAME TO {table}_unpartitioned")
+        await database.execute(f"CREATE TABLE {table} ({definitions}, processed_at TIMESTAMP NOT NULL) PARTITION BY RANGE (processed_at)")
+        await database.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+        months = await database.fetch_all(
+            f"SELECT DISTINCT CAST(date_trunc('month', processed_at) AS DATE) AS month FROM {table}_unpartitioned WHERE processed_at IS NOT NULL"
+        )
+        for row in months:
+            await create_partition(table, row["month"])
+        # Indexes are built once the data is in place; processed_at was always set by the writers
+        await database.execute(f"""
+            INSERT INTO {table} ({names}, processed_at)
+            SELECT {names}, COALESCE(processed_at, now() AT TIME ZONE 'utc') FROM {table}_unpartitioned
+        """)
+        await database.execute(f"DROP TABLE {table}_unpartitioned")
+        await database.execute(f"CREATE INDEX {table}_file_id_idx ON {table} (file_id)")
+    await database.execute("CREATE INDEX file_success_row_hash_idx ON file_success (row_hash)")
+
+# (version, name, steps); a step is a SQL statement or an async callable. Append only,
+# never edit a migration that has shipped. Versions 1-6 match what services.schema used
+# to apply and use IF NOT EXISTS, so databases set up by hand or by it are adopted as is.
+MIGRATIONS = [
+    (1, "base tables", [
+        """
+        CREATE TABLE IF NOT EXISTS files (
+            file_id TEXT PRIMARY KEY,
+            filename TEXT,
+            userid TEXT,
+            username TEXT,
+            role TEXT,
+            processed BOOLEAN DEFAULT FALSE,
+            processed_at TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS file_success (
+            id SERIAL PRIMARY KEY,
+            file_id TEXT,
+            processed_at TIMESTAMP,
+            row_data JSONB,
+            row_hash TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS file_failure (
+            id SERIAL PRIMARY KEY,
+            file_id TEXT,
+            error_type TEXT,
+            errors JSONB,
+            processed_at TIMESTAMP
+        )
+        """,
+    ]),
+    (2, "deduplicate passed rows", [
+        "ALTER TABLE files ADD COLUMN IF NOT EXISTS deduplicated_rows INTEGER NOT NULL DEFAULT 0",
+        # Rows inserted by racing workers before the unique index existed
+        """
+        DELETE FROM file_success a USING file_success b
+        WHERE a.row_hash = b.row_hash AND a.ctid > b.ctid
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS file_success_row_hash_key ON file_success (row_hash)",
+    ]),
+    # Rollups read by the stats endpoints, see services.rollups
+    (3, "stats rollups", [
+        "ALTER TABLE files ADD COLUMN IF NOT EXISTS uploaded_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc')",
+        "ALTER TABLE files ADD COLUMN IF NOT EXISTS passed_rows BIGINT NOT NULL DEFAULT 0",
+        "ALTER TABLE files ADD COLUMN IF NOT EXISTS failed_rows BIGINT NOT NULL DEFAULT 0",
+        """
+        CREATE TABLE IF NOT EXISTS file_stats_daily (
+            day DATE PRIMARY KEY,
+            uploaded_files BIGINT NOT NULL DEFAULT 0,
+            passed_files BIGINT NOT NULL DEFAULT 0,
+            failed_files BIGINT NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS filename_stats_daily (
+            filename TEXT NOT NULL,
+            day DATE NOT NULL,
+            passed_rows BIGINT NOT NULL DEFAULT 0,
+            failed_rows BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (filename, day)
+        )
+        """,
+    ]),
+    # Compact failure storage, see services.failures; row detail is re-read from the blob
+    (4, "failure segments", [
+        "ALTER TABLE files ADD COLUMN IF NOT EXISTS blob_ref TEXT",
+        """
+        CREATE TABLE IF NOT EXISTS file_failure_segments (
+            file_id TEXT NOT NULL,
+            error_type TEXT NOT NULL,
+            segment_no INTEGER NOT NULL,
+            row_base BIGINT NOT NULL,
+            failure_count INTEGER NOT NULL,
+            row_numbers BYTEA NOT NULL,
+            sample JSONB NOT NULL,
+            processed_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (file_id, error_type, segment_no)
+        )
+        """,
+    ]),
+    # Resumable processing, see services.file_processing.process_file
+    (5, "processing checkpoints", [
+        """
+        CREATE TABLE IF NOT EXISTS file_checkpoints (
+            file_id TEXT PRIMARY KEY,
+            blob_ref TEXT NOT NULL,
+            byte_offset BIGINT NOT NULL,
+            row_offset BIGINT NOT NULL,
+            segment_no INTEGER NOT NULL,
+            state JSONB NOT NULL,
+            updated_at TIMESTAMP NOT NULL,
+            completed_at TIMESTAMP,
+            notified_at TIMESTAMP
+        )
+        """,
+    ]),
+    # Split/merge processing of large files, see services.sharding
+    (6, "file shards", [
+        """
+        CREATE TABLE IF NOT EXISTS file_shards (
+            file_id TEXT NOT NULL,
+            shard_no INTEGER NOT NULL,
+            start_offset BIGINT NOT NULL,
+            end_offset BIGINT NOT NULL,
+            rows BIGINT,
+            state JSONB,
+            completed_at TIMESTAMP,
+            PRIMARY KEY (file_id, shard_no)
+        )
+        """,
+    ]),
+    # Listing by processed status, and lookups of a filename's files by processing time
+    (7, "files query indexes", [
+        "CREATE INDEX IF NOT EXISTS files_processed_file_id_idx ON files (processed, file_id)",
+        "CREATE INDEX IF NOT EXISTS files_filename_processed_at_idx ON files (filename, processed_at)",
+    ]),
+    # Old rows go by dropping a month's partition, see drop_partitions
+    (8, "partition row tables by month", [_partition_row_tables]),
+    # Per-file processing timelines, see services.tracing
+    (9, "file trace spans", [
+        """
+        CREATE TABLE IF NOT EXISTS file_trace_spans (
+            id BIGSERIAL PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            trace_id TEXT NOT NULL,
+            service TEXT NOT NULL,
+            name TEXT NOT NULL,
+            started_at TIMESTAMP NOT NULL,
+            duration_seconds DOUBLE PRECISION NOT NULL,
+            attributes JSONB
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS file_trace_spans_file_id_idx ON file_trace_spans (file_id, started_at)",
+    ]),
+    # drop_partitions also ages out failure segments, and records what it removed for rollups rebuild
+    (10, "row retention", [
+        "CREATE INDEX IF NOT EXISTS file_failure_segments_processed_at_idx ON file_failure_segments (processed_at)",
+        """
+        CREATE TABLE IF NOT EXISTS row_retention (
+            dropped_before DATE PRIMARY KEY,
+            dropped_at TIMESTAMP NOT NULL
+        )
+        """,
+    ]),
+    # Shards commit block by block like whole files, see services.sharding.process_shard
+    (11, "shard progress", [
+        "ALTER TABLE file_shards ADD COLUMN IF NOT EXISTS byte_offset BIGINT, ADD COLUMN IF NOT EXISTS segment_no INTEGER",
+    ]),
+    # drop_partitions ages out trace spans with the rows
+    (12, "trace span retention", [
+        "CREATE INDEX IF NOT EXISTS file_trace_spans_started_at_idx ON file_trace_spans (started_at)",
+    ]),
+]
+
+async def migrate(target: int = None) -> list:
+    """Apply pending migrations up to target (default all) and create upcoming partitions.
+
+    Each migration commits on its own, together with its schema_migrations row. Returns
+    the versions applied. The database must be connected.
+    """
+    async with database.transaction():
+        await database.execute(query="SELECT pg_advisory_xact_lock(:key)", values={"key": MIGRATION_LOCK_KEY})
+        await database.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL
+            )
+        """)
+    applied = []
+    for version, name, steps in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        async with database.transaction():
+            await database.execute(query="SELECT pg_advisory_xact_lock(:key)", values={"key": MIGRATION_LOCK_KEY})
+            if await database.fetch_val(query="SELECT 1 FROM schema_migrations WHERE version = :version", values={"version": version}):
+                continue
+            for step in steps:
+                if isinstance(step, str):
+                    await database.execute(step)
+                else:
+                    await step()
+            await database.execute(
+                query="INSERT INTO schema_migrations (version, name, applied_at) VALUES (:version, :name, :applied_at)",
+                values={"version": version, "name": name, "applied_at": datetime.utcnow()},
+            )
+        logger.info("Applied migration %d: %s", version, name)
+        applied.append(version)
+    created = await ensure_partitions()
+    if created:
+        logger.info("Created partitions %s", ", ".join(created))
+    return applied
+
+async def applied_versions() -> set:
+    if not await database.fetch_val("SELECT to_regclass('schema_migrations') IS NOT NULL"):
+        return set()
+    return {row["version"] for row in await database.fetch_all("SELECT version FROM schema_migrations")}
+
+async def _run(coroutine_fn, *args):
+    await database.connect()
+    try:
+        return await coroutine_fn(*args)
+    finally:
+        await database.disconnect()
+
+@click.group()
+def cli():
+    """Manage the FileFlow database schema."""
+    logging.basicConfig(level=logging.INFO)
+
+@cli.command()
+@click.option("--target", type=int, help="Stop after this version.")
+def upgrade(target):
+    """Apply pending migrations and create upcoming monthly partitions."""
+    applied = asyncio.run(_run(migrate, target))
+    click.echo(f"Applied {len(applied)} migration(s)" + (f": {', '.join(map(str, applied))}" if applied else ""))
+
+@cli.command()
+def status():
+    """List migrations and whether each one has been applied."""
+    applied = asyncio.run(_run(applied_versions))
+    for version, name, _ in MIGRATIONS:
+        click.echo(f"{version:>4}  {'applied' if version in applied else 'pending':8} {name}")
+
+@cli.command()
+@click.option("--months-ahead", default=PARTITION_MONTHS_AHEAD, show_default=True)
+def partitions(months_ahead):
+    """Create the current and upcoming monthly partitions; run it from cron if workers rarely restart."""
+    created = asyncio.run(_run(ensure_partitions, months_ahead))
+    click.echo(f"Created {len(created)} partition(s)" + (f": {', '.join(created)}" if created else ""))
+
+@cli.command("drop-partitions")
+@click.option("--before", required=True, type=click.DateTime(formats=["%Y-%m-%d"]), help="Drop months that end on or before this date.")
+def drop_partitions_command(before):
+    """Drop whole months of passed rows, failed rows and failure segments processed before a date."""
+    dropped = asyncio.run(_run(drop_partitions, before.date()))
+    click.echo(f"Dropped {len(dropped)} partition(s)" + (f": {', '.join(dropped)}" if dropped else ""))
+
+if __name__ == "__main__":
+    cli()
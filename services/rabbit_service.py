@@ -1,35 +1,116 @@
+import asyncio
 import os
 import aio_pika
+from aio_pika.pool import Pool
 from dotenv import load_dotenv
 import json
+from services.metrics import QUEUE_PUBLISH_SECONDS
+from services.compression import compress_body, decompress_body
+from services.tracing import span, trace_headers
+from services.backends import Backend
 
 load_dotenv()
 
 RABBITMQ_URL = os.getenv("RABBITMQ_URL")
 QUEUE_NAME=os.getenv("QUEUE_NAME")
+RABBIT_CHANNEL_POOL_SIZE = int(os.getenv("RABBIT_CHANNEL_POOL_SIZE", "10"))
+RABBIT_PUBLISHER_CONFIRMS = os.getenv("RABBIT_PUBLISHER_CONFIRMS", "true").lower() == "true"
 
-async def test_rabbitmq():
-    """Test RabbitMQ connectivity"""
-    try:
-        connection = await aio_pika.connect_robust(RABBITMQ_URL)
-        channel = await connection.channel()
-        queue = await channel.declare_queue("test_queue", durable=True)
-        await channel.default_exchange.publish(
-            aio_pika.Message(body=b"Hello from FastAPI test!"),
-            routing_key="test_queue"
-        )
-        await connection.close()
-        return "RabbitMQ connected , test message sent"
-    except Exception as e:
-        return f"RabbitMQ test failed : {e}"
+# One connection per process, shared by every publisher and consumer
+_connection = None
+_channel_pool = None
+_declared_queues = set()
+_declared_exchanges = set()
+_connect_lock = asyncio.Lock()
+# The load test's in-memory broker takes over the functions below through this
+backend = Backend()
 
+async def connect_rabbitmq():
+    """Open the shared RabbitMQ connection and channel pool if they are not open yet."""
+    global _connection, _channel_pool
+    async with _connect_lock:
+        if _connection is not None and not _connection.is_closed:
+            return _connection
+        _connection = await aio_pika.connect_robust(RABBITMQ_URL)
+        _channel_pool = Pool(_open_channel, max_size=RABBIT_CHANNEL_POOL_SIZE)
+        _declared_queues.clear()
+        _declared_exchanges.clear()
+        return _connection
+
+async def close_rabbitmq():
+    """Close the channel pool and the shared connection."""
+    global _connection, _channel_pool
+    if _channel_pool is not None:
+        await _channel_pool.close()
+    if _connection is not None:
+        await _connection.close()
+    _connection, _channel_pool = None, None
+    _declared_queues.clear()
+    _declared_exchanges.clear()
+
+@backend.routed
+async def get_connection():
+    """Return the shared connection, connecting on first use."""
+    return await connect_rabbitmq()
+
+async def _open_channel():
+    return await _connection.channel(publisher_confirms=RABBIT_PUBLISHER_CONFIRMS)
+
+async def declare_queue_once(channel, queue_name: str):
+    """Declare a durable queue the first time this process publishes to it."""
+    if queue_name not in _declared_queues:
+        await channel.declare_queue(queue_name, durable=True)
+        _declared_queues.add(queue_name)
+
+def is_connected() -> bool:
+    """Whether the shared connection is currently open, without touching the broker."""
+    return _connection is not None and not _connection.is_closed and _connection.connected.is_set()
+
+@backend.routed
+async def queue_depth(queue_name: str) -> int:
+    """Return the number of ready messages in a queue using a passive declare (no publish)."""
+    await connect_rabbitmq()
+    async with _channel_pool.acquire() as channel:
+        queue = await channel.declare_queue(queue_name, durable=True, passive=True)
+        return queue.declaration_result.message_count
+
+@backend.routed
 async def publish_to_queue(message: dict, queue_name: str):
-    """Publish a JSON-encoded message to the specified RabbitMQ queue."""
-    connection = await aio_pika.connect_robust(RABBITMQ_URL)
-    async with connection:
-        channel = await connection.channel()
-        queue = await channel.declare_queue(queue_name, durable=True)
-        await channel.default_exchange.publish(
-            aio_pika.Message(body=json.dumps(message).encode()),
-            routing_key=queue.name
-        )
+    """Publish a JSON-encoded message to the specified RabbitMQ queue over a pooled channel.
+
+    Bodies of QUEUE_COMPRESS_MIN_BYTES or more are compressed and labelled with content_encoding.
+    Inside a trace the publish is a span and the message headers carry the trace on.
+    """
+    body, content_encoding = compress_body(json.dumps(message).encode())
+    with QUEUE_PUBLISH_SECONDS.time(queue=queue_name), span(f"publish:{queue_name}"):
+        await connect_rabbitmq()
+        async with _channel_pool.acquire() as channel:
+            await declare_queue_once(channel, queue_name)
+            await channel.default_exchange.publish(
+                aio_pika.Message(body=body, content_type="application/json", content_encoding=content_encoding, headers=trace_headers()),
+                routing_key=queue_name
+            )
+
+@backend.routed
+async def publish_to_exchange(message: dict, exchange_name: str):
+    """Publish a JSON-encoded message to every queue bound to a fanout exchange.
+
+    Messages are transient: they only matter to consumers that are running.
+    """
+    body, content_encoding = compress_body(json.dumps(message).encode())
+    with QUEUE_PUBLISH_SECONDS.time(queue=exchange_name):
+        await connect_rabbitmq()
+        async with _channel_pool.acquire() as channel:
+            if exchange_name in _declared_exchanges:
+                exchange = await channel.get_exchange(exchange_name, ensure=False)
+            else:
+                exchange = await channel.declare_exchange(exchange_name, aio_pika.ExchangeType.FANOUT, durable=True)
+                _declared_exchanges.add(exchange_name)
+            await exchange.publish(
+                aio_pika.Message(body=body, content_type="application/json", content_encoding=content_encoding),
+                routing_key=""
+            )
+
+def read_message(message) -> dict:
+    """Decode a consumed message's JSON body, honouring its content_encoding."""
+    return json.loads(decompress_body(message.body, message.content_encoding))
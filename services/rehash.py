@@ -0,0 +1,113 @@
+import asyncio
+import json
+import logging
+import click
+from services.db_services import database
+from services.utlities import get_row_hash
+
+logger = logging.getLogger(__name__)
+
+REHASH_BATCH_SIZE = 5000
+
+async def rehash_batch(after: str, batch_size: int):
+    """Recompute row_hash for the next batch of file_success rows after the given hash.
+
+    Rows whose new fingerprint a surviving file_success row already carries (a migrated
+    row, a row inserted since the upgrade, or an earlier row of the batch) are duplicates
+    and are deleted. A fingerprint only left in file_success_hashes, by a row whose
+    partition was dropped, keeps its entry and the row is rehashed. The
+    file_success_hashes entries are kept in step. Returns the last old hash of the batch
+    (None when done) with the updated and deleted counts.
+    """
+    rows = await database.fetch_all(
+        query="SELECT row_hash, row_data FROM file_success WHERE row_hash > :after ORDER BY row_hash LIMIT :limit",
+        values={"after": after, "limit": batch_size},
+    )
+    if not rows:
+        return None, 0, 0
+
+    new_hashes = {}
+    batch_hashes = set()
+    duplicates = []
+    for row in rows:
+        row_data = row["row_data"]
+        new_hash = get_row_hash(json.loads(row_data) if isinstance(row_data, str) else row_data)
+        if new_hash == row["row_hash"]:
+            continue
+        if new_hash in batch_hashes:
+            duplicates.append(row["row_hash"])
+        else:
+            batch_hashes.add(new_hash)
+            new_hashes[row["row_hash"]] = new_hash
+
+    # Old hashes whose new one is already in file_success_hashes without a surviving row
+    hash_only = []
+    if new_hashes:
+        stored = await database.fetch_all(
+            query="SELECT row_hash FROM file_success_hashes WHERE row_hash = ANY(:hashes)",
+            values={"hashes": list(new_hashes.values())},
+        )
+        stored = {row["row_hash"] for row in stored}
+        surviving = await database.fetch_all(
+            query="SELECT DISTINCT row_hash FROM file_success WHERE row_hash = ANY(:hashes)",
+            values={"hashes": list(stored)},
+        ) if stored else []
+        surviving = {row["row_hash"] for row in surviving}
+        for old_hash, new_hash in list(new_hashes.items()):
+            if new_hash in surviving:
+                duplicates.append(old_hash)
+                del new_hashes[old_hash]
+            elif new_hash in stored:
+                hash_only.append(old_hash)
+
+    async with database.transaction():
+        if duplicates:
+            for table in ("file_success", "file_success_hashes"):
+                await database.execute(
+                    query=f"DELETE FROM {table} WHERE row_hash = ANY(:hashes)",
+                    values={"hashes": duplicates},
+                )
+        if hash_only:
+            await database.execute(
+                query="DELETE FROM file_success_hashes WHERE row_hash = ANY(:hashes)",
+                values={"hashes": hash_only},
+            )
+        if new_hashes:
+            for table in ("file_success", "file_success_hashes"):
+                await database.execute(
+                    query=f"""
+                        UPDATE {table} SET row_hash = v.new_hash
+                        FROM unnest(CAST(:old_hashes AS TEXT[]), CAST(:new_hashes AS TEXT[])) AS v(old_hash, new_hash)
+                        WHERE {table}.row_hash = v.old_hash
+                    """,
+                    values={"old_hashes": list(new_hashes), "new_hashes": list(new_hashes.values())},
+                )
+    return rows[-1]["row_hash"], len(new_hashes), len(duplicates)
+
+async def rehash_rows(batch_size: int = REHASH_BATCH_SIZE):
+    """Rewrite every stored row_hash with the current row fingerprint, one committed batch at a time."""
+    await database.connect()
+    try:
+        after, updated, deleted = "", 0, 0
+        while after is not None:
+            after, batch_updated, batch_deleted = await rehash_batch(after, batch_size)
+            updated += batch_updated
+            deleted += batch_deleted
+            logger.info("Rehashed %d rows, removed %d duplicates", updated, deleted)
+    finally:
+        await database.disconnect()
+
+@click.command()
+@click.option("--batch-size", default=REHASH_BATCH_SIZE, show_default=True, help="Rows per transaction.")
+def main(batch_size):
+    """Migrate file_success.row_hash values to the current row fingerprint.
+
+    Safe to re-run; rows that already carry the current fingerprint are left alone.
+    Afterwards restart the workers to drop their cached hashes and rebuild the rollups
+    (python -m services.rollups rebuild) if any duplicates were removed.
+    """
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(rehash_rows(batch_size))
+
+if __name__ == "__main__":
+    main()
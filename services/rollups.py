@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import click
+from services.db_services import database
+from services.migrations import dropped_before
+
+logger = logging.getLogger(__name__)
+
+# Recomputes everything update_file_status and insert_file maintain incrementally
+REBUILD_STATEMENTS = [
+    # Writers wait for the rebuild instead of updating counters it is about to replace
+    "LOCK TABLE files, file_stats_daily, filename_stats_daily IN EXCLUSIVE MODE",
+    """
+    UPDATE files SET
+        passed_rows = (SELECT COUNT(*) FROM file_success s WHERE s.file_id = files.file_id),
+        failed_rows = (SELECT COUNT(*) FROM file_failure f WHERE f.file_id = files.file_id)
+            + (SELECT COALESCE(SUM(failure_count), 0) FROM file_failure_segments f WHERE f.file_id = files.file_id)
+    """,
+    "TRUNCATE file_stats_daily, filename_stats_daily",
+    """
+    INSERT INTO file_stats_daily (day, uploaded_files, passed_files, failed_files)
+    SELECT day, SUM(uploaded), SUM(passed), SUM(failed) FROM (
+        SELECT DATE(uploaded_at) AS day, 1 AS uploaded, 0 AS passed, 0 AS failed FROM files
+        UNION ALL
+        SELECT DATE(processed_at), 0,
+            CASE WHEN processed THEN 1 ELSE 0 END,
+            CASE WHEN processed THEN 0 ELSE 1 END
+        FROM files WHERE processed_at IS NOT NULL
+    ) counts
+    GROUP BY day
+    """,
+    """
+    INSERT INTO filename_stats_daily (filename, day, passed_rows, failed_rows)
+    SELECT filename, DATE(processed_at), SUM(passed_rows), SUM(failed_rows)
+    FROM files WHERE processed_at IS NOT NULL
+    GROUP BY filename, DATE(processed_at)
+    """,
+]
+
+async def rebuild_rollups(force: bool = False):
+    """Recompute the per-file counters and both rollup tables from the row tables.
+
+    Once drop_partitions has removed rows, a rebuild would lose their counts, so it
+    raises RuntimeError unless force is set.
+    """
+    await database.connect()
+    try:
+        cutoff = await dropped_before()
+        if cutoff is not None:
+            if not force:
+                raise RuntimeError(f"Rows processed before {cutoff} were dropped; a rebuild would lose their counts")
+            logger.warning("Rebuilding without the rows processed before %s that were dropped", cutoff)
+        async with database.transaction():
+            for statement in REBUILD_STATEMENTS:
+                await database.execute(statement)
+        logger.info("Rollups rebuilt")
+    finally:
+        await database.disconnect()
+
+@click.group()
+def cli():
+    """Maintain the statistics rollup tables."""
+    logging.basicConfig(level=logging.INFO)
+
+@cli.command()
+@click.option("--force", is_flag=True, help="Rebuild even though drop-partitions removed rows, losing their counts.")
+def rebuild(force):
+    """Backfill or rebuild the rollups from files, file_success and the failure tables."""
+    try:
+        asyncio.run(rebuild_rollups(force))
+    except RuntimeError as e:
+        raise click.ClickException(f"{e}; pass --force to rebuild anyway")
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,107 @@
+import asyncio
+import os
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Uploads of at least LARGE_FILE_BYTES go to the large lane, so they never queue ahead of small files
+LARGE_FILE_BYTES = int(os.getenv("LARGE_FILE_BYTES", str(64 * 1024 * 1024)))
+LANE_QUEUES = {
+    "small": os.getenv("QUEUE_FIRST"),
+    "large": os.getenv("QUEUE_LARGE", f"{os.getenv('QUEUE_FIRST')}_large"),
+}
+# Files each worker processes at once per lane
+LANE_CONCURRENCY = {
+    "small": int(os.getenv("SMALL_LANE_CONCURRENCY", "8")),
+    "large": int(os.getenv("LARGE_LANE_CONCURRENCY", "1")),
+}
+# Each worker holds up to concurrency * FAIR_SCHEDULING_WINDOW messages of a lane to choose from
+FAIR_SCHEDULING_WINDOW = int(os.getenv("FAIR_SCHEDULING_WINDOW", "4"))
+PRIORITY_ROLES = {role.strip() for role in os.getenv("PRIORITY_ROLES", "admin").split(",") if role.strip()}
+
+def lane_for(size: int) -> str:
+    """The lane a file of this many bytes is queued on."""
+    return "large" if size >= LARGE_FILE_BYTES else "small"
+
+def lane_prefetch(lane: str) -> int:
+    return max(LANE_CONCURRENCY[lane], 1) * max(FAIR_SCHEDULING_WINDOW, 1)
+
+class FairScheduler:
+    """Admit at most concurrency tasks at a time, sharing slots fairly between users.
+
+    When a slot frees up, waiting tasks of PRIORITY_ROLES go first; otherwise the waiting
+    user with the fewest running tasks is served, and users take turns on ties. One
+    user's backlog therefore only delays others by the tasks already running.
+    """
+
+    def __init__(self, concurrency: int):
+        self.concurrency = max(concurrency, 1)
+        self.running = 0
+        self.running_by_user = {}
+        # user -> futures of that user's waiting tasks; key order is the turn order
+        self._priority = OrderedDict()
+        self._waiting = OrderedDict()
+
+    def waiting(self) -> int:
+        return sum(len(futures) for futures in self._priority.values()) + sum(len(futures) for futures in self._waiting.values())
+
+    @asynccontextmanager
+    async def turn(self, user: str, role: str = None):
+        """Wait until this task is admitted and hold its slot for the with-block."""
+        queues = self._priority if role in PRIORITY_ROLES else self._waiting
+        future = asyncio.get_running_loop().create_future()
+        queues.setdefault(user, deque()).append(future)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(user)
+            else:
+                self._forget(queues, user, future)
+            raise
+        try:
+            yield
+        finally:
+            self._release(user)
+
+    def _next(self):
+        for queues in (self._priority, self._waiting):
+            if queues:
+                user = min(queues, key=lambda u: self.running_by_user.get(u, 0))
+                futures = queues[user]
+                future = futures.popleft()
+                if futures:
+                    queues.move_to_end(user)
+                else:
+                    del queues[user]
+                return user, future
+        return None
+
+    def _dispatch(self):
+        while self.running < self.concurrency:
+            picked = self._next()
+            if picked is None:
+                return
+            user, future = picked
+            if future.done():
+                continue
+            self.running += 1
+            self.running_by_user[user] = self.running_by_user.get(user, 0) + 1
+            future.set_result(None)
+
+    def _release(self, user: str):
+        self.running -= 1
+        self.running_by_user[user] -= 1
+        if not self.running_by_user[user]:
+            del self.running_by_user[user]
+        self._dispatch()
+
+    def _forget(self, queues: OrderedDict, user: str, future: asyncio.Future):
+        futures = queues.get(user)
+        if futures is not None and future in futures:
+            futures.remove(future)
+            if not futures:
+                del queues[user]
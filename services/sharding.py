@@ -0,0 +1,225 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from dotenv import load_dotenv
+from services.blob_store import open_csv, store_decoded
+from services.csv_blocks import read_header, plan_shards, BoundedReader
+from services.rabbit_service import publish_to_queue
+from services.metrics import FILES_TOTAL
+from services.export import EXPORT_FORMAT, clear_export, finish_export
+from services.tracing import add_timings
+from services.file_processing import (
+    CSV_CHUNK_BYTES, analyze_blocks, check_template, record_block, finish_result,
+    merge_error_samples, new_checkpoint_state, record_file_metrics,
+)
+from services.db_services import (
+    database, seen_row_hashes, update_file_status, get_checkpoint, save_checkpoint, complete_checkpoint,
+    insert_shards, get_shard, save_shard_progress, complete_shard, fetch_shards, shift_failure_segments,
+    delete_failure_segments,
+)
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SHARD_QUEUE = os.getenv("QUEUE_SHARDS", "file_shards")
+# Files larger than this are split into shards any worker can take; 0 disables sharding
+SHARD_THRESHOLD_BYTES = int(os.getenv("SHARD_THRESHOLD_BYTES", str(512 * 1024 * 1024)))
+SHARD_BYTES = int(os.getenv("SHARD_BYTES", str(128 * 1024 * 1024)))
+# Shard n numbers its failure segments from n * SHARD_SEGMENT_STRIDE so they stay in file order
+SHARD_SEGMENT_STRIDE = 1_000_000
+# Times a shard task runs before its file is given up on as errored
+SHARD_MAX_ATTEMPTS = int(os.getenv("SHARD_MAX_ATTEMPTS", "3"))
+
+def should_shard(size: int) -> bool:
+    """Whether a file of this many bytes is processed in shards."""
+    return SHARD_THRESHOLD_BYTES > 0 and size > SHARD_THRESHOLD_BYTES
+
+def _plan(blob_ref: str):
+    with open_csv(blob_ref) as fh:
+        header = read_header(fh)
+        return header, plan_shards(fh, SHARD_BYTES, CSV_CHUNK_BYTES)
+
+async def split_file(file_id: str, blob_ref: str):
+    """Cut a file into shards at record boundaries and publish one task per shard to SHARD_QUEUE.
+
+    The template check runs here, once. Returns the stored result if the file was already
+    finished, else None; the worker completing the last shard publishes the result.
+    On redelivery only shards that have not completed are published again. Compressed
+    uploads are decompressed into a blob of their own first, since shards seek into the file.
+    """
+    try:
+        blob_ref = await store_decoded(blob_ref)
+        checkpoint = await get_checkpoint(file_id)
+        if checkpoint is not None and checkpoint["blob_ref"] == blob_ref and "shards" in json.loads(checkpoint["state"]):
+            if checkpoint["completed_at"] is not None:
+                return json.loads(checkpoint["state"])["result"]
+            pending = [(shard["shard_no"], shard["start_offset"], shard["end_offset"])
+                       for shard in await fetch_shards(file_id) if shard["completed_at"] is None]
+        else:
+            header, shards = await asyncio.to_thread(_plan, blob_ref)
+            state = new_checkpoint_state(file_id)
+            state["shards"] = len(shards)
+            state["started_at"] = time.time()
+            await asyncio.to_thread(clear_export, file_id)
+            async with database.transaction():
+                await delete_failure_segments(file_id)
+                await check_template(file_id, header, state, {})
+                await save_checkpoint(file_id, blob_ref, len(header), 0, 0, state)
+                await insert_shards(file_id, shards)
+            if not shards:
+                return await reduce_shards(file_id)
+            pending = [(shard_no, start, end) for shard_no, (start, end) in enumerate(shards)]
+
+        for shard_no, start, end in pending:
+            await publish_to_queue(
+                {"file_id": file_id, "blob_ref": blob_ref, "shard_no": shard_no, "start": start, "end": end},
+                SHARD_QUEUE,
+            )
+        return None
+
+    except Exception as e:
+        FILES_TOTAL.inc(status="error")
+        return {"file_id": file_id, "status": "error", "message": str(e)}
+
+async def process_shard(file_id: str, blob_ref: str, shard_no: int):
+    """Validate and store one shard, then reduce the file if it was the last one.
+
+    As in process_file, each block's rows commit together with the shard's progress, so
+    a redelivered or retried task resumes after the last committed block. Row numbers are
+    relative to the shard until reduce_shards shifts them. Returns the file's result if
+    this call finished the file, else None. Errors propagate; see retry_shard.
+    """
+    timings = {}
+    started_at = time.time()
+    try:
+        checkpoint = await get_checkpoint(file_id)
+        if checkpoint is None or checkpoint["blob_ref"] != blob_ref or checkpoint["completed_at"] is not None:
+            # Finished, given up on, or left over from a previous upload of this file_id
+            return None
+        shard = await get_shard(file_id, shard_no)
+        if shard is None:
+            return None
+        if shard["completed_at"] is None and not await _process_shard_blocks(file_id, blob_ref, shard_no, shard, timings):
+            return None
+        # Also runs on redelivery of a completed shard, in case the reduce was lost
+        return await reduce_shards(file_id)
+    finally:
+        add_timings(timings, started_at)
+
+def _owns_shard(shard, byte_offset: int) -> bool:
+    # Another worker running the same task has committed blocks past ours, or finished it
+    progress = shard["start_offset"] if shard["byte_offset"] is None else shard["byte_offset"]
+    return shard["completed_at"] is None and progress == byte_offset
+
+async def _process_shard_blocks(file_id: str, blob_ref: str, shard_no: int, shard, timings: dict) -> bool:
+    """Run a shard's remaining blocks and complete it; False if another worker got ahead."""
+    if shard["byte_offset"] is None:
+        state = new_checkpoint_state(file_id)
+        byte_offset, row_offset, segment_no = shard["start_offset"], 0, shard_no * SHARD_SEGMENT_STRIDE
+    else:
+        state = json.loads(shard["state"])
+        byte_offset, row_offset, segment_no = shard["byte_offset"], shard["rows"], shard["segment_no"]
+
+    with open_csv(blob_ref) as fh:
+        header = await asyncio.to_thread(read_header, fh)
+        fh.seek(byte_offset)
+        async for analysis in analyze_blocks(header, BoundedReader(fh, shard["end_offset"])):
+            async with database.transaction():
+                if not _owns_shard(await get_shard(file_id, shard_no, for_update=True), byte_offset):
+                    return False
+                row_hashes = await record_block(file_id, analysis, state, row_offset, segment_no, timings)
+                byte_offset += analysis["bytes"]
+                row_offset += analysis["rows"]
+                segment_no += 1
+                await save_shard_progress(file_id, shard_no, byte_offset, row_offset, segment_no, state)
+            seen_row_hashes.update(row_hashes)
+
+    async with database.transaction():
+        if not _owns_shard(await get_shard(file_id, shard_no, for_update=True), byte_offset):
+            return False
+        shard_timings = state.setdefault("timings", {})
+        for name, seconds in timings.items():
+            shard_timings[name] = shard_timings.get(name, 0.0) + seconds
+        await complete_shard(file_id, shard_no, row_offset, state)
+    return True
+
+async def retry_shard(task: dict, error: Exception):
+    """Publish a failed shard task again, or after SHARD_MAX_ATTEMPTS mark its file as errored.
+
+    The attempt count travels in the task. Returns the file's error result if this gave up on it, else None.
+    """
+    attempt = task.get("attempt", 1)
+    if attempt < SHARD_MAX_ATTEMPTS:
+        logger.warning("Shard %s of %s failed (%s), retrying", task["shard_no"], task["file_id"], error)
+        await publish_to_queue({**task, "attempt": attempt + 1}, SHARD_QUEUE)
+        return None
+    logger.error("Shard %s of %s failed %d times, giving up on the file", task["shard_no"], task["file_id"], attempt)
+    return await fail_sharded_file(task["file_id"], task["blob_ref"], f"Shard {task['shard_no']}: {error}")
+
+async def fail_sharded_file(file_id: str, blob_ref: str, message: str):
+    """Finish a sharded file with an error result, counting the rows its shards committed.
+
+    Tasks for its other shards then do nothing. Returns the result, or None if the file
+    already finished.
+    """
+    async with database.transaction():
+        checkpoint = await get_checkpoint(file_id, for_update=True)
+        if checkpoint is None or checkpoint["blob_ref"] != blob_ref or checkpoint["completed_at"] is not None:
+            return None
+        state = json.loads(checkpoint["state"])
+        counts = state["counts"]
+        for shard in await fetch_shards(file_id):
+            if shard["state"] is not None:
+                for name, value in json.loads(shard["state"])["counts"].items():
+                    counts[name] += value
+        state["result"] = {"file_id": file_id, "status": "error", "message": message}
+        await update_file_status(file_id, "error", counts["deduplicated"], counts["inserted_passed"], counts["inserted_failed"])
+        await complete_checkpoint(file_id, state)
+    FILES_TOTAL.inc(status="error")
+    return state["result"]
+
+async def reduce_shards(file_id: str):
+    """Combine completed shards into the file's result, status update and rollups.
+
+    Only the caller that finds every shard complete, under the checkpoint row lock,
+    does the work; everyone else gets None.
+    """
+    async with database.transaction():
+        checkpoint = await get_checkpoint(file_id, for_update=True)
+        if checkpoint is None or checkpoint["completed_at"] is not None:
+            return None
+        shards = await fetch_shards(file_id)
+        if any(shard["completed_at"] is None for shard in shards):
+            return None
+
+        state = json.loads(checkpoint["state"])
+        result, counts = state["result"], state["counts"]
+        timings = {}
+        row_base = 0
+        for shard in shards:
+            shard_state = json.loads(shard["state"])
+            if row_base:
+                first_segment = shard["shard_no"] * SHARD_SEGMENT_STRIDE
+                await shift_failure_segments(file_id, first_segment, first_segment + SHARD_SEGMENT_STRIDE, row_base)
+            shard_result = shard_state["result"]
+            if shard_result["error_counts"]:
+                result["status"] = "failed"
+                merge_error_samples(result, {"error_counts": shard_result["error_counts"], "samples": shard_result["errors"]}, row_base)
+            for name, value in shard_state["counts"].items():
+                counts[name] += value
+            for name, seconds in shard_state.get("timings", {}).items():
+                timings[name] = timings.get(name, 0.0) + seconds
+            row_base += shard["rows"]
+
+        finish_result(state)
+        if EXPORT_FORMAT:
+            # Shard parts are numbered by segment, so they combine in file order
+            await asyncio.to_thread(finish_export, file_id)
+        await update_file_status(file_id, result["status"], counts["deduplicated"], counts["inserted_passed"], counts["inserted_failed"])
+        await complete_checkpoint(file_id, state)
+
+    record_file_metrics(result, timings, time.time() - state["started_at"], counts["passed"], counts["failed"])
+    return result
@@ -1,11 +1,23 @@
-from services.db_services import get_file_ids_by_filename_and_date,count_failure_rows_by_fileids,count_success_rows_by_fileids
+from services.db_services import fetch_filename_row_counts, stats_cache
+from services.rabbit_service import get_connection, publish_to_exchange, read_message
 from services.utlities import compute_pass_fail_stats
+import aio_pika
+import asyncio
 import datetime
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Fanout exchange on which workers announce finished files to every API process
+STATS_EXCHANGE = os.getenv("STATS_EXCHANGE", "file_stats_events")
+STATS_EVENTS_RETRY_SECONDS = 5
+
 async def get_filename_date_stats(filename: str, date: str):
     """Retrieve pass/fail statistics for all files matching a given filename and optional date."""
 
-    file_ids = await get_file_ids_by_filename_and_date(filename, date)
-    if not file_ids:
+    passed, failed = await fetch_filename_row_counts(filename, date)
+    if not passed and not failed:
         return {
             "filename": filename,
             "date": date,
@@ -16,10 +28,48 @@ async def get_filename_date_stats(filename: str, date: str):
             "failed_percent": 0
         }
 
-    passed = await count_success_rows_by_fileids(file_ids)
-    failed = await count_failure_rows_by_fileids(file_ids)
-
     stats = compute_pass_fail_stats(passed, failed)
     stats["filename"] = filename
     stats["date"] = date
-    return stats
\ No newline at end of file
+    return stats
+
+def invalidate_stats(event: dict):
+    """Drop the cached stats a finished file can change; everything if its filename is unknown."""
+    filename = event.get("filename")
+    if filename is None:
+        stats_cache.clear()
+    else:
+        stats_cache.invalidate(f"filename:{filename}", "daily", "totals")
+
+async def publish_stats_event(file_id: str, filename: str = None):
+    """Tell every API process that a file's final status is committed. Failures are only logged."""
+    try:
+        await publish_to_exchange({"file_id": file_id, "filename": filename}, STATS_EXCHANGE)
+    except Exception:
+        logger.exception("Could not publish stats event for %s", file_id)
+
+async def consume_stats_events():
+    """Invalidate the stats cache for each event on STATS_EXCHANGE, through a queue private to this process."""
+    connection = await get_connection()
+    channel = await connection.channel()
+    async with channel:
+        exchange = await channel.declare_exchange(STATS_EXCHANGE, aio_pika.ExchangeType.FANOUT, durable=True)
+        queue = await channel.declare_queue(exclusive=True)
+        await queue.bind(exchange)
+        async with queue.iterator(no_ack=True) as messages:
+            async for message in messages:
+                invalidate_stats(read_message(message))
+
+async def run_stats_invalidation():
+    """Consume stats events until cancelled, resubscribing after errors.
+
+    Events sent while unsubscribed are lost, so the cache is cleared before each attempt;
+    STATS_CACHE_TTL_SECONDS bounds staleness in the meantime.
+    """
+    while True:
+        stats_cache.clear()
+        try:
+            await consume_stats_events()
+        except Exception:
+            logger.exception("Stats event consumer failed")
+        await asyncio.sleep(STATS_EVENTS_RETRY_SECONDS)
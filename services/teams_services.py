@@ -1,40 +1,233 @@
+import asyncio
 import json
-import requests
+import logging
 import os
+import time
+import httpx
+from services.metrics import TEAMS_SEND_SECONDS
+from services.backends import Backend
+
+logger = logging.getLogger(__name__)
 
 TEAMS_WEBHOOK_URL = os.getenv("TEAMS_WEBHOOK_URL")
+TEAMS_TIMEOUT_SECONDS = float(os.getenv("TEAMS_TIMEOUT_SECONDS", "10"))
+TEAMS_MAX_RETRIES = int(os.getenv("TEAMS_MAX_RETRIES", "3"))
+TEAMS_BACKOFF_SECONDS = float(os.getenv("TEAMS_BACKOFF_SECONDS", "1"))
+# Incoming webhooks throttle at roughly 4 requests per second
+TEAMS_MIN_INTERVAL_SECONDS = float(os.getenv("TEAMS_MIN_INTERVAL_SECONDS", "0.25"))
+TEAMS_MAX_MESSAGE_CHARS = int(os.getenv("TEAMS_MAX_MESSAGE_CHARS", "4000"))
+TEAMS_MAX_ERROR_ROWS = int(os.getenv("TEAMS_MAX_ERROR_ROWS", "10"))
+# 0 sends one message per file; otherwise results are batched per window
+TEAMS_DIGEST_SECONDS = float(os.getenv("TEAMS_DIGEST_SECONDS", "0"))
 
-def send_teams_message(file_id: str, status: str, errors: dict = None) -> str:
-    """Send a formatted notification message to a Microsoft Teams channel via webhook."""
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# What send_teams_text returns when Teams accepted the message
+TEAMS_SENT = "Message sent to Teams"
+# Prefix of the results worth sending again later: network errors and RETRY_STATUS_CODES
+TEAMS_TRANSIENT_ERROR = "Error sending message"
 
-    if not TEAMS_WEBHOOK_URL:
-        return "TEAMS_WEBHOOK_URL not configured "
+_client = None
+_send_lock = asyncio.Lock()
+_last_sent = 0.0
+# The load test's stand-in sender takes over send_teams_message through this
+backend = Backend()
+
+def get_client() -> httpx.AsyncClient:
+    """Return the shared HTTP client used for webhook calls."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(timeout=TEAMS_TIMEOUT_SECONDS)
+    return _client
+
+async def close_client():
+    """Close the shared HTTP client."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+def truncate(text: str, limit: int = None) -> str:
+    """Cut text to at most limit characters, marking the cut."""
+    limit = limit or TEAMS_MAX_MESSAGE_CHARS
+    if len(text) <= limit:
+        return text
+    return text[:limit - 15] + "\n… (truncated)"
+
+def summarize_rows(rows: list, total: int = None) -> str:
+    """Summarize failed rows as a count and the first few row numbers."""
+    total = total if total is not None else len(rows)
+    numbers = [row["row"] if isinstance(row, dict) else row for row in rows[:TEAMS_MAX_ERROR_ROWS]]
+    more = total - len(numbers)
+    summary = f"{total} row(s): {numbers}"
+    return summary + (f" and {more} more" if more > 0 else "")
 
+def format_file_message(file_id: str, status: str, errors: dict = None, error_counts: dict = None) -> str:
+    """Build the notification text for one file, summarizing errors to a bounded size."""
+    error_counts = error_counts or {}
     message = f"**File ID:** {file_id}\n**Status:** {status}"
 
     if errors:
         message += "\n**Errors:**"
         for key, value in errors.items():
-            if isinstance(value, dict):
+            if isinstance(value, dict) and key == "template":
+                message += f"\n- {key} → {value}"
+            elif isinstance(value, dict):
                 message += f"\n- {key}:"
                 for sub_key, sub_val in value.items():
-                    message += f"\n    - {sub_key} → rows {sub_val}"
+                    message += f"\n    - {sub_key} → {summarize_rows(sub_val, error_counts.get(sub_key))}"
             elif isinstance(value, list):
-                message += f"\n- {key} → {value}"
+                message += f"\n- {key} → {summarize_rows(value, error_counts.get(key))}"
             else:
                 message += f"\n- {key} → {value}"
+    return truncate(message)
+
+async def _wait_for_rate_limit():
+    global _last_sent
+    wait = _last_sent + TEAMS_MIN_INTERVAL_SECONDS - time.monotonic()
+    if wait > 0:
+        await asyncio.sleep(wait)
+    _last_sent = time.monotonic()
+
+async def send_teams_text(text: str) -> str:
+    """Post a text message to the Teams webhook with rate limiting and retries."""
+    if not TEAMS_WEBHOOK_URL:
+        return "TEAMS_WEBHOOK_URL not configured "
+
+    started = time.perf_counter()
+    result = await _post_with_retries(text)
+    outcome = "sent" if result == TEAMS_SENT else "failed"
+    TEAMS_SEND_SECONDS.observe(time.perf_counter() - started, outcome=outcome)
+    return result
 
-    payload = {"text": message}
+async def _post_with_retries(text: str) -> str:
+    payload = json.dumps({"text": truncate(text)})
+    for attempt in range(TEAMS_MAX_RETRIES + 1):
+        delay = TEAMS_BACKOFF_SECONDS * (2 ** attempt)
+        try:
+            async with _send_lock:
+                await _wait_for_rate_limit()
+                response = await get_client().post(
+                    TEAMS_WEBHOOK_URL,
+                    headers={"Content-Type": "application/json"},
+                    content=payload
+                )
+            if response.status_code == 200:
+                return TEAMS_SENT
+            if response.status_code not in RETRY_STATUS_CODES:
+                return f"Failed to send message: {response.status_code} {response.text[:200]}"
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            error = f"{response.status_code} {response.text[:200]}"
+        except httpx.HTTPError as e:
+            error = str(e) or type(e).__name__
+        if attempt < TEAMS_MAX_RETRIES:
+            logger.warning("Teams send failed (%s), retrying in %.1fs", error, delay)
+            await asyncio.sleep(delay)
+    return f"{TEAMS_TRANSIENT_ERROR}: {error}"
 
-    try:
-        response = requests.post(
-            TEAMS_WEBHOOK_URL,
-            headers={"Content-Type": "application/json"},
-            data=json.dumps(payload)
-        )
-        if response.status_code == 200:
-            return f"Message sent to Teams for file_id: {file_id} "
+def is_transient(result: str) -> bool:
+    """Whether a send_teams_text result failed in a way a later attempt may not."""
+    return result is not None and result.startswith(TEAMS_TRANSIENT_ERROR)
+
+@backend.routed
+async def send_teams_message(file_id: str, status: str, errors: dict = None, error_counts: dict = None) -> str:
+    """Send a formatted notification message to a Microsoft Teams channel via webhook.
+
+    Returns the send_teams_text result; failures are logged.
+    """
+    result = await send_teams_text(format_file_message(file_id, status, errors, error_counts))
+    if result != TEAMS_SENT:
+        logger.warning("Teams notification for %s not sent: %s", file_id, result)
+    return result
+
+
+class TeamsDigest:
+    """Collects file results and sends them as one Teams message per time window.
+
+    A result may carry the message it was consumed from, which is acked once the digest
+    is sent or fails for good, and handed to retry(message) if it may be sent later
+    (requeued if retry is None). claim(file_id, status) is awaited just before sending
+    and drops results it returns False for; release(file_id, status) undoes a claim
+    before a retry.
+    """
+
+    def __init__(self, window_seconds: float, claim=None, release=None, retry=None):
+        self.window_seconds = window_seconds
+        self.claim = claim
+        self.release = release
+        self.retry = retry
+        self.pending = []
+
+    def add(self, file_id: str, status: str, errors: dict = None, error_counts: dict = None, message=None):
+        """Queue a file result for the next digest."""
+        self.pending.append((file_id, status, errors or {}, error_counts or {}, message))
+
+    def format(self, results: list) -> str:
+        """Build one message summarizing a window's results."""
+        statuses = {}
+        for _, status, _, _, _ in results:
+            statuses[status] = statuses.get(status, 0) + 1
+        lines = [f"**FileFlow digest:** {len(results)} file(s) — " + ", ".join(f"{k}: {v}" for k, v in statuses.items())]
+        for file_id, status, errors, error_counts, _ in results:
+            if error_counts:
+                detail = ", ".join(f"{k}: {v}" for k, v in error_counts.items())
+            else:
+                detail = ", ".join(errors)
+            lines.append(f"- {file_id}: {status}" + (f" ({detail})" if detail else ""))
+        return truncate("\n".join(lines))
+
+    async def flush(self) -> str:
+        """Send everything queued so far as a single message.
+
+        If claiming raises or sending fails transiently, claimed results are released and
+        their messages retried; results that fail for good are acked, as the failure is logged.
+        """
+        if not self.pending:
+            return None
+        results, self.pending = self.pending, []
+        claimed, outcome, checked = [], None, 0
+        try:
+            for result in results:
+                if self.claim is None or await self.claim(result[0], result[1]):
+                    claimed.append(result)
+                elif result[4] is not None:
+                    # Already sent, e.g. a redelivered message
+                    await result[4].ack()
+                checked += 1
+            if claimed:
+                outcome = await send_teams_text(self.format(claimed))
+            if outcome is not None and outcome != TEAMS_SENT:
+                logger.warning("Teams digest not sent: %s", outcome)
+        finally:
+            retry = outcome is None or is_transient(outcome)
+            for file_id, status, _, _, message in claimed:
+                if retry and self.release is not None:
+                    await self.release(file_id, status)
+                if message is not None:
+                    await (self._retry(message) if retry else message.ack())
+            for *_, message in results[checked:]:
+                if message is not None:
+                    await self._retry(message)
+        return outcome
+
+    async def _retry(self, message):
+        if self.retry is not None:
+            await self.retry(message)
         else:
-            return f"Failed to send message: {response.status_code} {response.text}"
-    except Exception as e:
-        return f"Error sending message: {e}"
+            await message.nack(requeue=True)
+
+    async def run(self):
+        """Flush the digest every window until cancelled; results of a failed flush are retried."""
+        try:
+            while True:
+                await asyncio.sleep(self.window_seconds)
+                try:
+                    result = await self.flush()
+                except Exception:
+                    logger.exception("Teams digest flush failed")
+                    continue
+                if result:
+                    logger.info("Teams digest: %s", result)
+        finally:
+            await self.flush()
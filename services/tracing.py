@@ -0,0 +1,144 @@
+import cProfile
+import contextvars
+import hashlib
+import logging
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from dotenv import load_dotenv
+from services.db_services import insert_trace_spans
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+# Files that take at least this long to process keep a cProfile dump in PROFILE_DIR; 0 disables profiling
+PROFILE_SLOW_FILE_SECONDS = float(os.getenv("PROFILE_SLOW_FILE_SECONDS", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/data/profiles")
+# Message headers that carry a trace from publisher to consumer
+TRACE_ID_HEADER = "x-trace-id"
+SENT_AT_HEADER = "x-sent-at"
+
+
+class Trace:
+    """The spans one process records for a file, held in memory until save_trace writes them."""
+
+    def __init__(self, file_id: str, service: str, trace_id: str = None):
+        self.file_id = file_id
+        self.service = service
+        self.trace_id = trace_id or uuid.uuid4().hex
+        # (name, started_at epoch seconds, duration seconds, attributes or None)
+        self.spans = []
+
+    def add(self, name: str, started_at: float, seconds: float, **attributes):
+        self.spans.append((name, started_at, seconds, attributes or None))
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Record the with-block as a span."""
+        started_at, started = time.time(), time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, started_at, time.perf_counter() - started, **attributes)
+
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+_profiling = False
+
+@contextmanager
+def span(name: str, **attributes):
+    """Record the with-block as a span of the current trace; outside a trace it does nothing."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+    else:
+        with trace.span(name, **attributes):
+            yield
+
+def add_timings(timings: dict, started_at: float):
+    """Add summed per-stage timings (see file_processing.timed) to the current trace, each starting at started_at.
+
+    Blocks overlap in the CPU pool, so a stage's total can exceed the wall time it spanned.
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        for name, seconds in timings.items():
+            trace.add(f"stage:{name}", started_at, seconds, summed=True)
+
+def trace_headers():
+    """Headers that continue the current trace in a message's consumer, or None outside a trace."""
+    trace = _current_trace.get()
+    if trace is None:
+        return None
+    return {TRACE_ID_HEADER: trace.trace_id, SENT_AT_HEADER: time.time()}
+
+@asynccontextmanager
+async def traced(file_id: str, service: str, name: str, headers: dict = None):
+    """Record spans for file_id during the with-block, itself a span called name, and store them at its end.
+
+    headers from a consumed message continue the publisher's trace, and the time since
+    it was sent is recorded as a queue_wait span.
+    """
+    if not TRACING_ENABLED or not file_id:
+        yield None
+        return
+    headers = headers or {}
+    trace = Trace(file_id, service, headers.get(TRACE_ID_HEADER))
+    sent_at = headers.get(SENT_AT_HEADER)
+    if sent_at:
+        trace.add("queue_wait", float(sent_at), max(time.time() - float(sent_at), 0.0))
+    token = _current_trace.set(trace)
+    try:
+        with trace.span(name):
+            yield trace
+    finally:
+        _current_trace.reset(token)
+        await save_trace(trace)
+
+async def save_trace(trace: Trace):
+    """Write a trace's spans in one batch. Failures are only logged; tracing never fails a file."""
+    if not trace.spans:
+        return
+    try:
+        await insert_trace_spans(trace.file_id, trace.trace_id, trace.service, trace.spans)
+    except Exception:
+        logger.exception("Could not store trace spans for %s", trace.file_id)
+
+@contextmanager
+def profile_if_slow(file_id: str):
+    """Run cProfile over the with-block and keep the dump if it took PROFILE_SLOW_FILE_SECONDS or longer.
+
+    The dump's path is recorded as a profile span. cProfile sees the whole event loop
+    thread, so other files' coroutines running meanwhile show up too, while CPU pool work
+    does not. Only one file (or shard) is profiled at a time per worker; files that start
+    while another is being profiled run without profiling.
+    """
+    global _profiling
+    if PROFILE_SLOW_FILE_SECONDS <= 0 or _profiling:
+        yield
+        return
+    _profiling = True
+    profiler = cProfile.Profile()
+    started_at, started = time.time(), time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _profiling = False
+        seconds = time.perf_counter() - started
+        if seconds >= PROFILE_SLOW_FILE_SECONDS:
+            name = f"{hashlib.sha256(file_id.encode()).hexdigest()}-{int(started_at)}.prof"
+            path = os.path.join(PROFILE_DIR, name)
+            try:
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                profiler.dump_stats(path)
+                trace = _current_trace.get()
+                if trace is not None:
+                    trace.add("profile", started_at, seconds, path=path)
+                logger.info("Saved profile of %s (%.1fs) to %s", file_id, seconds, path)
+            except OSError:
+                logger.exception("Could not save profile of %s", file_id)
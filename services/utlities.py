@@ -1,10 +1,45 @@
+import base64
 import hashlib
 import json
+import math
+import numpy as np
+import pandas as pd
+
+# Row fingerprints are BLAKE2b-128 digests of a canonical encoding of the row: for each
+# column in name order, "<len>:<name>" followed by "<len>:<str(value)>", or "-" for null.
+# Lengths count characters and the encoding is hashed as UTF-8. Changing any of this
+# changes every stored row_hash; see services.rehash.
+ROW_FINGERPRINT_BYTES = 16
+
+def _canonical_token(value) -> str:
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return "-"
+    text = str(value)
+    return f"{len(text)}:{text}"
 
 def get_row_hash(row_data: dict) -> str:
-    """Generate a hash for a row dictionary."""
-    row_str = json.dumps(row_data, sort_keys=True)  # deterministic string
-    return hashlib.md5(row_str.encode("utf-8")).hexdigest()
+    """Fingerprint a single row dict as hex; matches row_fingerprints for the same values."""
+    canonical = "".join(f"{len(name)}:{name}{_canonical_token(row_data[name])}" for name in sorted(row_data))
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=ROW_FINGERPRINT_BYTES).hexdigest()
+
+def row_fingerprints(df: pd.DataFrame) -> np.ndarray:
+    """Fingerprint every row of a DataFrame, returning an 'S16' array of digests.
+
+    The canonical encoding is built column by column, so the only per-row Python work is
+    the hash call. Use .tobytes() rather than indexing to read digests, since numpy drops
+    trailing zero bytes from 'S' scalars.
+    """
+    encoded = pd.Series("", index=df.index, dtype=object)
+    for name in sorted(df.columns):
+        column = df[name]
+        text = column.astype(str)
+        tokens = (text.str.len().astype(str) + ":" + text).where(column.notna(), "-")
+        encoded = encoded + f"{len(name)}:{name}" + tokens
+    digests = [
+        hashlib.blake2b(record.encode("utf-8"), digest_size=ROW_FINGERPRINT_BYTES).digest()
+        for record in encoded.to_numpy()
+    ]
+    return np.array(digests, dtype=f"S{ROW_FINGERPRINT_BYTES}")
 
 def compute_file_stats(total: int, passed: int, failed: int):
     """Compute file-level statistics: total, passed, failed counts and percentages."""
@@ -25,3 +60,14 @@ def compute_pass_fail_stats(passed: int, failed: int):
         "passed_percent": passed_percent,
         "failed_percent": failed_percent
     }
+
+def encode_cursor(last_key: str) -> str:
+    """Encode the last key of a page as an opaque pagination cursor."""
+    return base64.urlsafe_b64encode(json.dumps({"k": last_key}).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str) -> str:
+    """Decode a cursor from encode_cursor, raising ValueError if it is malformed."""
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))["k"]
+    except Exception:
+        raise ValueError("Invalid cursor")
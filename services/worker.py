@@ -1,74 +1,241 @@
 import asyncio
 import aio_pika
-import json
+import logging
 import os
+import time
 from dotenv import load_dotenv
 from services.file_processing import process_file
-from services.teams_services import send_teams_message
+from services.sharding import SHARD_QUEUE, should_shard, split_file, process_shard, retry_shard
+from services.teams_services import send_teams_message, close_client, is_transient, TeamsDigest, TEAMS_DIGEST_SECONDS
+from services.blob_store import get_blob_store
+from services.rabbit_service import connect_rabbitmq, close_rabbitmq, get_connection, publish_to_queue, read_message
+from services.db_services import claim_notification, release_notification
+from services.cpu_pool import get_process_pool, shutdown_process_pool
+from services.metrics import start_metrics_server, QUEUE_WAIT_SECONDS
+from services.scheduling import LANE_QUEUES, LANE_CONCURRENCY, FairScheduler, lane_prefetch
+from services.migrations import migrate, MIGRATE_ON_STARTUP
+from services.stats import publish_stats_event
+from services.tracing import traced, span, profile_if_slow
 
 from services.db_services import database  
 
 RABBITMQ_URL = os.getenv("RABBITMQ_URL")
 FILE_QUEUE = os.getenv("QUEUE_FIRST")    
 NOTIFICATION_QUEUE = os.getenv("QUEUE_SECOND")      
+# Statuses process_file commits; their notifications are sent once per file
+FINAL_STATUSES = ("success", "failed")
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9100"))
+# Times a notification is sent before a transient Teams failure is given up on
+NOTIFICATION_MAX_ATTEMPTS = int(os.getenv("NOTIFICATION_MAX_ATTEMPTS", "5"))
+
+logger = logging.getLogger(__name__)
 
 async def handle_file_message(message: aio_pika.IncomingMessage):
-    """Process a single file message from the file queue and send the result to the notification queue."""
+    """Process a single file message from the file queue and send the result to the notification queue.
+
+    A redelivered message resumes from the file's last checkpoint, or republishes the
+    stored result if the file already finished; notification_worker drops the repeat.
+    Files above SHARD_THRESHOLD_BYTES are split into shards for shard_worker instead.
+    The work is traced under the file_id, continuing the trace in the message headers.
+    """
     async with message.process():
-        msg = json.loads(message.body.decode())
+        msg = read_message(message)
         file_id = msg.get("file_id")
-        file_content = msg.get("file_content")
-        result = await process_file(file_id, file_content)
+        async with traced(file_id, "worker", "handle_file", message.headers):
+            if "file_content" in msg:
+                # Messages queued before uploads moved to the blob store
+                blob = await get_blob_store().put_bytes(msg["file_content"].encode("utf-8"))
+                msg.update(blob)
+            blob_ref = msg.get("blob_ref")
+            try:
+                size = get_blob_store().size(blob_ref)
+            except Exception as e:
+                # e.g. pruned by services.blob_store, or a malformed ref
+                result = {"file_id": file_id, "status": "error", "message": f"Stored file is not available: {e}"}
+            else:
+                if msg.get("size") is not None and size != msg["size"]:
+                    result = {"file_id": file_id, "status": "error", "message": "Stored file size does not match upload"}
+                elif should_shard(size):
+                    with span("split_file"):
+                        result = await split_file(file_id, blob_ref)
+                else:
+                    with span("process_file"), profile_if_slow(file_id):
+                        result = await process_file(file_id, blob_ref)
 
-        # Push result to Notification queue
-        connection = await aio_pika.connect_robust(RABBITMQ_URL)
-        async with connection:
-            channel = await connection.channel()
-            queue = await channel.declare_queue(NOTIFICATION_QUEUE, durable=True)
-            await channel.default_exchange.publish(
-                aio_pika.Message(body=json.dumps(result).encode()),
-                routing_key=queue.name
-            )
+            # Push result to Notification queue; sharded files publish when their last shard finishes
+            if result is not None:
+                await publish_to_queue(result, NOTIFICATION_QUEUE)
+                if result["status"] in FINAL_STATUSES:
+                    await publish_stats_event(file_id, msg.get("filename"))
+
+async def handle_shard_message(message: aio_pika.IncomingMessage):
+    """Process one shard of a large file and, if it was the last, send the file's result to the notification queue.
+
+    A failed shard is retried through retry_shard, which errors the file after SHARD_MAX_ATTEMPTS.
+    """
+    async with message.process(requeue=True):
+        msg = read_message(message)
+        async with traced(msg["file_id"], "worker", f"handle_shard:{msg['shard_no']}", message.headers):
+            try:
+                with profile_if_slow(msg["file_id"]):
+                    result = await process_shard(msg["file_id"], msg["blob_ref"], msg["shard_no"])
+            except Exception as e:
+                result = await retry_shard(msg, e)
+            if result is not None:
+                await publish_to_queue(result, NOTIFICATION_QUEUE)
+                # Every result here has committed the file's status. Shard tasks do not
+                # carry the filename, so every API process drops all cached stats
+                await publish_stats_event(msg["file_id"])
+
+def lane_handler(lane: str):
+    """Consumer callback for a lane: files start through the lane's FairScheduler, fairly across users."""
+    scheduler = FairScheduler(LANE_CONCURRENCY[lane])
+
+    async def on_message(message: aio_pika.IncomingMessage):
+        try:
+            msg = read_message(message)
+        except Exception:
+            # Without a decoded body there is nothing to schedule or retry
+            logger.exception("Rejecting undecodable message on the %s lane", lane)
+            await message.reject()
+            return
+        async with scheduler.turn(msg.get("userid"), msg.get("role")):
+            if msg.get("enqueued_at"):
+                QUEUE_WAIT_SECONDS.observe(max(time.time() - msg["enqueued_at"], 0.0), lane=lane)
+            await handle_file_message(message)
+    return on_message
 
 async def file_worker():
-    """Continuously consume file messages from the file queue."""
-    connection = await aio_pika.connect_robust(RABBITMQ_URL)
+    """Continuously consume file messages from every lane.
+
+    Each lane has its own channel whose prefetch gives the scheduler a window of files to pick from.
+    """
+    connection = await get_connection()
+    for lane, queue_name in LANE_QUEUES.items():
+        channel = await connection.channel()
+        await channel.set_qos(prefetch_count=lane_prefetch(lane))
+        queue = await channel.declare_queue(queue_name, durable=True)
+        await queue.consume(lane_handler(lane))
+
+    while True:
+        await asyncio.sleep(1)
+
+async def shard_worker():
+    """Continuously consume shard tasks, one at a time per worker, so shards spread across workers."""
+    connection = await get_connection()
     channel = await connection.channel()
-    queue = await channel.declare_queue(FILE_QUEUE, durable=True)
-    await queue.consume(handle_file_message)
+    await channel.set_qos(prefetch_count=1)
+    queue = await channel.declare_queue(SHARD_QUEUE, durable=True)
+    await queue.consume(handle_shard_message)
 
     while True:
         await asyncio.sleep(1)
 
+async def claim_final(file_id: str, status: str) -> bool:
+    """Claim a final result's notification so it is sent once; other results need no claim."""
+    return status not in FINAL_STATUSES or await claim_notification(file_id)
+
+async def release_final(file_id: str, status: str):
+    """Undo claim_final after a failed send, so a redelivered message sends it."""
+    if status in FINAL_STATUSES:
+        await release_notification(file_id)
+
+async def retry_notification(message: aio_pika.IncomingMessage):
+    """Ack a notification Teams did not take and publish it again at the back of the queue.
+
+    The attempt count travels in the body; after NOTIFICATION_MAX_ATTEMPTS it is dropped and logged.
+    """
+    body = read_message(message)
+    attempts = body.get("notify_attempts", 1) + 1
+    if attempts > NOTIFICATION_MAX_ATTEMPTS:
+        logger.error("Giving up on the %s notification for %s after %d attempts",
+                     body.get("status"), body.get("file_id"), NOTIFICATION_MAX_ATTEMPTS)
+    else:
+        await publish_to_queue({**body, "notify_attempts": attempts}, NOTIFICATION_QUEUE)
+    await message.ack()
+
+async def send_notification(message: aio_pika.IncomingMessage, body: dict):
+    """Send one result to Teams, claiming final results first so repeats are skipped.
+
+    If Teams fails transiently, the claim is released and the message retried through
+    retry_notification; other failures are logged and the message is acked.
+    """
+    async with message.process(ignore_processed=True):
+        file_id = body.get("file_id", "Unknown")
+        status = body.get("status", "Unknown")
+        async with traced(body.get("file_id"), "notifier", "notify", message.headers):
+            with span("claim_notification"):
+                claimed = await claim_final(file_id, status)
+            if not claimed:
+                return
+            with span("teams_send"):
+                result = await send_teams_message(file_id, status, notification_errors(body), body.get("error_counts"))
+            if is_transient(result):
+                await release_final(file_id, status)
+                await retry_notification(message)
+
+def notification_errors(body: dict) -> dict:
+    """The per-check error samples of a result that go into its notification."""
+    errors = {}
+    for stage in ["template", "null_check", "data_type_check"]:
+        if stage in body.get("errors", {}):
+            errors[stage] = body["errors"][stage]
+    return errors
+
 async def notification_worker():
-    """Continuously consume notification messages and send alerts to Teams."""
-    connection = await aio_pika.connect_robust(RABBITMQ_URL)
-    async with connection:
-        channel = await connection.channel()
-        queue = await channel.declare_queue(NOTIFICATION_QUEUE, durable=True)
+    """Continuously consume notification messages and send alerts to Teams.
 
-        async with queue.iterator() as queue_iter:
-            async for message in queue_iter:
-                async with message.process():
-                    body = json.loads(message.body.decode())
-                    file_id = body.get("file_id", "Unknown")
-                    status = body.get("status", "Unknown")
-                    errors = {}
-                    for stage in ["template", "null_check", "data_type_check"]:
-                        if stage in body.get("errors", {}):
-                            errors[stage] = body["errors"][stage]
+    With TEAMS_DIGEST_SECONDS set, results are batched into one message per window and
+    their messages stay unacked until the digest is sent. A file's final result is
+    claimed in file_checkpoints just before it is sent, so repeats of the message are
+    skipped, and released again if the send fails transiently.
+    """
+    digest = TeamsDigest(TEAMS_DIGEST_SECONDS, claim_final, release_final, retry_notification) if TEAMS_DIGEST_SECONDS > 0 else None
+    digest_task = asyncio.create_task(digest.run()) if digest else None
+    connection = await get_connection()
+    channel = await connection.channel()
+    try:
+        async with channel:
+            queue = await channel.declare_queue(NOTIFICATION_QUEUE, durable=True)
 
-                    result = send_teams_message(file_id, status, errors)
+            async with queue.iterator() as queue_iter:
+                async for message in queue_iter:
+                    try:
+                        body = read_message(message)
+                    except Exception:
+                        logger.exception("Dropping undecodable notification message")
+                        await message.reject()
+                        continue
+                    if digest:
+                        async with traced(body.get("file_id"), "notifier", "notify", message.headers):
+                            digest.add(body.get("file_id", "Unknown"), body.get("status", "Unknown"),
+                                       notification_errors(body), body.get("error_counts"), message)
+                    else:
+                        await send_notification(message, body)
+    finally:
+        if digest_task:
+            digest_task.cancel()
 
 async def main():
-    """Connect to the database and start file and notification workers concurrently."""
+    """Connect to the database and RabbitMQ, then start file and notification workers concurrently."""
     await database.connect()
+    if MIGRATE_ON_STARTUP:
+        await migrate()
+    await connect_rabbitmq()
+    # Start the CPU pool up front so the first file does not pay for spawning it
+    get_process_pool()
+    if WORKER_METRICS_PORT:
+        await start_metrics_server(WORKER_METRICS_PORT)
     try:
         await asyncio.gather(
             file_worker(),
+            shard_worker(),
             notification_worker()
         )
     finally:
+        shutdown_process_pool()
+        await close_client()
+        await close_rabbitmq()
         await database.disconnect()
 
 